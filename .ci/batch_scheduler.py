@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+"""Duration-aware ordering of matrix tasks for batchSize chunking
+
+Matrix.groovy run_parallel_in_chunks() collates tasks into chunks of
+batchSize in declaration order and runs chunk after chunk, so every chunk
+takes as long as its slowest task. Given past durations this tool orders
+tasks longest first, which groups slow tasks into the same chunk and
+minimizes the sum of chunk maxima, and reports the predicted wall time of
+the current order, the sorted order and of an LPT schedule onto batchSize
+executors without chunk barriers.
+
+Durations come from JSON history files, JUnit XML (testcase classname is
+the task, name the step) or TAP files (TAP 13 'duration_ms' diagnostics
+or '# time=' comments). A file can be assigned to one task with
+TASK=path. Tasks without history use the median of their steps seen in
+other tasks, then -default.
+
+The -out file is read by the pipeline via the 'batchSchedule' key.
+"""
+import os
+import re
+import sys
+import json
+import heapq
+import argparse
+import statistics
+import xml.etree.ElementTree as ET
+
+import matrix_planner
+from matrix_planner import MatrixError
+
+# key under which a duration of a whole task is stored
+TOTAL = None
+
+
+def usage():
+    parser = argparse.ArgumentParser(description='Order matrix tasks by historical duration for batchSize chunking')
+    parser.add_argument('-file', '--file', metavar='filename', type=str, help='Path to job_matrix.yaml file', required=True)
+    parser.add_argument('-history', '--history', metavar='[TASK=]FILE', action='append', default=[],
+                        help='Duration history: .json, JUnit .xml or .tap file, can be repeated')
+    parser.add_argument('-batch', '--batch', metavar='N', type=int,
+                        help='Batch size/executor limit, default: batchSize of the project file')
+    parser.add_argument('-default', '--default', metavar='SECONDS', type=float, default=60.0,
+                        help='Duration of steps without history, default: 60')
+    parser.add_argument('-out', '--out', metavar='filename', type=str, help='Write schedule JSON for batchSchedule')
+    parser.add_argument('-json', '--json', action='store_true', help='Print report as JSON')
+    parser.add_argument('-e', '--env', metavar='KEY=VALUE', action='append', default=[],
+                        help='Set job parameter/environment variable used by templates, can be repeated')
+
+    args = parser.parse_args()
+
+    if not os.path.isfile(args.file):
+        print('The file {} does not exist'.format(args.file))
+        exit(1)
+    return args
+
+
+class History:
+    """Duration samples in seconds per (task, step), step TOTAL for a whole task"""
+
+    def __init__(self):
+        self.samples = {}
+        self.step_medians = None
+
+    def add(self, task, step, seconds):
+        self.step_medians = None
+        self.samples.setdefault((task, step), []).append(float(seconds))
+
+    def task_time(self, task, steps, default):
+        """Estimated seconds of a task and whether it had history"""
+        if (task, TOTAL) in self.samples:
+            return statistics.median(self.samples[(task, TOTAL)]), True
+        if self.step_medians is None:
+            by_step = {}
+            for (one, step), values in self.samples.items():
+                if step is not TOTAL:
+                    by_step.setdefault(step, []).extend(values)
+            self.step_medians = {step: statistics.median(values) for step, values in by_step.items()}
+        total = 0.0
+        known = False
+        for step in steps:
+            if (task, step) in self.samples:
+                total += statistics.median(self.samples[(task, step)])
+                known = True
+            elif step in self.step_medians:
+                total += self.step_medians[step]
+                known = True
+            else:
+                total += default
+        return total, known
+
+    def load(self, spec):
+        task, path = None, spec
+        if not os.path.isfile(spec) and '=' in spec:
+            task, path = spec.split('=', 1)
+        if not os.path.isfile(path):
+            raise MatrixError('History file {} does not exist'.format(path))
+
+        if path.endswith('.json'):
+            self.load_json(path, task)
+        elif path.endswith('.xml'):
+            self.load_junit(path, task)
+        elif path.endswith('.tap'):
+            self.load_tap(path, task)
+        else:
+            raise MatrixError('Unknown history format of {}, expected .json, .xml or .tap'.format(path))
+
+    def load_json(self, path, task=None):
+        """{task: seconds | {step: seconds}} or [{task, step, duration}, ...]"""
+        with open(path) as fin:
+            data = json.load(fin)
+        if isinstance(data, dict):
+            data = data.get('tasks', data)
+            for name, value in data.items():
+                if isinstance(value, dict):
+                    for step, seconds in value.items():
+                        self.add(name, step, seconds)
+                else:
+                    self.add(name, TOTAL, value)
+            return
+        for record in data:
+            name = record.get('task', task)
+            if name is None or record.get('duration') is None:
+                raise MatrixError('History record without task or duration in {}: {}'.format(path, record))
+            self.add(name, record.get('step', TOTAL), record['duration'])
+
+    def load_junit(self, path, task=None):
+        try:
+            root = ET.parse(path).getroot()
+        except ET.ParseError as e:
+            raise MatrixError('Unable to parse JUnit file {}: {}'.format(path, e))
+        for suite in root.iter('testsuite'):
+            for case in suite.iter('testcase'):
+                if case.get('time') is None:
+                    continue
+                name = task or case.get('classname') or suite.get('name')
+                self.add(name, case.get('name'), case.get('time'))
+
+    def load_tap(self, path, task=None):
+        task = task or os.path.splitext(os.path.basename(path))[0]
+        point = re.compile(r'^\s*(?:not )?ok\b\s*\d*\s*(?:-\s*)?([^#]*)(?:#\s*time=([\d.]+)(ms|s)?)?')
+        duration = re.compile(r'^\s*duration_ms:\s*([\d.]+)')
+        last = None
+        with open(path) as fin:
+            for line in fin:
+                m = point.match(line)
+                if m:
+                    last = m.group(1).strip()
+                    if m.group(2):
+                        scale = 1.0 if m.group(3) == 's' else 0.001
+                        self.add(task, last, float(m.group(2)) * scale)
+                        last = None
+                    continue
+                m = duration.match(line)
+                if m and last is not None:
+                    self.add(task, last, float(m.group(1)) / 1000)
+                    last = None
+
+
+def chunked_makespan(order, times, size):
+    """Wall time of run_parallel_in_chunks(): sum of the slowest task per chunk"""
+    return sum(max(times[name] for name in order[pos:pos + size]) for pos in range(0, len(order), size))
+
+
+def lpt_lanes(order, times, size):
+    """Longest processing time first onto 'size' executors: (makespan, lanes)"""
+    lanes = [(0.0, idx, []) for idx in range(min(size, len(order)))]
+    for name in sorted(order, key=lambda name: -times[name]):
+        load, idx, tasks = heapq.heappop(lanes)
+        tasks.append(name)
+        heapq.heappush(lanes, (load + times[name], idx, tasks))
+    lanes.sort(key=lambda lane: lane[1])
+    return max([lane[0] for lane in lanes] + [0.0]), [lane[2] for lane in lanes]
+
+
+def plan(tasks, history, size, default):
+    names = [task['name'] for task in tasks]
+    times = {}
+    unknown = []
+    for task in tasks:
+        times[task['name']], known = history.task_time(task['name'], task['steps'], default)
+        if not known:
+            unknown.append(task['name'])
+    size = size if size and size > 0 else max(1, len(names))
+
+    # stable: equal durations keep declaration order
+    order = sorted(names, key=lambda name: -times[name])
+    lanes_makespan, lanes = lpt_lanes(names, times, size)
+    return {
+        'batchSize': size,
+        'order': order,
+        'durations': times,
+        'no_history': unknown,
+        'predicted': {
+            'declaration_order': chunked_makespan(names, times, size) if names else 0.0,
+            'duration_order': chunked_makespan(order, times, size) if names else 0.0,
+            'lpt_executors': lanes_makespan,
+        },
+        'lanes': lanes,
+    }
+
+
+def print_report(schedule, out=sys.stdout):
+    predicted = schedule['predicted']
+    base = predicted['declaration_order']
+    print('tasks: {} (without history: {})'.format(len(schedule['order']), len(schedule['no_history'])), file=out)
+    print('batch size: {}'.format(schedule['batchSize']), file=out)
+    for key, label in (('declaration_order', 'current chunking'),
+                       ('duration_order', 'longest first chunking'),
+                       ('lpt_executors', 'LPT on executors, no chunk barrier')):
+        change = (predicted[key] - base) * 100.0 / base if base else 0.0
+        print('  {:36} {:10.1f}s ({:+.1f}%)'.format(label, predicted[key], change + 0.0), file=out)
+    size = schedule['batchSize']
+    for pos in range(0, len(schedule['order']), size):
+        chunk = schedule['order'][pos:pos + size]
+        print('chunk {}: {:.1f}s'.format(pos // size + 1, max(schedule['durations'][name] for name in chunk)), file=out)
+        for name in chunk:
+            print('    {:10.1f}s {}'.format(schedule['durations'][name], name), file=out)
+
+
+def main(args):
+    environ = dict(os.environ)
+    for item in args.env:
+        key, _, value = item.partition('=')
+        environ[key] = value
+
+    try:
+        config = matrix_planner.read_job_project(args.file)
+        history = History()
+        for spec in args.history:
+            history.load(spec)
+        tasks = list(matrix_planner.MatrixPlanner(config, environ).iter_tasks())
+        size = args.batch if args.batch is not None else int(matrix_planner.get_config_val(config, ['batchSize'], 0))
+        schedule = plan(tasks, history, size, args.default)
+    except (MatrixError, ValueError) as e:
+        print('Error: {}'.format(e))
+        exit(1)
+
+    if args.json:
+        print(json.dumps(schedule, indent=2))
+    else:
+        print_report(schedule)
+    if args.out:
+        with open(args.out, 'w') as fout:
+            json.dump({'batchSize': schedule['batchSize'], 'order': schedule['order'],
+                       'predicted': schedule['predicted']}, fout, indent=2)
+
+
+if __name__ == '__main__':
+    args = usage()
+    main(args)
@@ -1,57 +1,30 @@
 #!/usr/bin/env python3
 import os
+import re
+import sys
+import json
+import math
 import argparse
-import yaml
 from string import Template
+from functools import lru_cache
 
-template = """apiVersion: v1
-kind: Pod
-metadata:
-  name: "{podname}-debug-reproducer"
-spec:
-  containers:
-  - command:
-    - cat
-    image: {imageurl}
-    imagePullPolicy: "Always"
-    name: "{imagename}"
-    resources:
-      limits: {limits}
-      requests: {requests}
-    securityContext:
-      privileged: false
-      capabilities:
-        add: {caps_add}
-    tty: true
-    volumeMounts:
-    {volumeMounts}
-  nodeSelector:
-    {nodeSelector}
-  restartPolicy: "Never"
-  securityContext:
-    runAsGroup: {uid}
-    runAsUser: {gid}
-  hostNetwork: false
-  volumes:
-  {volumes}
-"""
-
-volumes_tmpl = """
-  - hostPath:
-      path: "{hostPath}"
-    name: "volume-{volumeid}"
-"""
-
-mounts_tmpl = """
-    - mountPath: "{mountPath}"
-      name: "volume-{volumeid}"
-      readOnly: false
-"""
-
-nodeSelector_tmpl = """
-    beta.kubernetes.io/os: "{os}"
-    beta.kubernetes.io/arch: "{arch}"
-"""
+import project_loader
+
+# option: default, as Matrix.groovy runK8() takes them from the image or
+# the kubernetes section
+POD_OPTIONS = {
+    'limits': '{memory: 8Gi, cpu: 4000m}',
+    'requests': '{memory: 8Gi, cpu: 4000m}',
+    'caps_add': '[]',
+    'tolerations': '[]',
+    'annotations': [],
+    'runAsUser': '0',
+    'runAsGroup': '0',
+    'privileged': False,
+    'hostNetwork': False,
+    'namespace': 'default',
+    'nodeSelector': None,
+}
 
 arch_to_k8s_arch = {
     "x86_64": "amd64",
@@ -65,8 +38,12 @@ def usage():
     parser.add_argument('-file', metavar='filename', type=str, help='Path to job_matrix.yaml file', required=True)
     parser.add_argument('-out',  metavar='filename', type=str, help='Output file for pod.yaml file, default: stdout', required=False)
     parser.add_argument('-image_name', metavar='string', type=str, help="Select container name: default: find 1st from 'runs_on_dockers' list", required=False)
-    parser.add_argument('-arch', metavar='string', type=str, help='Select container arch, default: x86_64', required=False, default="x86_64")
+    parser.add_argument('-arch', metavar='string', type=str, help='Select container arch, default: x86_64', required=False)
     parser.add_argument('-tag', metavar='string', type=str, help='Select container tag name, default: latest', required=False, default="latest")
+    parser.add_argument('-all', action='store_true', help="Generate pods for every 'runs_on_dockers' entry and arch (filtered by -image_name regex and -arch)", required=False)
+    parser.add_argument('-out_dir', metavar='dirname', type=str, help='With -all: write one pod yaml file per image into directory instead of a multi-document stream', required=False)
+    parser.add_argument('-jobs', metavar='N', type=int, help='With -all: number of worker processes, default: 1', required=False, default=1)
+    parser.add_argument('-strict', action='store_true', help='Fail on unresolved ${} variables in image uri/url, default: warn', required=False)
 
     args = parser.parse_args()
 
@@ -77,21 +54,382 @@ def usage():
 
 
 def read_job_project(in_file_name):
-    with open(in_file_name) as in_file:
-        data = yaml.safe_load(in_file)
-    return data
+    # pods need a few top level keys, steps and matrix stay unparsed
+    return project_loader.load_view(in_file_name)
+
+
+class TemplateError(Exception):
+    pass
+
+
+@lru_cache(maxsize=1024)
+def compile_template(text):
+    """Split a $var/${var} template into (text, name) parts, name is None for literals"""
+    parts = []
+    pos = 0
+    for m in Template.pattern.finditer(text):
+        if m.start() > pos:
+            parts.append((text[pos:m.start()], None))
+        if m.group('escaped') is not None:
+            parts.append(('$', None))
+        elif m.group('invalid') is not None:
+            parts.append((m.group(0), None))
+        else:
+            parts.append((m.group(0), m.group('named') or m.group('braced')))
+        pos = m.end()
+    if pos < len(text):
+        parts.append((text[pos:], None))
+    return tuple(parts)
+
+
+class TemplateResolver:
+    """Resolves $var/${var} references against the project file variables
+
+    Lookup order is 'env', process environment, image, project file. Values
+    of 'env' are resolved again against the process environment first, so
+    'env' entries may extend variables of the same name (PATH: /opt/bin:$PATH).
+    The layers are chained, never merged, and templates are compiled once.
+    Unknown variables are kept as is and recorded in 'unresolved', reference
+    cycles raise TemplateError.
+    """
+
+    def __init__(self, config, environ=None):
+        self.config = config
+        self.env = config.get('env') or {}
+        self.environ = os.environ if environ is None else environ
+        self.unresolved = set()
+
+    def layers(self, image):
+        if self.env:
+            return (self.env, self.environ, image, self.config), (self.environ, self.env, image, self.config)
+        return (image, self.config), (image, self.config)
+
+    def resolve(self, text, image=None):
+        top, nested = self.layers(image or {})
+        return self._resolve(text, top, nested, ())
+
+    def _resolve(self, text, layers, nested, stack):
+        out = []
+        for raw, name in compile_template(text):
+            if name is None:
+                out.append(raw)
+                continue
+            for layer in layers:
+                if name in layer:
+                    break
+            else:
+                self.unresolved.add(name)
+                out.append(raw)
+                continue
+            key = (name, id(layer))
+            if key in stack:
+                chain = ' -> '.join('${' + n + '}' for n, _ in stack + (key,))
+                raise TemplateError("Recursive variable reference {} in '{}'".format(chain, text))
+            value = layer[name]
+            value = value if isinstance(value, str) else str(value)
+            if '$' in value:
+                value = self._resolve(value, nested, nested, stack + (key,))
+            out.append(value)
+        return ''.join(out)
 
 
 def resolve_template(str, config, image):
-    vars = {**config, **image}
-    t = Template(str)
+    return TemplateResolver(config).resolve(str, image)
+
+
+def prepare_image(job_yaml, item, arch, tag, resolver=None):
+    image = dict(item)
+    image['tag'] = image.get('tag', tag)
+    image['arch'] = image.get('arch', arch)
+
+    uri = image.get('uri', image['arch'] + "/" + image['name'])
+    if 'url' in image:
+        url = image['url']
+    else:
+        url = job_yaml['registry_host'] + job_yaml['registry_path'] + "/" + uri + ":" + image['tag']
+
+    resolver = resolver or TemplateResolver(job_yaml)
+    image['uri'] = resolver.resolve(uri, image)
+    image['url'] = resolver.resolve(url, image)
+    return image
+
+
+def check_unresolved(resolver, strict=False):
+    if not resolver.unresolved:
+        return
+    names = ', '.join('${' + name + '}' for name in sorted(resolver.unresolved))
+    if strict:
+        print("Error: unresolved variables: {}".format(names))
+        exit(1)
+    print("Warning: unresolved variables: {}".format(names), file=sys.stderr)
+
+
+@lru_cache(maxsize=256)
+def _parse_flow(text):
+    return project_loader.loads(text)
+
+
+def parse_option(value, mapping=False):
+    """kubernetes options are given as yaml/Groovy flow text or as data"""
+    if not isinstance(value, str):
+        return value
+    text = value.strip()
+    if not text:
+        return {} if mapping else []
+    # '{memory: 8Gi}' and the older brace-less 'memory: 8Gi' both work
+    if mapping and not text.startswith('{'):
+        text = '{' + text + '}'
+    return _parse_flow(text)
+
+
+def to_bool(value):
+    if isinstance(value, str):
+        return value.strip().lower() in ('true', 'y', '1')
+    return bool(value)
+
+
+def to_id(value):
+    text = str(value).strip()
+    return int(text) if text.isdigit() else text
+
+
+def parse_node_selector(value):
+    """'key=value,key2=value2' as the Jenkins kubernetes plugin takes it"""
+    if isinstance(value, dict):
+        return {str(k): str(v) for k, v in value.items()}
+    selector = {}
+    for item in str(value or '').split(','):
+        key, sep, val = item.strip().partition('=')
+        if key:
+            selector[key] = val if sep else ''
+    return selector
+
+
+def parse_annotations(value):
+    value = parse_option(value)
+    if isinstance(value, dict):
+        return {str(k): str(v) for k, v in value.items()}
+    return {str(an['key']): str(an.get('value', '')) for an in value or []}
+
+
+def pod_volumes(job_yaml):
+    """(volumes, volumeMounts) of all volume kinds, in the order of
+    Matrix.groovy runK8()"""
+    volumes = []
+    mounts = []
+
+    def add(source, mount_path, read_only=None):
+        name = "volume-{}".format(len(volumes))
+        volumes.append(dict({'name': name}, **source))
+        mount = {'mountPath': mount_path, 'name': name}
+        if read_only is not None:
+            mount['readOnly'] = to_bool(read_only)
+        mounts.append(mount)
+
+    for vol in job_yaml.get('volumes') or []:
+        add({'hostPath': {'path': vol.get('hostPath') or vol['mountPath']}}, vol['mountPath'], False)
+    for vol in job_yaml.get('nfs_volumes') or []:
+        read_only = to_bool(vol.get('readOnly', False))
+        add({'nfs': {'server': vol.get('serverAddress'), 'path': vol.get('serverPath'), 'readOnly': read_only}},
+            vol['mountPath'], read_only)
+    for vol in job_yaml.get('pvc_volumes') or []:
+        read_only = to_bool(vol.get('readOnly', False))
+        add({'persistentVolumeClaim': {'claimName': vol.get('claimName'), 'readOnly': read_only}},
+            vol['mountPath'], read_only)
+    for vol in job_yaml.get('secret_volumes') or []:
+        secret = {'secretName': vol.get('secretName')}
+        if vol.get('optional') is not None:
+            secret['optional'] = to_bool(vol['optional'])
+        if vol.get('defaultMode') is not None:
+            secret['defaultMode'] = vol['defaultMode']
+        add({'secret': secret}, vol['mountPath'])
+    for vol in job_yaml.get('empty_volumes') or []:
+        add({'emptyDir': {'medium': 'Memory'} if to_bool(vol.get('memory', False)) else {}}, vol['mountPath'])
+    return volumes, mounts
+
+
+def arch_node_selectors(job_yaml, resolver):
+    """nodeSelector per arch, Matrix.groovy getArchConf() with
+    kubernetes.arch_table entries merged over the built-in table"""
+    kubernetes = job_yaml.get('kubernetes') or {}
+    table = {arch: {'nodeSelector': 'kubernetes.io/arch=' + k8s_arch} for arch, k8s_arch in arch_to_k8s_arch.items()}
+    for arch, conf in (kubernetes.get('arch_table') or {}).items():
+        table[arch] = dict(table.get(arch, {}), **(conf or {}))
+    selectors = {}
+    for arch, conf in table.items():
+        selector = conf.get('nodeSelector')
+        if isinstance(selector, str):
+            selector = resolver.resolve(selector, {'arch': arch})
+        selectors[arch] = parse_node_selector(selector)
+    return selectors
+
+
+def compile_pod_template(job_yaml, resolver=None):
+    """Pod parts shared by all images of the project, parsed once"""
+    kubernetes = job_yaml.get('kubernetes') or {}
+    volumes, mounts = pod_volumes(job_yaml)
+    options = {}
+    for key, default in POD_OPTIONS.items():
+        value = kubernetes.get(key)
+        options[key] = default if value in (None, '') else value
+    return {
+        'podname': job_yaml['job'],
+        'options': options,
+        'serviceAccount': kubernetes.get('serviceAccount', 'default'),
+        'imagePullSecrets': parse_option(kubernetes.get('imagePullSecrets', '[]')) or [],
+        'nodeSelectors': arch_node_selectors(job_yaml, resolver or TemplateResolver(job_yaml)),
+        'volumes': volumes,
+        'volumeMounts': mounts,
+    }
+
+
+def build_pod(pod_tmpl, image, podname=None):
+    """Pod manifest of one image as a dict, image keys override the
+    kubernetes section like in Matrix.groovy"""
+    opts = {key: image.get(key) or default for key, default in pod_tmpl['options'].items()}
+    selector = dict(pod_tmpl['nodeSelectors'].get(image['arch']) or {})
+    if opts['nodeSelector']:
+        selector.update(parse_node_selector(opts['nodeSelector']))
+
+    metadata = {
+        'name': "{}-debug-reproducer".format(podname or pod_tmpl['podname']),
+        'namespace': opts['namespace'],
+    }
+    annotations = parse_annotations(opts['annotations'])
+    if annotations:
+        metadata['annotations'] = annotations
+
+    container = {
+        'name': re.sub(r'[.:/_]', '', image['name']),
+        'image': image['url'],
+        'imagePullPolicy': 'Always',
+        'command': ['cat'],
+        'tty': True,
+        'env': [{'name': 'K8S_NODE_NAME', 'valueFrom': {'fieldRef': {'fieldPath': 'spec.nodeName'}}}],
+        'resources': {
+            'limits': parse_option(opts['limits'], mapping=True),
+            'requests': parse_option(opts['requests'], mapping=True),
+        },
+        'securityContext': {
+            'privileged': to_bool(opts['privileged']),
+            'capabilities': {'add': parse_option(opts['caps_add']) or []},
+        },
+        'volumeMounts': pod_tmpl['volumeMounts'],
+    }
+
+    spec = {
+        'containers': [container],
+        'restartPolicy': 'Never',
+        'serviceAccountName': pod_tmpl['serviceAccount'],
+        'hostNetwork': to_bool(opts['hostNetwork']),
+        'securityContext': {
+            'runAsUser': to_id(opts['runAsUser']),
+            'runAsGroup': to_id(opts['runAsGroup']),
+        },
+        'nodeSelector': selector,
+        'tolerations': parse_option(opts['tolerations']) or [],
+        'volumes': pod_tmpl['volumes'],
+    }
+    if pod_tmpl['imagePullSecrets']:
+        spec['imagePullSecrets'] = [{'name': name} for name in pod_tmpl['imagePullSecrets']]
+    return {'apiVersion': 'v1', 'kind': 'Pod', 'metadata': metadata, 'spec': spec}
 
-    if config.get('env'):
-        t.template = t.safe_substitute({**config['env']})
-        vars = {**config, **image, **config['env'], **os.environ}
 
-    res = t.safe_substitute(vars)
-    return res
+# strings that may be written without quotes, if yaml reads them back as str
+PLAIN_RE = re.compile(r'[\w./][\w./@:=+-]*(?<!:)')
+
+
+def yaml_scalar(value):
+    if value is None:
+        return 'null'
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, float) and not math.isfinite(value):
+        return '.nan' if math.isnan(value) else ('.inf' if value > 0 else '-.inf')
+    if isinstance(value, (int, float)):
+        return repr(value)
+    return _yaml_str(str(value))
+
+
+# only strings are cached: True, 1 and 1.0 (or 0.0 and -0.0) are equal keys
+@lru_cache(maxsize=4096)
+def _yaml_str(text):
+    if PLAIN_RE.fullmatch(text) and _plain_is_str(text):
+        return text
+    # JSON strings are valid double quoted yaml scalars
+    return json.dumps(text)
+
+
+@lru_cache(maxsize=1)
+def _str_resolver():
+    import yaml
+    return yaml.resolver.Resolver()
+
+
+def _plain_is_str(text):
+    import yaml
+    return _str_resolver().resolve(yaml.ScalarNode, text, (True, False)) == 'tag:yaml.org,2002:str'
+
+
+def _inline(value):
+    if isinstance(value, dict):
+        return '{}'
+    if isinstance(value, list):
+        return '[]'
+    return yaml_scalar(value)
+
+
+def _emit(value, indent, lines, blocks=None):
+    if blocks:
+        block = blocks.get(id(value))
+        if block is not None and block[0] is value:
+            if indent not in block[1]:
+                block[1][indent] = []
+                _emit(value, indent, block[1][indent])
+            lines.extend(block[1][indent])
+            return
+    pad = ' ' * indent
+    if isinstance(value, dict):
+        for key, item in value.items():
+            if isinstance(item, (dict, list)) and item:
+                lines.append(pad + yaml_scalar(key) + ':')
+                # sequences are not indented under their key, as yaml.dump does
+                _emit(item, indent + 2 if isinstance(item, dict) else indent, lines, blocks)
+            else:
+                lines.append(pad + yaml_scalar(key) + ': ' + _inline(item))
+        return
+    for item in value:
+        if isinstance(item, dict) and item:
+            first = len(lines)
+            _emit(item, indent + 2, lines, blocks)
+            lines[first] = pad + '- ' + lines[first][indent + 2:]
+        elif isinstance(item, list) and item:
+            lines.append(pad + '-')
+            _emit(item, indent + 2, lines, blocks)
+        else:
+            lines.append(pad + '- ' + _inline(item))
+
+
+def dump_yaml(data, blocks=None):
+    """Block style yaml of dicts, lists and scalars, in one pass
+
+    yaml.dump spends most of its time in the pure Python representer, pods
+    only need the handful of types above. blocks maps id(value) to (value,
+    {indent: lines}) for values shared by several documents, which are
+    emitted once.
+    """
+    lines = []
+    _emit(data, 0, lines, blocks)
+    return '\n'.join(lines)
+
+
+def render_pod_yaml(pod_tmpl, image, podname=None):
+    # volumes are the same in every pod, their yaml is built once per process
+    blocks = pod_tmpl.setdefault('blocks', {})
+    for key in ('volumes', 'volumeMounts'):
+        if id(pod_tmpl[key]) not in blocks:
+            blocks[id(pod_tmpl[key])] = (pod_tmpl[key], {})
+    return dump_yaml(build_pod(pod_tmpl, image, podname), blocks)
 
 
 def generate_pod_yaml(args):
@@ -107,48 +445,97 @@ def generate_pod_yaml(args):
         print("Error: Image with name '{}' is not found".format(args.image_name))
         exit(1)
 
-    image['tag'] = image.get('tag', args.tag)
-    image['arch'] = image.get('arch', args.arch)
+    resolver = TemplateResolver(job_yaml)
+    image = prepare_image(job_yaml, image, args.arch or "x86_64", args.tag, resolver)
+    pod_tmpl = compile_pod_template(job_yaml, resolver)
+    check_unresolved(resolver, getattr(args, 'strict', False))
+    pod_yaml = render_pod_yaml(pod_tmpl, image)
 
-    uri = image.get('uri', image['arch'] + "/" + image['name'])
-    url = image.get('url', job_yaml['registry_host'] + job_yaml['registry_path'] + "/" + uri + ":" + image['tag'])
-
-    image['uri'] = resolve_template(uri, job_yaml, image)
-    image['url'] = resolve_template(url, job_yaml, image)
-
-    limits = '{' + job_yaml['kubernetes'].get('limits', '') + '}'
-    requests = '{' + job_yaml['kubernetes'].get('requests', '') + '}'
-    caps_add = job_yaml['kubernetes'].get('caps_add', '[]')
-    nodeSelector = job_yaml['kubernetes'].get('nodeSelector', nodeSelector_tmpl.format(os='linux', arch=arch_to_k8s_arch[image['arch']]))
-    uid = image.get('uid', '0')
-    gid = image.get('gid', '0')
-    volumes = ''
-    volumeMounts = ''
-    for vid, volume in enumerate(job_yaml['volumes']):
-        volumes += volumes_tmpl.format(
-            hostPath=volume['hostPath'],
-            volumeid=vid,
-        )
-        volumeMounts += mounts_tmpl.format(
-            mountPath=volume['mountPath'],
-            volumeid=vid
-        )
-
-    pod_yaml = template.format(
-        podname=job_yaml['job'],
-        imageurl=image['url'],
-        imagename=image['name'].replace('.', ''),
-        uid=uid,
-        gid=gid,
-        limits=limits,
-        requests=requests,
-        caps_add=caps_add,
-        nodeSelector=nodeSelector,
-        volumes=volumes,
-        volumeMounts=volumeMounts
-    )
-
-    pod_yaml = "".join([s for s in pod_yaml.strip().splitlines(True) if s.strip()])
+    if args.out is None:
+        print(pod_yaml)
+    else:
+        with open(args.out, "w") as fout:
+            print(pod_yaml, file=fout)
+
+
+def select_images(job_yaml, image_name=None, arch=None, tag="latest", resolver=None):
+    """(image, arch) pairs for every runs_on_dockers entry
+
+    Images without 'arch' are generated for each value of the matrix
+    'arch' axis (x86_64 if there is none), like Matrix.groovy does.
+    """
+    axes = (job_yaml.get('matrix') or {}).get('axes') or {}
+    arch_list = axes.get('arch') or ["x86_64"]
+    arch_table = (job_yaml.get('kubernetes') or {}).get('arch_table') or {}
+    name_re = re.compile(image_name) if image_name else None
+    resolver = resolver or TemplateResolver(job_yaml)
+
+    selected = []
+    for item in job_yaml.get('runs_on_dockers') or []:
+        if name_re and not name_re.fullmatch(item['name']):
+            continue
+        for one_arch in ([item['arch']] if item.get('arch') else arch_list):
+            if arch and one_arch != arch:
+                continue
+            if one_arch not in arch_to_k8s_arch and one_arch not in arch_table:
+                continue
+            selected.append(prepare_image(job_yaml, item, one_arch, tag, resolver))
+    return selected
+
+
+def pod_name(job, image):
+    name = "{}-{}-{}-{}".format(job, image['name'], image['arch'], image['tag'])
+    return re.sub(r'[^a-z0-9-]+', '-', name.lower()).strip('-')[:240]
+
+
+_worker = {}
+
+
+def _init_worker(job, pod_tmpl, out_dir):
+    _worker.update(job=job, pod_tmpl=pod_tmpl, out_dir=out_dir)
+
+
+def _render_one(image):
+    name = pod_name(_worker['job'], image)
+    pod_yaml = render_pod_yaml(_worker['pod_tmpl'], image, podname=name)
+    if _worker['out_dir'] is None:
+        return pod_yaml
+    path = os.path.join(_worker['out_dir'], name + ".yaml")
+    with open(path, "w") as fout:
+        print(pod_yaml, file=fout)
+    return path
+
+
+def generate_pod_batch(args):
+    job_yaml = read_job_project(args.file)
+    resolver = TemplateResolver(job_yaml)
+    images = select_images(job_yaml, args.image_name, args.arch, args.tag, resolver)
+    pod_tmpl = compile_pod_template(job_yaml, resolver)
+    check_unresolved(resolver, getattr(args, 'strict', False))
+
+    if not images:
+        print("Error: No images found matching name '{}' arch '{}'".format(args.image_name or '.*', args.arch or 'any'))
+        exit(1)
+
+    if args.out_dir:
+        os.makedirs(args.out_dir, exist_ok=True)
+
+    initargs = (job_yaml['job'], pod_tmpl, args.out_dir)
+    if args.jobs > 1 and len(images) > 1:
+        # imported here, single pod runs don't pay for multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=args.jobs, initializer=_init_worker, initargs=initargs) as executor:
+            results = list(executor.map(_render_one, images, chunksize=max(1, len(images) // (args.jobs * 4))))
+    else:
+        _init_worker(*initargs)
+        results = [_render_one(image) for image in images]
+
+    if args.out_dir:
+        for path in results:
+            print(path)
+        return
+
+    pod_yaml = "\n---\n".join(results)
     if args.out is None:
         print(pod_yaml)
     else:
@@ -158,4 +545,11 @@ def generate_pod_yaml(args):
 
 if __name__ == '__main__':
     args = usage()
-    generate_pod_yaml(args)
+    try:
+        if args.all:
+            generate_pod_batch(args)
+        else:
+            generate_pod_yaml(args)
+    except TemplateError as e:
+        print("Error: {}".format(e))
+        exit(1)
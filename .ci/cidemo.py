@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""Single entry point for the ci-demo Python tools
+
+    cidemo.py <command> [options]
+
+Every command is one of the stand-alone scripts, run as if it was called
+directly. Only the script of the invoked command is imported, so yaml,
+yamale or requests are loaded by the commands that need them and not on
+every invocation. The tools and the default schema can be packed into one
+executable zipapp:
+
+    python3 .ci/cidemo.py zipapp -out cidemo.pyz
+    ./cidemo.pyz nexus yum -u ... -a show -n my-repo
+"""
+import os
+import sys
+import runpy
+
+# command: (module, path relative to the repository root, description)
+COMMANDS = {
+    'nexus': ('nexus', 'resources/actions/nexus.py', 'Manage Nexus 3 repositories'),
+    'pod': ('cidemo-k8', '.ci/cidemo-k8.py', 'Generate k8s pod yaml for runs_on_dockers images'),
+    'validate': ('ci_demo_yaml_validator', 'schema_validator/ci_demo_yaml_validator.py', 'Validate project files'),
+    'plan': ('matrix_planner', '.ci/matrix_planner.py', 'Expand the matrix into the task list'),
+    'impact': ('impact_planner', '.ci/impact_planner.py', 'List cells affected by changes since a revision'),
+    'run': ('local_runner', '.ci/local_runner.py', 'Run matrix steps locally'),
+    'schedule': ('batch_scheduler', '.ci/batch_scheduler.py', 'Order tasks by duration history'),
+    'size': ('resource_sizer', '.ci/resource_sizer.py', 'Suggest kubernetes limits/requests from usage samples'),
+    'image-hash': ('image_hash', '.ci/image_hash.py', 'Content hash runs_on_dockers images'),
+    'timing': ('timing_analyzer', '.ci/timing_analyzer.py', 'Analyze job console log timing'),
+    'snapshot': ('ws_snapshot', '.ci/ws_snapshot.py', 'Content-addressed workspace snapshots'),
+}
+
+# files packed into the zipapp besides the commands
+LIBRARIES = ['.ci/project_loader.py']
+DATA_FILES = ['schema_validator/ci_demo_schema.yaml']
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def usage(out=sys.stdout):
+    print('usage: {} <command> [options]\n'.format(os.path.basename(sys.argv[0])), file=out)
+    print('commands:', file=out)
+    for name, (module, path, text) in COMMANDS.items():
+        print('  {:12} {}'.format(name, text), file=out)
+    print('  {:12} {}'.format('zipapp', 'Pack all commands into one executable file (-out FILE)'), file=out)
+    print('\nRun `<command> -h` for the options of a command.', file=out)
+
+
+def build_zipapp(argv):
+    import shutil
+    import zipapp
+    import argparse
+    import tempfile
+
+    parser = argparse.ArgumentParser(prog='cidemo.py zipapp', description='Pack all commands into one zipapp')
+    parser.add_argument('-out', '--out', metavar='filename', default='cidemo.pyz', help='Output file, default: %(default)s')
+    parser.add_argument('-python', '--python', default='/usr/bin/env python3', help='Interpreter line, default: %(default)s')
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as staging:
+        shutil.copyfile(os.path.abspath(__file__), os.path.join(staging, '__main__.py'))
+        sources = [path for module, path, text in COMMANDS.values()]
+        for path in sources + LIBRARIES + DATA_FILES:
+            shutil.copyfile(os.path.join(REPO_ROOT, path), os.path.join(staging, os.path.basename(path)))
+        # stored, not deflated: zipimport reads stored members faster
+        zipapp.create_archive(staging, args.out, interpreter=args.python)
+    print('Created {}'.format(args.out))
+
+
+def main(argv):
+    if not argv or argv[0] in ('-h', '--help'):
+        usage()
+        return
+    command = argv[0]
+    if command == 'zipapp':
+        build_zipapp(argv[1:])
+        return
+    if command not in COMMANDS:
+        print('Error: unknown command {}\n'.format(command), file=sys.stderr)
+        usage(sys.stderr)
+        exit(2)
+
+    module, path, text = COMMANDS[command]
+    if os.path.isfile(os.path.join(REPO_ROOT, path)):
+        # running from a checkout, commands live in different directories
+        for directory in sorted({os.path.dirname(one[1]) for one in COMMANDS.values()}):
+            directory = os.path.join(REPO_ROOT, directory)
+            if directory not in sys.path:
+                sys.path.insert(1, directory)
+    sys.argv = [sys.argv[0]] + argv[1:]
+    # alter_sys makes the command the __main__ module while it runs, which
+    # process pools need to pickle its functions
+    runpy.run_module(module, run_name='__main__', alter_sys=True)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
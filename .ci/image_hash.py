@@ -0,0 +1,359 @@
+#!/usr/bin/env python3
+"""Content hashes of runs_on_dockers images, to skip rebuilding unchanged ones
+
+Matrix.groovy buildImage() rebuilds an image when its Dockerfile changed
+in the last commit, when build_dockers is set, or when its url is missing
+in the registry, so a static 'tag: latest' never tells whether the image
+is current. This tool hashes what the image is built from:
+
+  - the Dockerfile
+  - files and directories its COPY/ADD instructions take from the build
+    context (the workspace root, as in buildImage()), minus .dockerignore
+  - files listed in 'deps'
+  - the resolved build_args and the arch
+
+and maps every image to a tag derived from that hash. An image needs to be
+built only if the content tagged url is neither in the local manifest
+cache (-cache) nor, with -inspect, in the registry. Base images named by
+FROM are not resolved, a moved base tag does not change the hash.
+"""
+import os
+import re
+import sys
+import json
+import shlex
+import fnmatch
+import hashlib
+import argparse
+import subprocess
+
+import matrix_planner
+from matrix_planner import MatrixError, groovy_str
+
+HASH_VERSION = 'ci-demo-image-hash 1'
+TAG_LENGTH = 12
+
+
+def usage():
+    parser = argparse.ArgumentParser(description='Content hash runs_on_dockers images and list the ones to build')
+    parser.add_argument('-file', '--file', metavar='filename', type=str, help='Path to job_matrix.yaml file', required=True)
+    parser.add_argument('-context', '--context', metavar='DIR', default='.', help='Build context, default: current directory')
+    parser.add_argument('-cache', '--cache', metavar='filename', help='Manifest cache of built images (JSON)')
+    parser.add_argument('-inspect', '--inspect', action='store_true',
+                        help='Look up content tagged urls in the registry with docker manifest inspect')
+    parser.add_argument('-record', '--record', action='store_true',
+                        help='Add all hashed images to the cache, run after the images were built and pushed')
+    parser.add_argument('-build-list', '--build-list', action='store_true', help='Print only urls of images to build')
+    parser.add_argument('-json', '--json', action='store_true', help='Print result as JSON')
+    parser.add_argument('-e', '--env', metavar='KEY=VALUE', action='append', default=[],
+                        help='Set job parameter/environment variable used by templates, can be repeated')
+
+    args = parser.parse_args()
+
+    if not os.path.isfile(args.file):
+        print('The file {} does not exist'.format(args.file))
+        exit(1)
+    return args
+
+
+def dockerfile_instructions(text):
+    """(instruction, arguments) with line continuations joined and comments dropped"""
+    line = ''
+    for raw in text.splitlines():
+        stripped = raw.strip()
+        if not line and (not stripped or stripped.startswith('#')):
+            continue
+        if line and stripped.startswith('#'):
+            continue
+        if stripped.endswith('\\'):
+            line += stripped[:-1] + ' '
+            continue
+        line += stripped
+        parts = line.split(None, 1)
+        if parts:
+            yield parts[0].upper(), parts[1] if len(parts) > 1 else ''
+        line = ''
+    if line.strip():
+        parts = line.split(None, 1)
+        yield parts[0].upper(), parts[1] if len(parts) > 1 else ''
+
+
+def parse_build_args(build_args):
+    values = {}
+    tokens = shlex.split(build_args or '')
+    for idx, token in enumerate(tokens):
+        value = None
+        if token == '--build-arg' and idx + 1 < len(tokens):
+            value = tokens[idx + 1]
+        elif token.startswith('--build-arg='):
+            value = token[len('--build-arg='):]
+        if value and '=' in value:
+            key, _, val = value.partition('=')
+            values[key] = val
+    return values
+
+
+def substitute(text, variables):
+    def repl(m):
+        return variables.get(m.group(1) or m.group(2), m.group(0))
+    return re.sub(r'\$\{(\w+)\}|\$(\w+)', repl, text)
+
+
+def copy_sources(text, build_args):
+    """Build context paths used by COPY/ADD, URLs are returned as they are"""
+    variables = {}
+    sources = []
+    for instruction, rest in dockerfile_instructions(text):
+        if instruction in ('ARG', 'ENV'):
+            for item in shlex.split(rest):
+                key, sep, value = item.partition('=')
+                if instruction == 'ARG':
+                    variables[key] = build_args.get(key, value if sep else variables.get(key, ''))
+                elif sep:
+                    variables[key] = value
+            continue
+        if instruction not in ('COPY', 'ADD'):
+            continue
+        rest = rest.strip()
+        if rest.startswith('['):
+            try:
+                args = json.loads(rest)
+            except ValueError:
+                args = shlex.split(rest)
+        else:
+            args = shlex.split(rest)
+        flags = [arg for arg in args if arg.startswith('--')]
+        if any(flag.startswith('--from') for flag in flags):
+            continue
+        paths = [arg for arg in args if not arg.startswith('--')]
+        if rest.lstrip().startswith('<<') or len(paths) < 2:
+            continue
+        sources.extend(substitute(path, variables) for path in paths[:-1])
+    return sources
+
+
+def parse_dockerignore(text):
+    patterns = []
+    for line in text.splitlines():
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        negate = line.startswith('!')
+        pattern = os.path.normpath(line.lstrip('!').lstrip('/'))
+        patterns.append((negate, pattern))
+    return patterns
+
+
+def read_dockerignore(context):
+    path = os.path.join(context, '.dockerignore')
+    if not os.path.isfile(path):
+        return []
+    with open(path) as fin:
+        return parse_dockerignore(fin.read())
+
+
+def ignored(rel, patterns):
+    res = False
+    for negate, pattern in patterns:
+        if fnmatch.fnmatch(rel, pattern) or rel.startswith(pattern + '/') or \
+                (pattern.startswith('**/') and fnmatch.fnmatch(os.path.basename(rel), pattern[3:])):
+            res = not negate
+    return res
+
+
+def walk_context(context):
+    files = []
+    for root, dirs, names in os.walk(context):
+        rel_root = os.path.relpath(root, context)
+        dirs.sort()
+        files.extend(os.path.normpath(os.path.join(rel_root, name)) for name in sorted(names))
+    return files
+
+
+def context_files(files, source, ignore):
+    """Files of the context a COPY/ADD source refers to, relative paths"""
+    pattern = os.path.normpath(source.lstrip('/'))
+    matches = []
+    for rel in files:
+        if pattern == '.' or fnmatch.fnmatch(rel, pattern) or rel.startswith(pattern + '/') or \
+                any(fnmatch.fnmatch(parent, pattern) for parent in parents(rel)):
+            if not ignored(rel, ignore):
+                matches.append(rel)
+    return matches
+
+
+def parents(rel):
+    parts = rel.split('/')
+    return ['/'.join(parts[:idx]) for idx in range(1, len(parts))]
+
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as fin:
+        for chunk in iter(lambda: fin.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ContextIndex:
+    """Context file list and file hashes, computed once for all images"""
+
+    def __init__(self, context):
+        self.context = context
+        self.ignore = read_dockerignore(context)
+        self.hashes = {}
+        self.walks = {}
+        self.all_files = None
+
+    def files(self, source):
+        if source not in self.walks:
+            if self.all_files is None:
+                self.all_files = walk_context(self.context)
+            self.walks[source] = context_files(self.all_files, source, self.ignore)
+        return self.walks[source]
+
+    def digest(self, rel):
+        if rel not in self.hashes:
+            path = os.path.join(self.context, rel)
+            mode = 'x' if os.access(path, os.X_OK) else '-'
+            self.hashes[rel] = mode + file_digest(path)
+        return self.hashes[rel]
+
+
+def image_hash(image, index):
+    """(hash, inputs) of one runs_on_dockers image"""
+    filename = groovy_str(image.get('filename') or image.get('file')).strip()
+    path = os.path.join(index.context, filename)
+    if not os.path.isfile(path):
+        raise MatrixError("Dockerfile {} of image {} not found in {}".format(filename, image.get('name'), index.context))
+    with open(path) as fin:
+        text = fin.read()
+
+    build_args = groovy_str(image.get('build_args') or '')
+    inputs = {filename: index.digest(filename)}
+    for source in copy_sources(text, parse_build_args(build_args)):
+        if re.match(r'^(https?|git)://|^git@', source):
+            inputs[source] = 'url'
+            continue
+        files = index.files(source)
+        if not files:
+            raise MatrixError("COPY/ADD source '{}' of {} matches no file in {}".format(source, filename, index.context))
+        for rel in files:
+            inputs[rel] = index.digest(rel)
+    for dep in image.get('deps') or []:
+        dep = groovy_str(dep)
+        if os.path.isfile(os.path.join(index.context, dep)):
+            inputs[dep] = index.digest(dep)
+        else:
+            inputs[dep] = 'missing'
+
+    digest = hashlib.sha256()
+    digest.update(HASH_VERSION.encode())
+    digest.update(b'\0arch\0' + groovy_str(image.get('arch')).encode())
+    digest.update(b'\0build_args\0' + ' '.join(build_args.split()).encode())
+    for rel in sorted(inputs):
+        digest.update(b'\0' + rel.encode() + b'\0' + inputs[rel].encode())
+    return digest.hexdigest(), inputs
+
+
+def load_cache(path):
+    if not path or not os.path.isfile(path):
+        return {}
+    with open(path) as fin:
+        return json.load(fin).get('images', {})
+
+
+def save_cache(path, images):
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as fout:
+        json.dump({'images': images}, fout, indent=2, sort_keys=True)
+    os.replace(tmp, path)
+
+
+def registry_has(url):
+    return subprocess.call(['docker', 'manifest', 'inspect', url],
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL) == 0
+
+
+def untagged(image):
+    url = groovy_str(image.get('url'))
+    suffix = ':' + groovy_str(image.get('tag'))
+    return url[:-len(suffix)] if url.endswith(suffix) else url
+
+
+def plan_images(config, environ, context, cache, inspect=False):
+    index = ContextIndex(context)
+    results = []
+    for images in matrix_planner.gen_image_map(config, environ).values():
+        for image in images:
+            res = {'name': image.get('name'), 'arch': image.get('arch'), 'url': image.get('url')}
+            if not image.get('filename'):
+                res['status'] = 'no-file'
+                results.append(res)
+                continue
+            try:
+                digest, inputs = image_hash(image, index)
+            except (MatrixError, OSError) as e:
+                # content that cannot be verified is built under its plain
+                # url, one broken image must not hide the plan of the others
+                res['status'] = 'build'
+                res['error'] = str(e)
+                results.append(res)
+                continue
+            res['hash'] = digest
+            res['inputs'] = len(inputs)
+            res['content_url'] = '{}:{}'.format(untagged(image), digest[:TAG_LENGTH])
+            if res['content_url'] in cache:
+                res['status'] = 'cached'
+            elif inspect and registry_has(res['content_url']):
+                res['status'] = 'in-registry'
+            else:
+                res['status'] = 'build'
+            results.append(res)
+    return results
+
+
+def main(args):
+    environ = dict(os.environ)
+    for item in args.env:
+        key, _, value = item.partition('=')
+        environ[key] = value
+
+    try:
+        config = matrix_planner.read_job_project(args.file)
+        if not config.get('env'):
+            config['env'] = {}
+        cache = load_cache(args.cache)
+        results = plan_images(config, environ, args.context, cache, args.inspect)
+    except (MatrixError, OSError, ValueError) as e:
+        print('Error: {}'.format(e))
+        exit(1)
+
+    if args.record:
+        if not args.cache:
+            print('Error: -record needs -cache')
+            exit(1)
+        for res in results:
+            if res.get('hash'):
+                cache[res['content_url']] = {'hash': res['hash'], 'name': res['name'], 'arch': res['arch']}
+        save_cache(args.cache, cache)
+
+    if args.build_list:
+        for res in results:
+            if res['status'] == 'build':
+                print(res.get('content_url', res['url']))
+    elif args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        for res in results:
+            print('{:12} {}/{} {}'.format(res['status'], res['arch'], res['name'], res.get('content_url', res['url'])))
+        todo = sum(1 for res in results if res['status'] == 'build')
+        print('{} of {} images need building'.format(todo, len(results)), file=sys.stderr)
+    for res in results:
+        if res.get('error'):
+            print('Warning: {}, building {}'.format(res['error'], res['url']), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    args = usage()
+    main(args)
@@ -0,0 +1,337 @@
+#!/usr/bin/env python3
+"""Matrix cells and steps affected by the changes between two revisions
+
+Compares a ci-demo project file at a base revision with the same file at
+a head revision (default: the working tree) and maps every (cell, step)
+of the head matrix to the inputs it depends on:
+
+  - the step definition and the files its run/onfail/always/args refer
+    to, followed through the scripts they call, plus its 'resource'
+  - the image of the cell: its runs_on_dockers/runs_on_agents entry, the
+    Dockerfile named by 'file', its 'deps' and COPY/ADD sources
+  - the cell itself, cells that did not exist at the base revision run
+    all their steps
+
+Changes to other top level keys of the project file, or to files matching
+-full-run patterns, affect every cell. The affected cells are printed or
+written as a matrix.include filter (-out), which Matrix.groovy applies
+like a hand-written one. include selects cells, not steps, so a selected
+cell still runs all of its steps.
+"""
+import os
+import re
+import sys
+import json
+import fnmatch
+import argparse
+import subprocess
+
+import yaml
+
+import matrix_planner
+import project_loader
+from matrix_planner import MatrixError, groovy_str
+from image_hash import copy_sources, parse_build_args, parse_dockerignore, context_files
+
+# keys whose changes are attributed to single cells/steps, any other
+# project file change affects the whole matrix
+SCOPED_KEYS = ('steps', 'runs_on_dockers', 'runs_on_agents', 'matrix')
+
+STEP_TEXT_KEYS = ('run', 'onfail', 'always', 'args')
+
+# references are followed through these, other files are only inputs
+SCRIPT_EXTENSIONS = ('.sh', '.bash', '.py', '.pl', '.mk')
+
+# include filter of -out when no cell is affected, no axis has this key
+NO_CELL = {'impact_planner': 'no cell affected'}
+
+# candidate file references in scripts
+PATH_TOKEN = re.compile(r'[\w.@+-]*(?:/[\w.@+-]+)+|[\w@+-][\w.@+-]*\.\w+')
+
+
+def usage():
+    parser = argparse.ArgumentParser(description='List matrix cells and steps affected by changes since a base revision')
+    parser.add_argument('-file', '--file', metavar='filename', type=str, help='Path to job_matrix.yaml file', required=True)
+    parser.add_argument('-base', '--base', metavar='REV', required=True, help='Base revision, e.g. origin/master')
+    parser.add_argument('-head', '--head', metavar='REV', help='Head revision, default: working tree')
+    parser.add_argument('-full-run', '--full-run', metavar='PATTERN', action='append', default=[],
+                        help='Changed files matching this glob pattern affect every cell, can be repeated')
+    parser.add_argument('-out', '--out', metavar='filename',
+                        help='Write the head project file with matrix.include set to the affected cells')
+    parser.add_argument('-json', '--json', action='store_true', help='Print result as JSON')
+    parser.add_argument('-e', '--env', metavar='KEY=VALUE', action='append', default=[],
+                        help='Set job parameter/environment variable used by templates, can be repeated')
+
+    args = parser.parse_args()
+
+    if not os.path.isfile(args.file):
+        print('The file {} does not exist'.format(args.file))
+        exit(1)
+    return args
+
+
+def git(*args, **kwargs):
+    res = subprocess.run(('git',) + args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, **kwargs)
+    if res.returncode:
+        raise MatrixError('git {} failed: {}'.format(' '.join(args), res.stderr.decode(errors='replace').strip()))
+    return res.stdout
+
+
+class Tree:
+    """Files of the repository at a revision, or of the working tree"""
+
+    def __init__(self, top, rev=None):
+        self.top = top
+        self.rev = rev
+        self.texts = {}
+        if rev is None:
+            out = git('ls-files', '-z', '--cached', '--others', '--exclude-standard', cwd=top)
+        else:
+            out = git('ls-tree', '-r', '-z', '--name-only', rev, cwd=top)
+        self.files = set(name for name in out.decode().split('\0') if name)
+
+    def read(self, path):
+        """Text of a file, None if it does not exist or is binary"""
+        if path not in self.texts:
+            data = None
+            if path in self.files:
+                if self.rev is None:
+                    try:
+                        with open(os.path.join(self.top, path), 'rb') as fin:
+                            data = fin.read()
+                    except OSError:
+                        data = None
+                else:
+                    data = git('show', '{}:{}'.format(self.rev, path), cwd=self.top)
+            if data is not None and b'\0' in data[:8192]:
+                data = None
+            self.texts[path] = None if data is None else data.decode(errors='replace')
+        return self.texts[path]
+
+
+def changed_files(top, base, head=None):
+    args = ['diff', '--name-only', '-z', base] + ([head] if head else [])
+    names = set(name for name in git(*args, cwd=top).decode().split('\0') if name)
+    if head is None:
+        names.update(name for name in git('ls-files', '-z', '--others', '--exclude-standard', cwd=top).decode().split('\0')
+                     if name)
+    return names
+
+
+def file_refs(text, tree, cwd=''):
+    """Repository files a script or step text refers to"""
+    refs = set()
+    for token in PATH_TOKEN.findall(text):
+        parts = token.strip('/').split('/')
+        # '${WORKSPACE}/.ci/x.sh' and 'foo/.ci/x.sh' end with a repo path
+        for idx in range(len(parts)):
+            rel = '/'.join(parts[idx:])
+            for path in (rel, os.path.normpath(os.path.join(cwd, rel))):
+                if path in tree.files:
+                    refs.add(path)
+    return refs
+
+
+def is_script(path, text):
+    return path.endswith(SCRIPT_EXTENSIONS) or os.path.basename(path) == 'Makefile' or text.startswith('#!')
+
+
+def script_closure(text, tree, cache):
+    """Files referenced by text, followed through the referenced scripts"""
+    todo = list(file_refs(text, tree))
+    seen = set()
+    while todo:
+        path = todo.pop()
+        if path in seen:
+            continue
+        seen.add(path)
+        if path not in cache:
+            body = tree.read(path)
+            cache[path] = set()
+            if body and is_script(path, body):
+                cache[path] = file_refs(body, tree, os.path.dirname(path))
+        todo.extend(cache[path] - seen)
+    return seen
+
+
+def step_inputs(step, tree, cache):
+    text = '\n'.join(groovy_str(step[key]) if not isinstance(step[key], (dict, list)) else json.dumps(step[key])
+                     for key in STEP_TEXT_KEYS if step.get(key) is not None)
+    files = script_closure(text, tree, cache)
+    if step.get('resource'):
+        files.add('resources/' + groovy_str(step['resource']))
+    return files
+
+
+def image_inputs(image, tree):
+    """Files a runs_on_dockers image is built from, relative to the repo root"""
+    filename = groovy_str(image.get('filename') or image.get('file') or '').strip()
+    if not filename:
+        return set()
+    files = {os.path.normpath(filename)}
+    files.update(os.path.normpath(groovy_str(dep)) for dep in image.get('deps') or [])
+    text = tree.read(os.path.normpath(filename))
+    if text:
+        ignore = parse_dockerignore(tree.read('.dockerignore') or '')
+        all_files = sorted(tree.files)
+        for source in copy_sources(text, parse_build_args(groovy_str(image.get('build_args') or ''))):
+            if not re.match(r'^(https?|git)://|^git@', source):
+                files.update(context_files(all_files, source, ignore))
+    return files
+
+
+def image_key(image):
+    return (groovy_str(image.get('name')), groovy_str(image.get('arch')))
+
+
+def cell_key(cell, axis_keys):
+    return image_key(cell['axis']) + tuple(groovy_str(cell['axis'].get(key)) for key in axis_keys)
+
+
+def include_entry(cell, axis_keys):
+    """include filter matching exactly one cell, values are regexes"""
+    entry = {}
+    for key in ['name', 'arch'] + [key for key in axis_keys if key not in ('name', 'arch')]:
+        value = cell['axis'].get(key)
+        if value is not None:
+            entry[key] = re.escape(groovy_str(value))
+    return entry
+
+
+def plan_impact(base_config, head_config, changed, head_tree, environ, full_run=()):
+    """{'full': reasons or [], 'cells': [{name, steps, include}], 'total': n}"""
+    reasons = []
+    if base_config is None:
+        reasons.append('project file is new')
+    else:
+        for key in sorted(set(base_config) | set(head_config)):
+            if key not in SCOPED_KEYS and base_config.get(key) != head_config.get(key):
+                reasons.append("top level key '{}' changed".format(key))
+    for path in sorted(changed):
+        if any(fnmatch.fnmatch(path, pattern) for pattern in full_run):
+            reasons.append('{} matches -full-run'.format(path))
+
+    planner = matrix_planner.MatrixPlanner(head_config, environ)
+    axis_keys = [key for key, values in planner.axes]
+    base_cells = set()
+    base_steps = {}
+    base_images = {}
+    if base_config is not None:
+        base_planner = matrix_planner.MatrixPlanner(base_config, environ)
+        base_cells = set(cell_key(cell, axis_keys) for cell in base_planner.iter_step_table())
+        base_steps = {groovy_str(step.get('name')): step for step in base_planner.steps}
+        base_images = {image_key(image): image for image in base_planner.images()}
+
+    cache = {}
+    step_changed = []
+    for step in planner.steps:
+        name = groovy_str(step.get('name'))
+        why = None
+        if base_steps.get(name) != step:
+            why = 'step changed' if name in base_steps else 'step is new'
+        else:
+            hit = sorted(step_inputs(step, head_tree, cache) & changed)
+            if hit:
+                why = 'changed ' + ', '.join(hit)
+        step_changed.append(why)
+
+    image_changed = {}
+    for image in planner.images():
+        key = image_key(image)
+        why = None
+        if key not in base_images:
+            why = 'image is new'
+        elif base_images[key] != image:
+            why = 'image changed'
+        else:
+            hit = sorted(image_inputs(image, head_tree) & changed)
+            if hit:
+                why = 'changed ' + ', '.join(hit)
+        image_changed[key] = why
+
+    cells = []
+    total = 0
+    for cell in planner.iter_step_table():
+        if not any(cell['run']):
+            continue
+        total += 1
+        whole = 'full run' if reasons else image_changed.get(image_key(cell['axis']))
+        if not whole and cell_key(cell, axis_keys) not in base_cells:
+            whole = 'cell is new'
+        steps = []
+        for step, run, why in zip(planner.steps, cell['run'], step_changed):
+            if run and (whole or why):
+                steps.append({'name': groovy_str(step.get('name')), 'reason': why or whole})
+        if steps:
+            cells.append({'name': cell['name'], 'steps': steps, 'include': include_entry(cell, axis_keys)})
+    return {'full': reasons, 'cells': cells, 'total': total}
+
+
+def filtered_project(config, result):
+    """Project file config restricted to the affected cells"""
+    config = dict(config)
+    if result['full']:
+        return config
+    matrix = dict(config.get('matrix') or {})
+    if not matrix:
+        # Matrix.groovy applies include only to matrix axes, an arch axis
+        # gives the same one cell per image
+        arches = []
+        for image in config.get('runs_on_dockers') or []:
+            if image.get('arch') and image['arch'] not in arches:
+                arches.append(image['arch'])
+        if config.get('runs_on_agents') and 'x86_64' not in arches:
+            arches.append('x86_64')
+        matrix['axes'] = {'arch': arches}
+    matrix.pop('exclude', None)
+    # an empty include selects every cell
+    matrix['include'] = [cell['include'] for cell in result['cells']] or [NO_CELL]
+    config['matrix'] = matrix
+    return config
+
+
+def main(args):
+    environ = dict(os.environ)
+    for item in args.env:
+        key, _, value = item.partition('=')
+        environ[key] = value
+
+    try:
+        top = git('rev-parse', '--show-toplevel', cwd=os.path.dirname(os.path.abspath(args.file))).decode().strip()
+        path = os.path.relpath(os.path.abspath(args.file), top).replace(os.sep, '/')
+        base_tree = Tree(top, args.base)
+        head_tree = Tree(top, args.head)
+        changed = changed_files(top, args.base, args.head)
+        if head_tree.read(path) is None:
+            raise MatrixError('{} does not exist at {}'.format(path, args.head or 'working tree'))
+        head_config = project_loader.loads(head_tree.read(path))
+        base_config = None
+        if base_tree.read(path) is not None:
+            base_config = project_loader.loads(base_tree.read(path))
+        result = plan_impact(base_config, head_config, changed, head_tree, environ, args.full_run)
+    except (MatrixError, yaml.YAMLError) as e:
+        print('Error: {}'.format(e))
+        exit(1)
+
+    if args.out:
+        with open(args.out, 'w') as fout:
+            yaml.safe_dump(filtered_project(head_config, result), fout, default_flow_style=False, sort_keys=False)
+
+    if args.json:
+        print(json.dumps(dict(result, changed=sorted(changed)), indent=2))
+    else:
+        for reason in result['full']:
+            print('Full run: {}'.format(reason))
+        for cell in result['cells']:
+            print(cell['name'])
+            for step in cell['steps']:
+                print('  {}: {}'.format(step['name'], step['reason']))
+    print('{} of {} cells affected, {} changed files'.format(len(result['cells']), result['total'], len(changed)),
+          file=sys.stderr)
+    if args.out and not result['full'] and not result['cells']:
+        print('No cell affected, {} selects no cell'.format(args.out), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    args = usage()
+    main(args)
@@ -0,0 +1,379 @@
+#!/usr/bin/env python3
+"""Run a ci-demo project file locally, without Jenkins
+
+Expands the matrix with matrix_planner.py and runs the 'run' script of
+every step of every matrix cell the way Matrix.groovy run_step_shell()
+does: environment from the cell axis, 'env' and step 'env' resolved with
+resolveTemplate(), the default or configured shell, step 'timeout' in
+minutes, 'onfail' and 'always' commands. The whole run is limited by
+'timeout_minutes' and 'failFast' stops scheduling new cells on failure.
+
+Cells run in a bounded thread pool, either as plain subprocesses or with
+-docker in one container per cell started from the image url. Output is
+streamed line by line, prefixed with the task and step name.
+
+Steps using 'shell: action' or 'resource' need Jenkins and are skipped.
+Parallel steps run one after another.
+"""
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import signal
+import argparse
+import tempfile
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+import matrix_planner
+from matrix_planner import MatrixError, groovy_str, resolve_template, get_config_val
+
+PASS = 'PASS'
+FAIL = 'FAIL'
+TIMEOUT = 'TIMEOUT'
+SKIP = 'SKIP'
+
+output_lock = threading.Lock()
+
+
+def usage():
+    parser = argparse.ArgumentParser(description='Run ci-demo project file steps locally')
+    parser.add_argument('-file', '--file', metavar='filename', type=str, help='Path to job_matrix.yaml file', required=True)
+    parser.add_argument('-jobs', '--jobs', metavar='N', type=int, default=1, help='Matrix cells run in parallel, default: 1')
+    parser.add_argument('-task', '--task', metavar='REGEX', help='Run only tasks with matching name')
+    parser.add_argument('-step', '--step', metavar='REGEX', help='Run only steps with matching name')
+    parser.add_argument('-docker', '--docker', action='store_true', help='Run steps in a container of the cell image')
+    parser.add_argument('-workdir', '--workdir', metavar='DIR', default='.', help='Workspace, default: current directory')
+    parser.add_argument('-isolate', '--isolate', action='store_true', help='Run every cell in its own copy of workdir')
+    parser.add_argument('-fail-fast', '--fail-fast', action='store_true', help='Stop on first failed cell, default: failFast of the project file')
+    parser.add_argument('-quiet', '--quiet', action='store_true', help='Do not stream step output')
+    parser.add_argument('-dry-run', '--dry-run', action='store_true', help='Print what would run')
+    parser.add_argument('-report', '--report', metavar='filename', help='Write JSON summary')
+    parser.add_argument('-e', '--env', metavar='KEY=VALUE', action='append', default=[],
+                        help='Set job parameter/environment variable, can be repeated')
+
+    args = parser.parse_args()
+
+    if not os.path.isfile(args.file):
+        print('The file {} does not exist'.format(args.file))
+        exit(1)
+    return args
+
+
+def default_shell(config, step):
+    """Matrix.groovy getDefaultShell()"""
+    shell = step.get('shell') or config.get('shell')
+    if not shell:
+        shell = '/bin/bash -elE' if os.access('/bin/bash', os.X_OK) else '/bin/sh -el'
+    if shell == 'action':
+        return shell
+    if shell.startswith('/'):
+        return '#!' + shell
+    if not shell.startswith('#!'):
+        return '#!/bin/' + shell
+    return shell
+
+
+def to_env_vars(config, variables, environ):
+    """Matrix.groovy toEnvVars()"""
+    return {key: resolve_template(variables, groovy_str(value), config, environ)
+            for key, value in (variables or {}).items()}
+
+
+def cell_env(config, axis):
+    """Variables of Matrix.groovy withEnv(axisEnv)"""
+    env = {key: groovy_str(value) for key, value in axis.items()}
+    env.update({key: groovy_str(value) for key, value in (config.get('env') or {}).items()})
+    return env
+
+
+def step_env(config, step, environ):
+    """Variables of Matrix.groovy run_step_shell() withEnv(vars)"""
+    env = to_env_vars(config, config.get('env'), environ)
+    env.update(to_env_vars(config, step.get('env'), environ))
+    for name in ('registry_host', 'registry_path', 'job'):
+        env[name] = groovy_str(config.get(name))
+    return env
+
+
+def emit(prefix, line):
+    with output_lock:
+        sys.stdout.write('[{}] {}'.format(prefix, line))
+        if not line.endswith('\n'):
+            sys.stdout.write('\n')
+        sys.stdout.flush()
+
+
+class CellError(Exception):
+    pass
+
+
+class Cell:
+    """One matrix cell: its steps run one after another in one workspace"""
+
+    def __init__(self, runner, task, steps, index):
+        self.runner = runner
+        self.task = task
+        self.steps = steps
+        self.name = task['name']
+        self.index = index
+        self.container = None
+        self.workdir = None
+        self.result = {'name': self.name, 'status': PASS, 'duration': 0.0, 'steps': []}
+
+    def run(self):
+        runner = self.runner
+        start = time.monotonic()
+        if runner.stopped():
+            self.result['status'] = SKIP
+            return self.result
+        try:
+            self.workdir = runner.workspace(self.index)
+            if runner.args.docker:
+                if not self.task['image'].get('url'):
+                    raise CellError('image {} has no url, cannot run with -docker'.format(self.task['image'].get('name')))
+                self.start_container()
+            for step in self.steps:
+                res = self.run_step(step)
+                self.result['steps'].append(res)
+                if res['status'] in (FAIL, TIMEOUT):
+                    self.result['status'] = res['status']
+                    break
+        except (CellError, OSError, subprocess.CalledProcessError) as e:
+            self.result['status'] = FAIL
+            self.result['error'] = str(e)
+            emit(self.name, 'Error: {}'.format(e))
+        finally:
+            self.stop_container()
+            runner.release(self.index, self.workdir)
+        self.result['duration'] = round(time.monotonic() - start, 3)
+        if self.result['status'] != PASS:
+            runner.failed()
+        return self.result
+
+    def start_container(self):
+        image = self.task['image']
+        cmd = ['docker', 'run', '-d', '-i', '--rm', '-w', self.workdir,
+               '-v', '{0}:{0}'.format(self.workdir), '-v', '{0}:{0}'.format(self.runner.tmp_dir),
+               '-e', 'WORKSPACE={}'.format(self.workdir)]
+        for key, value in cell_env(self.runner.config, self.task['axis']).items():
+            cmd += ['-e', '{}={}'.format(key, value)]
+        cmd += [image['url'], 'cat']
+        self.container = subprocess.check_output(cmd, universal_newlines=True).strip()
+
+    def stop_container(self):
+        if self.container:
+            subprocess.call(['docker', 'rm', '-f', self.container], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            self.container = None
+
+    def kill_in_container(self, script):
+        # the process group when the script leads one, what is left over goes with the container
+        kill = 'pid=$(cat "$0.pid") && { kill -KILL "-$pid" 2>/dev/null || kill -KILL "$pid"; }'
+        subprocess.call(['docker', 'exec', self.container, 'sh', '-c', kill, script],
+                        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def script(self, name, shell, text):
+        path = os.path.join(self.runner.tmp_dir, '{}-{}.sh'.format(self.index, re.sub(r'[^\w.-]', '_', name)))
+        with open(path, 'w') as fout:
+            fout.write(shell + '\n' + text + '\n')
+        os.chmod(path, 0o755)
+        return path
+
+    def run_step(self, step):
+        runner = self.runner
+        config = runner.config
+        name = groovy_str(step.get('name'))
+        prefix = '{}->{}'.format(self.name, name)
+        res = {'name': name, 'status': PASS, 'rc': 0, 'duration': 0.0}
+
+        shell = default_shell(config, step)
+        if shell == 'action' or step.get('resource') or step.get('run') is None:
+            res['status'] = SKIP
+            emit(prefix, 'skipped: needs Jenkins' if step.get('run') is not None or shell == 'action' else 'skipped: no run')
+            return res
+
+        env = step_env(config, step, runner.environ)
+        timeout = step.get('timeout')
+        timeout = runner.timeout(float(resolve_template({}, timeout, config, runner.environ)) * 60 if timeout else None)
+
+        start = time.monotonic()
+        rc, timed_out = self.execute(prefix, self.script(name, shell, groovy_str(step['run'])), env, timeout)
+        if rc != 0:
+            if step.get('onfail') is not None:
+                self.execute(prefix + ' onfail', self.script(name + '-onfail', shell, groovy_str(step['onfail'])), env, None)
+        if step.get('always') is not None:
+            self.execute(prefix + ' always', self.script(name + '-always', shell, groovy_str(step['always'])), env, None)
+
+        res['rc'] = rc
+        res['duration'] = round(time.monotonic() - start, 3)
+        if timed_out:
+            res['status'] = TIMEOUT
+        elif rc != 0:
+            res['status'] = FAIL
+        emit(prefix, '{} rc={} {:.1f}s'.format(res['status'], rc, res['duration']))
+        return res
+
+    def execute(self, prefix, script, env, timeout):
+        if self.runner.args.docker and not self.container:
+            # never fall back to the host for a cell that asked for a sandbox
+            raise CellError('no container to run {}'.format(os.path.basename(script)))
+        if self.container:
+            cmd = ['docker', 'exec', '-i', '-w', self.workdir, '-e', 'WORKSPACE={}'.format(self.workdir)]
+            for key, value in env.items():
+                cmd += ['-e', '{}={}'.format(key, value)]
+            # the pid file lets a timeout kill the script inside the container
+            cmd += [self.container, 'sh', '-c', 'echo $$ > "$0.pid" && exec "$0"', script]
+            proc_env = None
+        else:
+            cmd = [script]
+            proc_env = dict(self.runner.environ)
+            proc_env.update(cell_env(self.runner.config, self.task['axis']))
+            proc_env.update(env)
+            proc_env['WORKSPACE'] = self.workdir
+
+        proc = subprocess.Popen(cmd, cwd=self.workdir, env=proc_env, stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT, stdin=subprocess.DEVNULL, start_new_session=True)
+        timed_out = threading.Event()
+
+        def kill():
+            timed_out.set()
+            emit(prefix, 'timeout after {:.0f}s, killing'.format(timeout))
+            if self.container:
+                # killing docker exec does not stop the process in the container,
+                # the container itself is kept for onfail/always of the step
+                self.kill_in_container(script)
+            try:
+                os.killpg(proc.pid, signal.SIGKILL)
+            except OSError:
+                pass
+
+        timer = threading.Timer(timeout, kill) if timeout is not None else None
+        if timer:
+            timer.start()
+        try:
+            for line in iter(proc.stdout.readline, b''):
+                if not self.runner.args.quiet:
+                    emit(prefix, line.decode(errors='replace'))
+            rc = proc.wait()
+        finally:
+            if timer:
+                timer.cancel()
+        return rc, timed_out.is_set()
+
+
+class LocalRunner:
+
+    def __init__(self, config, args, environ):
+        self.config = config
+        self.args = args
+        self.environ = environ
+        self.tmp_dir = None
+        self.stop = threading.Event()
+        fail_fast = get_config_val(config, ['failFast'], False)
+        self.fail_fast = args.fail_fast or fail_fast is True or groovy_str(fail_fast) == 'true'
+        minutes = get_config_val(config, ['timeout_minutes'], 90)
+        self.deadline = time.monotonic() + float(resolve_template({}, minutes, config, environ)) * 60
+
+    def stopped(self):
+        return self.stop.is_set() or time.monotonic() >= self.deadline
+
+    def failed(self):
+        if self.fail_fast:
+            self.stop.set()
+
+    def timeout(self, seconds):
+        """Step timeout limited by timeout_minutes of the job"""
+        left = max(0.0, self.deadline - time.monotonic())
+        return left if seconds is None else min(seconds, left)
+
+    def workspace(self, index):
+        workdir = os.path.abspath(self.args.workdir)
+        if not self.args.isolate:
+            return workdir
+        target = os.path.join(self.tmp_dir, 'ws-{}'.format(index))
+        shutil.copytree(workdir, target, symlinks=True)
+        return target
+
+    def release(self, index, workdir):
+        if self.args.isolate and workdir and workdir.startswith(self.tmp_dir):
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    def cells(self):
+        task_re = re.compile(self.args.task) if self.args.task else None
+        step_re = re.compile(self.args.step) if self.args.step else None
+        planner = matrix_planner.MatrixPlanner(self.config, self.environ)
+        images = {}
+        for cell in planner.iter_step_table():
+            steps = [step for step, run in zip(planner.steps, cell['run']) if run]
+            if step_re:
+                steps = [step for step in steps if step_re.search(groovy_str(step.get('name')))]
+            if not steps or (task_re and not task_re.search(cell['name'])):
+                continue
+            key = (cell['arch'], cell['image'])
+            if key not in images:
+                images[key] = {k: v for k, v in cell['axis'].items()
+                               if k in ('name', 'arch', 'url', 'uri', 'tag', 'category')}
+            cell['image'] = images[key]
+            yield cell, steps
+
+    def run(self):
+        cells = list(self.cells())
+        if self.args.dry_run:
+            for cell, steps in cells:
+                print('{}: {}'.format(cell['name'], ', '.join(groovy_str(step.get('name')) for step in steps)))
+            return []
+
+        self.tmp_dir = tempfile.mkdtemp(prefix='ci-demo-local-')
+        try:
+            with ThreadPoolExecutor(max_workers=max(1, self.args.jobs)) as pool:
+                futures = [pool.submit(Cell(self, cell, steps, idx).run) for idx, (cell, steps) in enumerate(cells)]
+                return [future.result() for future in futures]
+        finally:
+            shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+
+def print_summary(results, elapsed, out=sys.stdout):
+    print('', file=out)
+    print('{:8} {:>9}  {}'.format('STATUS', 'TIME', 'TASK'), file=out)
+    for res in results:
+        failed = [step['name'] for step in res['steps'] if step['status'] in (FAIL, TIMEOUT)]
+        print('{:8} {:8.1f}s  {}{}'.format(res['status'], res['duration'], res['name'],
+                                          ' ({})'.format(failed[0]) if failed else ''), file=out)
+    counts = {}
+    for res in results:
+        counts[res['status']] = counts.get(res['status'], 0) + 1
+    print('{} tasks in {:.1f}s: {}'.format(len(results), elapsed,
+                                           ', '.join('{} {}'.format(v, k) for k, v in sorted(counts.items()))), file=out)
+
+
+def main(args):
+    environ = dict(os.environ)
+    for item in args.env:
+        key, _, value = item.partition('=')
+        environ[key] = value
+
+    start = time.monotonic()
+    try:
+        runner = LocalRunner(matrix_planner.read_job_project(args.file), args, environ)
+        results = runner.run()
+    except MatrixError as e:
+        print('Error: {}'.format(e))
+        exit(1)
+    if args.dry_run:
+        return
+
+    elapsed = time.monotonic() - start
+    print_summary(results, elapsed)
+    if args.report:
+        with open(args.report, 'w') as fout:
+            json.dump({'file': args.file, 'duration': round(elapsed, 3), 'tasks': results}, fout, indent=2)
+    if not results or any(res['status'] != PASS for res in results):
+        exit(1)
+
+
+if __name__ == '__main__':
+    args = usage()
+    main(args)
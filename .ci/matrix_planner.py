@@ -0,0 +1,608 @@
+#!/usr/bin/env python3
+"""Expand a ci-demo project file into the task list Matrix.groovy builds
+
+Mirrors gen_image_map/getMatrixTasks/getTasks/check_skip_stage from
+src/com/mellanox/cicd/Matrix.groovy, so the size and shape of a matrix can
+be checked before a job is submitted. Tasks are produced lazily and
+include/exclude filters are applied per axis value while walking the
+Cartesian product, so combinations ruled out by a filter are never built.
+"""
+import os
+import re
+import sys
+import json
+import argparse
+from functools import reduce
+
+import project_loader
+
+# arches Matrix.groovy getArchConf() knows without kubernetes.arch_table
+DEFAULT_ARCHES = ('x86_64', 'aarch64', 'ppc64le')
+
+
+class MatrixError(Exception):
+    pass
+
+
+def usage():
+    parser = argparse.ArgumentParser(description='Expand ci-demo project file matrix into task list')
+    parser.add_argument('-file', '--file', metavar='filename', type=str, help='Path to job_matrix.yaml file', required=True)
+    parser.add_argument('-count', '--count', action='store_true', help='Print matrix size summary (default)')
+    parser.add_argument('-list', '--list', action='store_true', help='Print task names')
+    parser.add_argument('-json', '--json', action='store_true', help='Print tasks as JSON lines')
+    parser.add_argument('-table', '--table', action='store_true',
+                        help='Print step x matrix cell run table, as one JSON document with --json')
+    parser.add_argument('-check', '--check', action='store_true',
+                        help='Report disabled/unused steps and cells running no step, fail on empty pipeline')
+    parser.add_argument('-e', '--env', metavar='KEY=VALUE', action='append', default=[],
+                        help='Set job parameter/environment variable used by templates, can be repeated')
+
+    args = parser.parse_args()
+
+    if not os.path.isfile(args.file):
+        print('The file {} does not exist'.format(args.file))
+        exit(1)
+    return args
+
+
+def read_job_project(in_file_name):
+    return project_loader.load(in_file_name)
+
+
+def groovy_str(value):
+    """String conversion the way Groovy's `value + ''` does it"""
+    if value is None:
+        return 'null'
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, list):
+        return '[' + ', '.join(groovy_str(v) for v in value) + ']'
+    if isinstance(value, dict):
+        return '[' + ', '.join('{}:{}'.format(k, groovy_str(v)) for k, v in value.items()) + ']'
+    return str(value)
+
+
+def to_boolean(value):
+    """Groovy String.toBoolean()"""
+    return groovy_str(value).strip().lower() in ('true', 'y', '1')
+
+
+def groovy_truth(value):
+    """Groovy truth of a yaml value, 'false' is true as any non-empty string"""
+    if isinstance(value, (str, list, dict)):
+        return len(value) > 0
+    return bool(value)
+
+
+def cell_runtime(image):
+    """Runtime getTasks() runs a cell of the image with, as run_step() gets it"""
+    if groovy_truth(image.get('nodeLabel')):
+        return 'docker' if image.get('url') is not None else 'baremetal'
+    return 'k8'
+
+
+def replace_vars(variables, text):
+    res = groovy_str(text)
+    for key, value in variables.items():
+        if key in ('', None) or value is None or value == '':
+            continue
+        if '$' not in res:
+            return res
+        for opt in ('$' + key, '${' + key + '}'):
+            if opt in res:
+                res = res.replace(opt, groovy_str(value))
+                break
+    return res
+
+
+def resolve_template(variables, text, config, environ):
+    res = text
+    if config.get('env'):
+        res = replace_vars(config['env'], res)
+    # the merged scope is only needed if there is something left to resolve
+    if '$' not in groovy_str(res):
+        return groovy_str(res)
+    scope = dict(variables)
+    scope.update(config.get('env') or {})
+    scope.update(config)
+    scope.update(environ)
+    return replace_vars(scope, res)
+
+
+def get_config_val(config, keys, default=None, to_string=True):
+    val = config
+    for key in keys:
+        if not isinstance(val, dict) or val.get(key) is None:
+            return default
+        val = val[key]
+    if to_string and isinstance(val, list) and len(val) == 1:
+        return val[0]
+    return val
+
+
+def _split_top_level(text):
+    items, quote, start = [], None, 0
+    for pos, char in enumerate(text):
+        if quote:
+            if char == quote:
+                quote = None
+        elif char in '\'"':
+            quote = char
+        elif char == ',':
+            items.append(text[start:pos])
+            start = pos + 1
+    items.append(text[start:])
+    return [item.strip() for item in items if item.strip()]
+
+
+def _unquote(text):
+    text = text.strip()
+    if len(text) >= 2 and text[0] == text[-1] and text[0] in '\'"':
+        return text[1:-1]
+    if text in ('true', 'false'):
+        return text == 'true'
+    if text == 'null':
+        return None
+    if re.fullmatch(r'-?\d+', text):
+        return int(text)
+    return text
+
+
+def parse_selector_map(selector):
+    """Parse a selector string like "{name: 'centos7', variant: 1}"
+
+    Matrix.groovy toStringMap() evaluates it as a Groovy map literal.
+    """
+    if isinstance(selector, dict):
+        return dict(selector)
+    text = re.sub(r'[{}]', ' ', groovy_str(selector)).strip()
+    if text.startswith('[') and text.endswith(']'):
+        text = text[1:-1]
+    result = {}
+    for item in _split_top_level(text):
+        key, sep, value = item.partition(':')
+        if not sep:
+            raise MatrixError("Unable to parse selector '{}'".format(selector))
+        result[groovy_str(_unquote(key))] = _unquote(value)
+    return result
+
+
+def parse_selector(selector):
+    """Matrix.groovy stringToList(): selector string or list -> list of maps"""
+    if not selector:
+        return []
+    if isinstance(selector, (str, dict)):
+        return [parse_selector_map(selector)]
+    return [parse_selector_map(item) for item in selector]
+
+
+def compile_filters(filters):
+    return [[(key, re.compile(groovy_str(value))) for key, value in f.items()] for f in filters]
+
+
+def match_map_entry(compiled, entry):
+    """Matrix.groovy matchMapEntry() for filters from compile_filters()"""
+    for one in compiled:
+        if all(entry.get(key) is not None and regex.fullmatch(groovy_str(entry[key]))
+               for key, regex in one):
+            return True
+    return False
+
+
+def known_arches(config):
+    arch_table = get_config_val(config, ['kubernetes', 'arch_table'], None, False) or {}
+    return set(DEFAULT_ARCHES) | set(arch_table)
+
+
+def gen_image_map(config, environ):
+    """Matrix.groovy gen_image_map(): {arch: [image, ...]}"""
+    image_map = {}
+    dockers = config.get('runs_on_dockers') or []
+    arch_list = get_config_val(config, ['matrix', 'axes', 'arch'], None, False)
+
+    if arch_list:
+        for arch in arch_list:
+            image_map[arch] = []
+    else:
+        for dfile in dockers:
+            if not dfile.get('arch'):
+                raise MatrixError("Please define tag 'arch' for image {} in 'runs_on_dockers' section of yaml file".format(dfile.get('name')))
+            image_map[dfile['arch']] = []
+
+    arches = known_arches(config)
+    for arch, images in image_map.items():
+        if arch not in arches:
+            continue
+        for item in dockers:
+            dfile = dict(item)
+            if dfile.get('enable') is None:
+                dfile['enable'] = 'true'
+            if dfile['enable'] == 'auto':
+                dfile['enable'] = '${' + groovy_str(dfile.get('name')) + '}'
+            if not to_boolean(resolve_template(dfile, dfile['enable'], config, environ)):
+                continue
+
+            dfile['arch'] = dfile.get('arch') or arch
+            if dfile['arch'] != arch:
+                continue
+
+            dfile['file'] = dfile.get('file') or ''
+            if dfile.get('url'):
+                parts = dfile['url'].split('/')[-1].split(':')
+                if len(parts) == 2:
+                    dfile['tag'] = parts[1]
+                    dfile['uri'] = dfile['url'][:len(dfile['url']) - len(parts[1]) - 1]
+
+            dfile['tag'] = dfile.get('tag') or 'latest'
+            dfile['build_args'] = resolve_template(dfile, dfile.get('build_args') or '', config, environ)
+            dfile['uri'] = dfile.get('uri') or '{}/{}'.format(arch, dfile.get('name'))
+            dfile['filename'] = dfile['file']
+            dfile['uri'] = resolve_template(dfile, dfile['uri'], config, environ)
+            dfile['url'] = dfile.get('url') or '{}{}/{}:{}'.format(
+                groovy_str(config.get('registry_host')), groovy_str(config.get('registry_path')),
+                dfile['uri'], dfile['tag'])
+            dfile['url'] = resolve_template(dfile, dfile['url'], config, environ)
+            images.append(dfile)
+    return image_map
+
+
+class Selector:
+    """Compiled containerSelector/agentSelector
+
+    Only the keys named by the selector decide the match, so results are
+    memoized on the values of those keys and every distinct key/value
+    combination is matched once per job, not once per step and cell.
+    """
+
+    def __init__(self, selector):
+        self.filters = compile_filters(parse_selector(selector))
+        self.keys = sorted({key for one in self.filters for key, regex in one})
+        self.memo = {}
+
+    def match(self, axis):
+        values = tuple(None if axis.get(key) is None else groovy_str(axis[key]) for key in self.keys)
+        res = self.memo.get(values)
+        if res is None:
+            entry = {key: value for key, value in zip(self.keys, values) if value is not None}
+            res = self.memo[values] = match_map_entry(self.filters, entry)
+        return res
+
+
+class StepSelector:
+    """check_skip_stage() for one step with its selectors parsed once
+
+    Steps sharing a selector string share its Selector through 'cache'.
+    """
+
+    def __init__(self, step, config, environ, cache=None):
+        self.step = step
+        self.enabled = True
+        if step.get('enable') is not None:
+            self.enabled = to_boolean(resolve_template({}, step['enable'], config, environ))
+
+        # a parallel step is checked once more without runtime by runSteps()
+        self.parallel = step.get('parallel') is True
+        single = get_config_val(config, ['step_allow_single_selector'], False)
+        self.single = groovy_truth(single)
+        self.has_container = groovy_truth(step.get('containerSelector'))
+        self.has_agent = groovy_truth(step.get('agentSelector'))
+        if single is True and step.get('containerSelector') is not None and step.get('agentSelector') is not None:
+            raise MatrixError("Step='{}' has both containerSelector and agentSelector configured, "
+                              "step_allow_single_selector=true, set `step_allow_single_selector: false` "
+                              "to disable".format(step.get('name')))
+
+        cache = {} if cache is None else cache
+        self.container = self._selector(step.get('containerSelector'), cache)
+        self.agent = self._selector(step.get('agentSelector'), cache)
+        self.selectors = [selector for selector in (self.container, self.agent) if selector]
+
+    @staticmethod
+    def _selector(selector, cache):
+        if not selector:
+            return None
+        key = groovy_str(selector)
+        if key not in cache:
+            cache[key] = Selector(selector)
+        return cache[key]
+
+    def skip(self, image, axis, runtime=None):
+        """Without runtime the pass getTasks() makes over both selectors,
+        with it the one run_step() makes inside a k8/docker/baremetal cell"""
+        if not self.enabled:
+            return True
+        selectors = self.selectors
+        if runtime == 'k8':
+            if self.single and self.has_agent:
+                return True
+            selectors = [self.container] if self.container else []
+        elif runtime is not None:
+            if self.single and self.has_container:
+                return True
+            selectors = [self.agent] if self.agent else []
+        skip = image.get('category') == 'tool'
+        for selector in selectors:
+            if selector.match(axis):
+                return False
+            skip = True
+        return skip
+
+
+class MatrixPlanner:
+
+    def __init__(self, config, environ=None):
+        self.config = config
+        self.environ = dict(os.environ if environ is None else environ)
+
+        if not config.get('env'):
+            config['env'] = {}
+
+        matrix = config.get('matrix')
+        self.axes = []
+        self.include = []
+        self.exclude = []
+        if matrix:
+            if matrix.get('include') is not None and matrix.get('exclude') is not None:
+                raise MatrixError('matrix.include and matrix.exclude sections are mutually exclusive. Please keep only one.')
+            self.axes = [(key, list(values or [])) for key, values in (matrix.get('axes') or {}).items()]
+            self.include = self._resolve_filters(get_config_val(config, ['matrix', 'include'], [], False))
+            self.exclude = self._resolve_filters(get_config_val(config, ['matrix', 'exclude'], [], False))
+
+        self.steps = config.get('steps') or []
+        self.selectors = {}
+        self.step_selectors = [StepSelector(step, config, self.environ, self.selectors) for step in self.steps]
+
+    def _resolve_filters(self, filters):
+        return [{key: resolve_template({}, value, self.config, self.environ) for key, value in f.items()}
+                for f in filters]
+
+    def images(self):
+        for arch, images in gen_image_map(self.config, self.environ).items():
+            for image in images:
+                yield image
+        for agent in self.config.get('runs_on_agents') or []:
+            image = dict(agent)
+            image['name'] = image.get('nodeLabel')
+            image['arch'] = 'x86_64'
+            yield image
+
+    def combinations(self):
+        """Number of matrix combinations per image before filtering"""
+        if not self.config.get('matrix'):
+            return 1
+        if not self.axes:
+            return 0
+        return reduce(lambda total, axis: total * len(axis[1]), self.axes, 1)
+
+    def iter_cells(self, image):
+        """Axis maps of the image that pass the include/exclude filters"""
+        job = self.config.get('job')
+        if not self.config.get('matrix'):
+            axis = dict(image)
+            axis['job'] = job
+            yield axis
+            return
+        if not self.axes:
+            return
+
+        filters = self.include or self.exclude
+        include = bool(self.include)
+        axis_pos = {key: pos for pos, (key, values) in enumerate(self.axes)}
+
+        # Walk the product with the last axis outermost, which gives the
+        # order of Groovy's combinations() (first axis changes fastest).
+        order = list(reversed(range(len(self.axes))))
+        depth_of = {pos: depth for depth, pos in enumerate(order)}
+
+        # For every filter: bit set when the filter can still match.
+        # base: keys resolved from image/job, value_masks: per axis value.
+        base = 0
+        decided = [0] * (len(order) + 1)
+        value_masks = [[0] * len(values) for key, values in self.axes]
+        for bit, one in enumerate(compile_filters(filters)):
+            possible = True
+            last_depth = -1
+            axis_keys = {}
+            for key, regex in one:
+                if key in image or key == 'job':
+                    value = image[key] if key in image else job
+                    if value is None or not regex.fullmatch(groovy_str(value)):
+                        possible = False
+                elif key in axis_pos:
+                    axis_keys[axis_pos[key]] = regex
+                    last_depth = max(last_depth, depth_of[axis_pos[key]])
+                else:
+                    possible = False
+            if not possible:
+                continue
+            base |= 1 << bit
+            decided[last_depth + 1] |= 1 << bit
+            for pos, (key, values) in enumerate(self.axes):
+                regex = axis_keys.get(pos)
+                for idx, value in enumerate(values):
+                    if regex is None or (value is not None and regex.fullmatch(groovy_str(value))):
+                        value_masks[pos][idx] |= 1 << bit
+
+        # decided[d]: filters fully evaluated once d axes are chosen
+        for depth in range(1, len(decided)):
+            decided[depth] |= decided[depth - 1]
+
+        arch_pos = axis_pos.get('arch')
+        chosen = [None] * len(self.axes)
+
+        def walk(depth, mask):
+            if filters:
+                if include and not mask:
+                    return
+                if not include and mask & decided[depth]:
+                    return
+            if depth == len(order):
+                axis = {key: values[chosen[pos]] for pos, (key, values) in enumerate(self.axes)}
+                axis.update(image)
+                axis['job'] = job
+                yield axis
+                return
+            pos = order[depth]
+            for idx, value in enumerate(self.axes[pos][1]):
+                if pos == arch_pos and value is not None and value != image.get('arch'):
+                    continue
+                chosen[pos] = idx
+                yield from walk(depth + 1, mask & value_masks[pos][idx])
+
+        yield from walk(0, base)
+
+    def iter_step_table(self):
+        """Every matrix cell in Matrix.groovy order with its run flag per step
+
+        Yields dicts with name, image, arch, axis, task and run. task is
+        False for cells getTasks() drops because no step passes its selector
+        check. run[i] is True when steps[i] runs in the cell: the cell is a
+        task, run_step() does not skip the step for the cell's runtime and,
+        for a parallel step, runSteps() does not skip it either. Run tuples
+        are shared between cells.
+        """
+        if not self.steps:
+            return
+        tmpl = get_config_val(self.config, ['taskName'], None)
+        # a cell's run flags only depend on the tool category, the runtime
+        # and the outcome of each distinct selector, compute them once per outcome
+        selectors = list(self.selectors.values())
+        runs = {}
+        for image in self.images():
+            runtime = cell_runtime(image)
+            serial = 1
+            for axis in self.iter_cells(image):
+                axis['variant'] = serial
+                axis['axis_index'] = serial
+                serial += 1
+
+                if tmpl is None:
+                    name = '{}/{} v{}'.format(groovy_str(axis.get('arch')), groovy_str(image.get('name')), axis['axis_index'])
+                else:
+                    name = resolve_template(axis, tmpl, self.config, self.environ)
+
+                key = (image.get('category') == 'tool', runtime) + tuple(selector.match(axis) for selector in selectors)
+                cached = runs.get(key)
+                if cached is None:
+                    listed = [not step.skip(image, axis) for step in self.step_selectors]
+                    task = any(listed)
+                    run = tuple(task and not step.skip(image, axis, runtime) and (listed[idx] or not step.parallel)
+                                for idx, step in enumerate(self.step_selectors))
+                    cached = runs[key] = (task, run)
+                task, run = cached
+                yield {'name': name, 'image': image.get('name'), 'arch': image.get('arch'),
+                       'axis': axis, 'task': task, 'run': run}
+
+    def iter_tasks(self):
+        """Tasks in Matrix.groovy order, as dicts with name, image and axis"""
+        for cell in self.iter_step_table():
+            if not cell['task']:
+                continue
+            steps = [step.get('name') for step, run in zip(self.steps, cell['run']) if run]
+            yield {'name': cell['name'], 'image': cell['image'], 'arch': cell['arch'],
+                   'steps': steps, 'axis': cell['axis']}
+
+    def step_table(self):
+        """Dense run/skip table: (cells, rows), rows[step][cell] is True if the step runs"""
+        cells = []
+        rows = [[] for step in self.steps]
+        for cell in self.iter_step_table():
+            cells.append(cell)
+            for row, run in zip(rows, cell['run']):
+                row.append(run)
+        return cells, rows
+
+    def check(self):
+        """Problems visible before submission: (warnings, errors)"""
+        warnings = []
+        errors = []
+        cells, rows = self.step_table()
+        for step, selector, row in zip(self.steps, self.step_selectors, rows):
+            if not selector.enabled:
+                warnings.append("Step '{}' is disabled".format(step.get('name')))
+            elif cells and not any(row):
+                warnings.append("Step '{}' does not run in any matrix cell".format(step.get('name')))
+        for cell in cells:
+            if not any(cell['run']):
+                warnings.append("Matrix cell '{}' runs no step".format(cell['name']))
+        if not self.steps:
+            errors.append('No steps defined')
+        elif not any(any(row) for row in rows):
+            errors.append('Pipeline is empty: no step runs in any of {} matrix cells'.format(len(cells)))
+        return warnings, errors
+
+
+def print_summary(planner, out=sys.stdout):
+    per_image = {}
+    total_tasks = 0
+    total_steps = 0
+    for task in planner.iter_tasks():
+        key = '{}/{}'.format(task['arch'], task['image'])
+        stat = per_image.setdefault(key, [0, 0])
+        stat[0] += 1
+        stat[1] += len(task['steps'])
+        total_tasks += 1
+        total_steps += len(task['steps'])
+
+    images = list(planner.images())
+    print('job: {}'.format(planner.config.get('job')), file=out)
+    print('images: {}'.format(len(images)), file=out)
+    print('combinations: {}'.format(planner.combinations() * len(images)), file=out)
+    print('tasks: {}'.format(total_tasks), file=out)
+    print('step runs: {}'.format(total_steps), file=out)
+    for key, (tasks, steps) in per_image.items():
+        print('  {}: tasks={} step runs={}'.format(key, tasks, steps), file=out)
+
+
+def print_step_table(planner, as_json=False, out=sys.stdout):
+    cells, rows = planner.step_table()
+    names = [groovy_str(step.get('name')) for step in planner.steps]
+    if as_json:
+        print(json.dumps({
+            'steps': names,
+            'cells': [{'name': cell['name'], 'image': cell['image'], 'arch': cell['arch'],
+                       'axis': cell['axis']} for cell in cells],
+            'run': [[int(run) for run in row] for row in rows],
+        }, default=groovy_str), file=out)
+        return
+    for idx, name in enumerate(names):
+        print('{:>4} {} ({}/{} cells)'.format(idx, name, sum(rows[idx]), len(cells)), file=out)
+    width = max([len(cell['name']) for cell in cells] + [4])
+    print('{:{}} {}'.format('', width, ''.join(str(idx % 10) for idx in range(len(names)))), file=out)
+    for cell in cells:
+        print('{:{}} {}'.format(cell['name'], width, ''.join('x' if run else '.' for run in cell['run'])), file=out)
+
+
+def main(args):
+    environ = dict(os.environ)
+    for item in args.env:
+        key, _, value = item.partition('=')
+        environ[key] = value
+
+    try:
+        planner = MatrixPlanner(read_job_project(args.file), environ)
+        if args.check:
+            warnings, errors = planner.check()
+            for line in warnings:
+                print('Warning: {}'.format(line))
+            for line in errors:
+                print('Error: {}'.format(line))
+            if errors:
+                exit(1)
+        if args.table:
+            print_step_table(planner, args.json)
+        elif args.list or args.json:
+            for task in planner.iter_tasks():
+                if args.json:
+                    print(json.dumps(task, default=groovy_str))
+                else:
+                    print(task['name'])
+        if args.count or not (args.list or args.json or args.table or args.check):
+            print_summary(planner)
+    except MatrixError as e:
+        print('Error: {}'.format(e))
+        exit(1)
+
+
+if __name__ == '__main__':
+    args = usage()
+    main(args)
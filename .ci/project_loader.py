@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+"""Shared loader of ci-demo project files
+
+Every tool used to run the pure Python yaml.safe_load on the same project
+files, and the validator parsed them once more through yamale. This module
+parses with the libyaml based CSafeLoader when PyYAML was built with it and
+keeps the parsed documents in an on-disk cache:
+
+  - one entry per file, named after the absolute path
+  - an entry is used without reading the file when mtime and size match
+    and the file was not modified within RACY_NS before the entry was
+    written, otherwise the file is read and its sha256 compared
+  - top level values of a mapping are pickled one by one, so a view of a
+    cached file unpickles only the keys a tool looks at
+
+The cache lives in $CI_DEMO_YAML_CACHE, default ~/.cache/ci-demo/yaml, and
+is disabled with CI_DEMO_YAML_CACHE=off. A cache that cannot be written is
+skipped silently. yaml is imported only when a file is parsed, cache hits
+do not pay for it.
+"""
+import os
+import io
+import time
+import pickle
+import hashlib
+import datetime
+from collections.abc import Mapping
+
+CACHE_VERSION = 1
+
+# mtime/size are not trusted for files modified this close to the cache
+# write, a second change within the filesystem timestamp granularity
+# would go unnoticed
+RACY_NS = 2 * 10 ** 9
+
+# types yaml.SafeLoader constructs besides the builtin containers
+SAFE_GLOBALS = {
+    ('datetime', 'date'): datetime.date,
+    ('datetime', 'datetime'): datetime.datetime,
+    ('datetime', 'timedelta'): datetime.timedelta,
+    ('datetime', 'timezone'): datetime.timezone,
+    ('builtins', 'set'): set,
+    ('builtins', 'bytes'): bytes,
+}
+
+
+def cache_dir():
+    """Cache directory from the environment, None when disabled"""
+    path = os.environ.get('CI_DEMO_YAML_CACHE')
+    if path == 'off':
+        return None
+    if path:
+        return path
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'ci-demo', 'yaml')
+
+
+def safe_loader():
+    import yaml
+    return getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+
+def loads(text):
+    """yaml.safe_load with CSafeLoader, for text not backed by a file"""
+    import yaml
+    return yaml.load(text, Loader=safe_loader())
+
+
+class _Unpickler(pickle.Unpickler):
+    """Only what a safe yaml load can produce, a planted cache file must
+    not run code"""
+
+    def find_class(self, module, name):
+        try:
+            return SAFE_GLOBALS[(module, name)]
+        except KeyError:
+            raise pickle.UnpicklingError('{}.{} is not allowed in the yaml cache'.format(module, name))
+
+
+def _unpickle(data):
+    return _Unpickler(io.BytesIO(data)).load()
+
+
+def _pack(doc):
+    """('map', {key: pickled value}) for mappings, ('obj', pickled doc) else"""
+    if isinstance(doc, dict):
+        return ('map', {key: pickle.dumps(value, pickle.HIGHEST_PROTOCOL) for key, value in doc.items()})
+    return ('obj', pickle.dumps(doc, pickle.HIGHEST_PROTOCOL))
+
+
+class ProjectView(Mapping):
+    """Read-only mapping of a top level document, values are materialized
+    on first access
+
+    Backed either by pickled values of the cache or by the composed yaml
+    nodes of a file parsed without cache. Anchors shared between top level
+    keys become separate copies when the values come from the cache.
+    """
+
+    def __init__(self, path, packed=None, nodes=None, loader=None):
+        self.path = path
+        self._values = {}
+        self._packed = packed or {}
+        self._nodes = nodes or {}
+        self._loader = loader
+        self._keys = list(self._packed) if packed is not None else list(self._nodes)
+
+    def __getitem__(self, key):
+        if key in self._values:
+            return self._values[key]
+        if key in self._packed:
+            value = _unpickle(self._packed.pop(key))
+        elif key in self._nodes:
+            value = self._loader.construct_object(self._nodes.pop(key), deep=True)
+        else:
+            raise KeyError(key)
+        self._values[key] = value
+        return value
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, key):
+        return key in self._values or key in self._packed or key in self._nodes
+
+    def materialized(self):
+        """Keys resolved so far"""
+        return [key for key in self._keys if key in self._values]
+
+    def to_dict(self):
+        return {key: self[key] for key in self._keys}
+
+
+def _cache_file(directory, path):
+    return os.path.join(directory, hashlib.sha256(path.encode()).hexdigest()[:32] + '.pickle')
+
+
+def _read_entry(cache_path, path):
+    try:
+        with open(cache_path, 'rb') as fin:
+            entry = _unpickle(fin.read())
+    except (OSError, EOFError, ValueError, TypeError, pickle.UnpicklingError):
+        return None
+    if not isinstance(entry, dict) or entry.get('version') != CACHE_VERSION or entry.get('path') != path:
+        return None
+    return entry
+
+
+def _write_entry(cache_path, entry):
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        tmp = '{}.{}'.format(cache_path, os.getpid())
+        with open(tmp, 'wb') as fout:
+            pickle.dump(entry, fout, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, cache_path)
+    except OSError:
+        pass
+
+
+def _fresh(entry, st):
+    return entry['mtime_ns'] == st.st_mtime_ns and entry['size'] == st.st_size and \
+        st.st_mtime_ns < entry['written_ns'] - RACY_NS
+
+
+def _cached_docs(path, directory):
+    """Packed documents of path, from the cache or parsed and stored"""
+    path = os.path.abspath(path)
+    st = os.stat(path)
+    cache_path = _cache_file(directory, path)
+    entry = _read_entry(cache_path, path)
+    if entry is not None and _fresh(entry, st):
+        return entry['docs']
+
+    with open(path, 'rb') as fin:
+        data = fin.read()
+    digest = hashlib.sha256(data).hexdigest()
+    if entry is not None and entry['sha256'] == digest:
+        docs = entry['docs']
+    else:
+        import yaml
+        docs = [_pack(doc) for doc in yaml.load_all(data, Loader=safe_loader())]
+    _write_entry(cache_path, {
+        'version': CACHE_VERSION,
+        'path': path,
+        'mtime_ns': st.st_mtime_ns,
+        'size': st.st_size,
+        'written_ns': time.time_ns(),
+        'sha256': digest,
+        'docs': docs,
+    })
+    return docs
+
+
+def _unpack(packed):
+    kind, data = packed
+    if kind == 'map':
+        return {key: _unpickle(value) for key, value in data.items()}
+    return _unpickle(data)
+
+
+def load_all(path, cache=True):
+    """All documents of a yaml file, as yaml.safe_load_all returns them"""
+    directory = cache_dir() if cache else None
+    if directory:
+        return [_unpack(packed) for packed in _cached_docs(path, directory)]
+    import yaml
+    with open(path, 'rb') as fin:
+        return list(yaml.load_all(fin, Loader=safe_loader()))
+
+
+def load(path, cache=True):
+    """First document of a yaml file, as yaml.safe_load returns it"""
+    docs = load_all(path, cache)
+    return docs[0] if docs else None
+
+
+def load_view(path, cache=True):
+    """ProjectView of the project file, values are built on first access
+
+    Falls back to the plain document when it is not a mapping.
+    """
+    directory = cache_dir() if cache else None
+    if directory:
+        docs = _cached_docs(path, directory)
+        if not docs:
+            return None
+        kind, data = docs[0]
+        return ProjectView(path, packed=dict(data)) if kind == 'map' else _unpickle(data)
+
+    import yaml
+    with open(path, 'rb') as fin:
+        loader = safe_loader()(fin.read())
+    try:
+        node = loader.get_single_node()
+    except Exception:
+        loader.dispose()
+        raise
+    if node is None:
+        return None
+    if not isinstance(node, yaml.MappingNode):
+        return loader.construct_document(node)
+    loader.flatten_mapping(node)
+    nodes = {}
+    for key_node, value_node in node.value:
+        nodes[loader.construct_object(key_node, deep=True)] = value_node
+    return ProjectView(path, nodes=nodes, loader=loader)
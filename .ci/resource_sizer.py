@@ -0,0 +1,389 @@
+#!/usr/bin/env python3
+"""Right-size kubernetes limits/requests from measured CPU/memory usage
+
+kubernetes.limits/requests (or the same keys of a runs_on_dockers entry)
+are pasted into every pod as written. Too low limits throttle steps or get
+them OOM killed, too high requests leave node capacity unused, because the
+scheduler packs pods by their requests. Given usage samples of past runs
+this tool computes per image/arch:
+
+  cpu request      -request-pct percentile of the cpu samples
+  cpu limit        -limit-pct percentile of the cpu samples, times -headroom
+  memory request   -request-pct percentile of the per run memory peaks
+  memory limit     highest memory peak, times -headroom
+
+and prints a suggested kubernetes block (runs_on_dockers entries get own
+values where they differ from it) with the cells per node the current and
+the suggested requests allow on a -node sized node.
+
+Samples are JSON ([{...}, ...] or {"samples": [...]}), JSON lines or CSV
+records. A record names its cell by 'task' (the task name matrix_planner
+prints) or by 'image' and 'arch', other CSV columns are matrix axis
+values. Usage is given as
+
+  cpu           cores or a quantity ('250m')
+  usage_usec    cumulative cpu.stat usage_usec of the cell's cgroup, with
+                'ts' in seconds; consecutive records of a run are turned
+                into cores
+  memory        bytes or a quantity ('512Mi'), also memory_current or
+                memory_peak as exported from cgroup v2
+
+Records of one cell run are told apart by 'run', default is the file.
+"""
+import os
+import re
+import sys
+import csv
+import json
+import math
+import argparse
+
+import matrix_planner
+import project_loader
+from matrix_planner import MatrixError
+
+# Matrix.groovy runK8() defaults
+DEFAULT_RESOURCES = '{memory: 8Gi, cpu: 4000m}'
+
+CPU_STEP_M = 50
+MEMORY_STEP_MI = 64
+
+MEMORY_UNITS = {
+    '': 1, 'k': 1000, 'M': 1000 ** 2, 'G': 1000 ** 3, 'T': 1000 ** 4,
+    'Ki': 1024, 'Mi': 1024 ** 2, 'Gi': 1024 ** 3, 'Ti': 1024 ** 4,
+}
+
+
+def usage():
+    parser = argparse.ArgumentParser(description='Suggest kubernetes limits/requests from CPU/memory usage samples')
+    parser.add_argument('-file', '--file', metavar='filename', type=str, help='Path to job_matrix.yaml file', required=True)
+    parser.add_argument('-samples', '--samples', metavar='FILE', action='append', default=[], required=True,
+                        help='Usage samples: .json, .jsonl or .csv file, can be repeated')
+    parser.add_argument('-request-pct', '--request-pct', metavar='PCT', type=float, default=90.0,
+                        help='Percentile of usage used for requests, default: 90')
+    parser.add_argument('-limit-pct', '--limit-pct', metavar='PCT', type=float, default=99.0,
+                        help='Percentile of cpu usage used for limits, default: 99')
+    parser.add_argument('-headroom', '--headroom', metavar='FACTOR', type=float, default=1.2,
+                        help='Factor applied to limits, default: 1.2')
+    parser.add_argument('-node', '--node', metavar='cpu=N,memory=Q', default='cpu=32,memory=128Gi',
+                        help='Allocatable resources of a node, default: cpu=32,memory=128Gi')
+    parser.add_argument('-min-runs', '--min-runs', metavar='N', type=int, default=3,
+                        help='Runs needed before an image gets a suggestion, default: 3')
+    parser.add_argument('-json', '--json', action='store_true', help='Print report as JSON')
+    parser.add_argument('-e', '--env', metavar='KEY=VALUE', action='append', default=[],
+                        help='Set job parameter/environment variable used by templates, can be repeated')
+
+    args = parser.parse_args()
+
+    if not os.path.isfile(args.file):
+        print('The file {} does not exist'.format(args.file))
+        exit(1)
+    return args
+
+
+def parse_cpu(value):
+    """Cores of a cpu quantity: 2, '1.5', '250m'"""
+    text = str(value).strip()
+    if text.endswith('m'):
+        return float(text[:-1]) / 1000
+    return float(text)
+
+
+def parse_memory(value):
+    """Bytes of a memory quantity: 1048576, '512Mi', '1G'"""
+    m = re.fullmatch(r'\s*([\d.]+(?:e\d+)?)\s*([kMGT]i?|)\s*', str(value))
+    if not m:
+        raise ValueError('Invalid memory quantity {}'.format(value))
+    return float(m.group(1)) * MEMORY_UNITS[m.group(2)]
+
+
+def format_cpu(cores):
+    return '{}m'.format(max(CPU_STEP_M, int(math.ceil(cores * 1000 / CPU_STEP_M)) * CPU_STEP_M))
+
+
+def format_memory(size):
+    mib = max(MEMORY_STEP_MI, int(math.ceil(size / 1024 ** 2 / MEMORY_STEP_MI)) * MEMORY_STEP_MI)
+    return '{}Gi'.format(mib // 1024) if mib % 1024 == 0 else '{}Mi'.format(mib)
+
+
+def parse_resources(value):
+    """{'cpu': cores, 'memory': bytes} of a limits/requests value, given as
+    '{memory: 8Gi, cpu: 4000m}' like in project files or as a map"""
+    if isinstance(value, str):
+        text = value.strip()
+        if not text.startswith('{'):
+            text = '{' + text + '}'
+        value = project_loader.loads(text) or {}
+    res = {}
+    if value.get('cpu') is not None:
+        res['cpu'] = parse_cpu(value['cpu'])
+    if value.get('memory') is not None:
+        res['memory'] = parse_memory(value['memory'])
+    return res
+
+
+def resources_str(res):
+    items = []
+    if 'memory' in res:
+        items.append('memory: {}'.format(format_memory(res['memory'])))
+    if 'cpu' in res:
+        items.append('cpu: {}'.format(format_cpu(res['cpu'])))
+    return '{{{}}}'.format(', '.join(items))
+
+
+def percentile(values, pct):
+    """Nearest rank percentile"""
+    values = sorted(values)
+    rank = int(math.ceil(pct / 100.0 * len(values)))
+    return values[min(len(values), max(1, rank)) - 1]
+
+
+def read_records(path):
+    if path.endswith('.csv'):
+        with open(path, newline='') as fin:
+            return list(csv.DictReader(fin))
+    with open(path) as fin:
+        if path.endswith('.jsonl'):
+            return [json.loads(line) for line in fin if line.strip()]
+        data = json.load(fin)
+    return data.get('samples', []) if isinstance(data, dict) else data
+
+
+class Usage:
+    """cpu samples (cores) and memory peaks (bytes) per (image, arch)"""
+
+    RECORD_KEYS = ('task', 'image', 'arch', 'run', 'cpu', 'usage_usec', 'ts',
+                   'memory', 'memory_current', 'memory_peak', 'axis')
+
+    def __init__(self, tasks):
+        # task name -> (image, arch)
+        self.tasks = {task['name']: (task['image'], task['arch']) for task in tasks}
+        self.cpu = {}
+        self.peaks = {}
+        self.unmatched = {}
+
+    def load(self, path):
+        if not os.path.isfile(path):
+            raise MatrixError('Samples file {} does not exist'.format(path))
+        runs = {}
+        for record in read_records(path):
+            key = self.cell(record)
+            if key is None:
+                name = record.get('task') or '{}/{}'.format(record.get('arch'), record.get('image'))
+                self.unmatched[name] = self.unmatched.get(name, 0) + 1
+                continue
+            axis = record.get('axis') or {k: v for k, v in record.items() if k not in self.RECORD_KEYS}
+            run_id = (path, record.get('run'), record.get('task'), tuple(sorted((k, str(v)) for k, v in axis.items())))
+            runs.setdefault((key, run_id), []).append(record)
+        for (key, run_id), records in runs.items():
+            self.add_run(key, records)
+
+    def cell(self, record):
+        if record.get('task'):
+            return self.tasks.get(record['task'])
+        if record.get('image'):
+            return record['image'], record.get('arch') or 'x86_64'
+        return None
+
+    def add_run(self, key, records):
+        cpu = self.cpu.setdefault(key, [])
+        peak = None
+        last = None
+        for record in sorted(records, key=lambda record: float(record.get('ts') or 0)):
+            if record.get('cpu') not in (None, ''):
+                cpu.append(parse_cpu(record['cpu']))
+            elif record.get('usage_usec') not in (None, ''):
+                if record.get('ts') in (None, ''):
+                    raise MatrixError('usage_usec sample without ts: {}'.format(record))
+                now = (float(record['ts']), float(record['usage_usec']))
+                if last is not None and now[0] > last[0]:
+                    cpu.append((now[1] - last[1]) / 1e6 / (now[0] - last[0]))
+                last = now
+            for field in ('memory', 'memory_current', 'memory_peak'):
+                if record.get(field) not in (None, ''):
+                    size = parse_memory(record[field])
+                    peak = size if peak is None else max(peak, size)
+        if peak is not None:
+            self.peaks.setdefault(key, []).append(peak)
+
+    def suggest(self, key, request_pct, limit_pct, headroom, min_runs):
+        cpu = self.cpu.get(key) or []
+        peaks = self.peaks.get(key) or []
+        if len(peaks) < min_runs or not cpu:
+            return None
+        return {
+            'runs': len(peaks),
+            'samples': len(cpu),
+            'requests': {'cpu': percentile(cpu, request_pct), 'memory': percentile(peaks, request_pct)},
+            'limits': {'cpu': percentile(cpu, limit_pct) * headroom, 'memory': max(peaks) * headroom},
+        }
+
+
+def rounded(res):
+    return {'cpu': parse_cpu(format_cpu(res['cpu'])), 'memory': parse_memory(format_memory(res['memory']))}
+
+
+def cells_per_node(node, requests):
+    """Pods the scheduler fits on one node by their requests"""
+    fits = [int(node[key] // requests[key]) for key in ('cpu', 'memory') if requests.get(key)]
+    return min(fits) if fits else None
+
+
+def current_resources(config, entry):
+    """limits/requests the cells run with, the default applies only to a
+    missing value as in runK8, '{memory: 4Gi}' sets no cpu limit"""
+    kubernetes = config.get('kubernetes') or {}
+    res = {}
+    for key in ('limits', 'requests'):
+        value = entry.get(key) or kubernetes.get(key) or DEFAULT_RESOURCES
+        res[key] = parse_resources(value)
+    return res
+
+
+def scheduled_requests(current):
+    """Requests the scheduler sees, kubernetes uses the limit of a resource
+    whose request is not set"""
+    return dict(current['limits'], **current['requests'])
+
+
+def plan(config, usage, node, args):
+    """Report per image/arch and the suggested kubernetes block"""
+    entries = {}
+    for entry in config.get('runs_on_dockers') or []:
+        entries.setdefault(entry.get('name'), entry)
+
+    images = []
+    keys = sorted(set(usage.cpu) | set(usage.peaks), key=lambda key: (str(key[0]), str(key[1])))
+    for key in keys:
+        image, arch = key
+        entry = entries.get(image, {})
+        current = current_resources(config, entry)
+        res = {'image': image, 'arch': arch, 'current': current}
+        if image not in entries:
+            res['status'] = 'not in runs_on_dockers'
+        suggestion = usage.suggest(key, args.request_pct, args.limit_pct, args.headroom, args.min_runs)
+        if suggestion is None:
+            res.setdefault('status', 'too few runs, need {}'.format(args.min_runs))
+            images.append(res)
+            continue
+        suggestion['requests'] = rounded(suggestion['requests'])
+        suggestion['limits'] = rounded(suggestion['limits'])
+        cpu = usage.cpu[key]
+        limits = current['limits']
+        suggestion['cpu_over_limit'] = None
+        if 'cpu' in limits:
+            suggestion['cpu_over_limit'] = sum(1 for v in cpu if v > limits['cpu']) / float(len(cpu))
+        suggestion['oom_runs'] = None
+        if 'memory' in limits:
+            suggestion['oom_runs'] = sum(1 for v in usage.peaks[key] if v > limits['memory'])
+        res.update(suggestion)
+        res.setdefault('status', 'ok')
+        res['cells_per_node'] = {
+            'current': cells_per_node(node, scheduled_requests(current)),
+            'suggested': cells_per_node(node, suggestion['requests']),
+        }
+        images.append(res)
+
+    sized = [res for res in images if res['status'] == 'ok']
+    block = None
+    overrides = []
+    if sized:
+        # the project default covers the largest image, smaller ones get own values
+        block = {
+            kind: {key: max(res[kind][key] for res in sized) for key in ('cpu', 'memory')}
+            for kind in ('limits', 'requests')
+        }
+        by_name = {}
+        for res in sized:
+            for kind in ('limits', 'requests'):
+                one = by_name.setdefault(res['image'], {}).setdefault(kind, {})
+                for key in ('cpu', 'memory'):
+                    one[key] = max(one.get(key, 0), res[kind][key])
+        for name, res in sorted(by_name.items()):
+            if res != block:
+                overrides.append(dict(res, name=name))
+    return {'node': node, 'images': images, 'kubernetes': block, 'runs_on_dockers': overrides,
+            'unmatched': usage.unmatched}
+
+
+def suggested_yaml(report):
+    lines = ['kubernetes:']
+    for kind in ('limits', 'requests'):
+        lines.append('  {}: "{}"'.format(kind, resources_str(report['kubernetes'][kind])))
+    if report['runs_on_dockers']:
+        lines.append('# add to these runs_on_dockers entries')
+        lines.append('runs_on_dockers:')
+        for res in report['runs_on_dockers']:
+            lines.append('  - {{name: {}, limits: "{}", requests: "{}"}}'.format(
+                res['name'], resources_str(res['limits']), resources_str(res['requests'])))
+    return '\n'.join(lines)
+
+
+def print_report(report, out=sys.stdout):
+    node = report['node']
+    print('node: cpu={:g} memory={}'.format(node['cpu'], format_memory(node['memory'])), file=out)
+    for res in report['images']:
+        print('{}/{}: {}'.format(res['arch'], res['image'], res['status']), file=out)
+        if res['status'] != 'ok':
+            continue
+        print('    runs {}, cpu samples {}'.format(res['runs'], res['samples']), file=out)
+        for kind in ('requests', 'limits'):
+            print('    {:8} {} -> {}'.format(kind, resources_str(res['current'][kind]), resources_str(res[kind])), file=out)
+        over = 'no cpu limit' if res['cpu_over_limit'] is None else \
+            'cpu samples over current limit {:.1f}%'.format(res['cpu_over_limit'] * 100)
+        oom = 'no memory limit' if res['oom_runs'] is None else \
+            'runs over memory limit {}'.format(res['oom_runs'])
+        print('    {}, {}'.format(over, oom), file=out)
+        cells = res['cells_per_node']
+        if cells['current'] and cells['suggested'] is not None:
+            gain = (cells['suggested'] - cells['current']) * 100.0 / cells['current']
+            print('    cells per node {} -> {} ({:+.0f}%)'.format(cells['current'], cells['suggested'], gain), file=out)
+    for name, count in sorted(report['unmatched'].items()):
+        print('Warning: {} samples of unknown cell {}'.format(count, name), file=sys.stderr)
+    if report['kubernetes']:
+        print('\n' + suggested_yaml(report), file=out)
+
+
+def parse_node(text):
+    node = {}
+    for item in text.split(','):
+        key, _, value = item.partition('=')
+        key = key.strip()
+        if key == 'cpu':
+            node['cpu'] = parse_cpu(value)
+        elif key == 'memory':
+            node['memory'] = parse_memory(value)
+        else:
+            raise ValueError('Unknown node resource {}, expected cpu=N,memory=Q'.format(key))
+    if set(node) != {'cpu', 'memory'}:
+        raise ValueError('-node needs cpu and memory, got {}'.format(text))
+    return node
+
+
+def main(args):
+    environ = dict(os.environ)
+    for item in args.env:
+        key, _, value = item.partition('=')
+        environ[key] = value
+
+    try:
+        node = parse_node(args.node)
+        config = matrix_planner.read_job_project(args.file)
+        tasks = list(matrix_planner.MatrixPlanner(config, environ).iter_tasks())
+        samples = Usage(tasks)
+        for path in args.samples:
+            samples.load(path)
+        report = plan(config, samples, node, args)
+    except (MatrixError, ValueError) as e:
+        print('Error: {}'.format(e))
+        exit(1)
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+
+
+if __name__ == '__main__':
+    args = usage()
+    main(args)
@@ -0,0 +1,460 @@
+#!/usr/bin/env python3
+"""Where does the wall time of a matrix job go
+
+Reads the console log of a Matrix.groovy run (timestamps {} enabled, as
+saved from consoleText) line by line and rebuilds the timeline from the
+'[Pipeline] { (title)' / '[Pipeline] }' markers: parallel branches (matrix
+cells, 'Setup Image' builds), stages (steps of runSteps(), pipeline
+start/stop) and unstash with its retries. Only open blocks and finished
+spans are kept, so logs of any size are read in one pass; .gz logs are
+read compressed.
+
+Reports the critical path, executor idle time and the slowest steps, and
+writes the timeline as Chrome trace JSON (chrome://tracing, Perfetto).
+JUnit XML and TAP results add test durations; JUnit suites with a
+timestamp are placed on the timeline.
+"""
+import os
+import re
+import sys
+import gzip
+import json
+import heapq
+import argparse
+import datetime
+import xml.etree.ElementTree as ET
+
+TS_ISO = re.compile(r'^\[?(\d{4}-\d\d-\d\d[T ]\d\d:\d\d:\d\d(?:[.,]\d+)?)(Z|[+-]\d\d:?\d\d)?\]?\s?')
+TS_TIME = re.compile(r'^\[?(\d\d):(\d\d):(\d\d(?:\.\d+)?)\]?\s')
+BRANCH_PREFIX = re.compile(r'^\[([^\]]+)\] ')
+BLOCK_OPEN = re.compile(r'^\[Pipeline\] \{(?: \((.*)\))?\s*$')
+BLOCK_CLOSE = re.compile(r'^\[Pipeline\] \}\s*$')
+PIPELINE_STEP = re.compile(r'^\[Pipeline\] (\w+)')
+UNSTASH_RETRY = re.compile(r'Unstash attempt \d+ failed')
+
+# pipeline steps that belong to an unstash with retries
+UNSTASH_STEPS = ('unstash', 'sleep', 'echo')
+
+
+def usage():
+    parser = argparse.ArgumentParser(description='Analyze timing of a ci-demo matrix job from its console log')
+    parser.add_argument('-log', '--log', metavar='filename', required=True, help='Timestamped console log, .gz or - for stdin')
+    parser.add_argument('-results', '--results', metavar='[TASK=]FILE', action='append', default=[],
+                        help='JUnit .xml or .tap results, TASK= assigns them to a matrix cell, can be repeated')
+    parser.add_argument('-trace', '--trace', metavar='filename', help='Write Chrome trace JSON')
+    parser.add_argument('-top', '--top', metavar='N', type=int, default=10, help='Number of slowest steps, default: 10')
+    parser.add_argument('-executors', '--executors', metavar='N', type=int,
+                        help='Executors for idle time, default: peak number of parallel cells')
+    parser.add_argument('-json', '--json', action='store_true', help='Print report as JSON')
+    return parser.parse_args()
+
+
+class Span:
+    __slots__ = ('name', 'cat', 'branch', 'start', 'end', 'parent', 'args')
+
+    def __init__(self, name, cat, branch, start, parent=None):
+        self.name = name
+        self.cat = cat
+        self.branch = branch
+        self.start = start
+        self.end = start
+        self.parent = parent
+        self.args = {}
+
+    @property
+    def duration(self):
+        if self.start is None:
+            return self.args.get('duration', 0.0)
+        return self.end - self.start
+
+
+def category(title, branch):
+    lower = title.lower()
+    if title.startswith('Branch: '):
+        if branch:
+            # parallel steps inside a matrix cell
+            return 'branch'
+        return 'image' if title[8:].startswith('Setup Image') else 'cell'
+    if lower.startswith(('pipeline start', 'pipline start')):
+        return 'pipeline_start'
+    if lower.startswith(('pipeline stop', 'pipline stop')):
+        return 'pipeline_stop'
+    return 'step' if branch else 'stage'
+
+
+class LogParser:
+    """Rebuilds spans from the console log, fed one line at a time"""
+
+    def __init__(self):
+        self.spans = []
+        self.stacks = {}
+        self.branches = {None: None}
+        self.current = None
+        self.parallel_owner = None
+        self.unstash = {}
+        self.now = None
+        self.day = None
+        self.last_time = None
+        self.last_text = None
+
+    def timestamp(self, line):
+        m = TS_ISO.match(line)
+        if m:
+            # consecutive lines mostly share the timestamp
+            if m.group(0) == self.last_text:
+                return self.now, line[m.end():]
+            self.last_text = m.group(0)
+            text = m.group(1).replace(',', '.').replace(' ', 'T')
+            zone = m.group(2) or ''
+            zone = '+00:00' if zone == 'Z' else zone
+            if zone and ':' not in zone:
+                zone = zone[:3] + ':' + zone[3:]
+            if '.' in text:
+                # fromisoformat() takes 3 or 6 digit fractions only
+                head, frac = text.split('.')
+                text = head + '.' + (frac + '000000')[:6]
+            stamp = datetime.datetime.fromisoformat(text + zone)
+            if stamp.tzinfo is None:
+                stamp = stamp.replace(tzinfo=datetime.timezone.utc)
+            return stamp.timestamp(), line[m.end():]
+        m = TS_TIME.match(line)
+        if m:
+            seconds = int(m.group(1)) * 3600 + int(m.group(2)) * 60 + float(m.group(3))
+            if self.day is None:
+                self.day = 0
+            elif seconds < self.last_time - 43200:
+                self.day += 86400
+            self.last_time = seconds
+            return self.day + seconds, line[m.end():]
+        return None, line
+
+    def feed(self, line):
+        stamp, text = self.timestamp(line.rstrip('\n'))
+        if stamp is not None:
+            self.now = stamp
+        if self.now is None:
+            return
+
+        branch = None
+        m = BRANCH_PREFIX.match(text)
+        if m and m.group(1) in self.branches:
+            branch = self.current = m.group(1)
+            text = text[m.end():]
+        elif text.startswith('[Pipeline]') and self.stacks.get(self.current):
+            # markers inside parallel branches are not prefixed by newer
+            # Jenkins, they belong to the branch that printed last
+            branch = self.current
+        stack = self.stacks.setdefault(branch, [])
+
+        if branch in self.unstash and not UNSTASH_RETRY.search(text):
+            m = PIPELINE_STEP.match(text)
+            if m and m.group(1) not in UNSTASH_STEPS:
+                self.unstash.pop(branch).end = self.now
+
+        m = BLOCK_OPEN.match(text)
+        if m:
+            title = m.group(1)
+            if title is None:
+                stack.append(None)
+                return
+            if title.startswith('Branch: '):
+                # sibling branches open one after another, they belong to
+                # the branch that started the parallel step
+                branch = self.parallel_owner
+            parent = self.parent(branch)
+            span = Span(title[8:] if title.startswith('Branch: ') else title, category(title, branch), branch, self.now, parent)
+            if span.cat in ('cell', 'image', 'branch'):
+                # a branch has its own block stack, its output is prefixed with its name
+                self.branches[span.name] = span
+                self.stacks[span.name] = [span]
+                self.current = span.name
+                return
+            stack.append(span)
+            return
+
+        if BLOCK_CLOSE.match(text):
+            if not stack and branch is not None:
+                stack = self.stacks.setdefault(None, [])
+            if stack:
+                span = stack.pop()
+                if span is not None:
+                    span.end = self.now
+                    self.spans.append(span)
+            if branch is not None and not self.stacks[branch]:
+                self.current = None
+            return
+
+        if text.startswith('[Pipeline] parallel'):
+            self.parallel_owner = branch
+        elif text.startswith('[Pipeline] unstash') and branch not in self.unstash:
+            span = Span('unstash', 'unstash', branch, self.now, self.parent(branch))
+            span.args['retries'] = 0
+            self.unstash[branch] = span
+            self.spans.append(span)
+        elif UNSTASH_RETRY.search(text) and branch in self.unstash:
+            self.unstash[branch].args['retries'] += 1
+
+    def parent(self, branch):
+        for span in reversed(self.stacks.get(branch, [])):
+            if span is not None:
+                return span
+        return self.branches.get(branch)
+
+    def close(self):
+        """Blocks still open at the end of the log (aborted job) end at the last timestamp"""
+        for stack in self.stacks.values():
+            for span in stack:
+                if span is not None:
+                    span.end = self.now
+                    span.args['unfinished'] = True
+                    self.spans.append(span)
+        for span in self.unstash.values():
+            span.end = self.now
+        self.stacks = {}
+        self.unstash = {}
+        return self.spans
+
+
+def open_log(path):
+    if path == '-':
+        return sys.stdin
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt', errors='replace')
+    return open(path, errors='replace')
+
+
+def parse_log(path):
+    parser = LogParser()
+    with open_log(path) as fin:
+        for line in fin:
+            parser.feed(line)
+    return parser.close()
+
+
+def load_results(spec, cells):
+    """Test spans from JUnit/TAP, start is None when the file has no timestamps"""
+    task, path = None, spec
+    if not os.path.isfile(spec) and '=' in spec:
+        task, path = spec.split('=', 1)
+    spans = []
+    if path.endswith('.xml'):
+        for suite in ET.parse(path).getroot().iter('testsuite'):
+            start = None
+            if suite.get('timestamp'):
+                stamp = datetime.datetime.fromisoformat(suite.get('timestamp').replace('Z', '+00:00'))
+                if stamp.tzinfo is None:
+                    stamp = stamp.replace(tzinfo=datetime.timezone.utc)
+                start = stamp.timestamp()
+            for case in suite.iter('testcase'):
+                duration = float(case.get('time') or 0)
+                owner = task or case.get('classname') or suite.get('name')
+                span = Span(case.get('name'), 'test', owner if owner in cells else None, start, cells.get(owner))
+                span.end = None if start is None else start + duration
+                span.args['duration'] = duration
+                spans.append(span)
+                if start is not None:
+                    start += duration
+    elif path.endswith('.tap'):
+        point = re.compile(r'^\s*(?:not )?ok\b\s*\d*\s*(?:-\s*)?([^#]*)(?:#\s*time=([\d.]+)(ms|s)?)?')
+        duration_ms = re.compile(r'^\s*duration_ms:\s*([\d.]+)')
+        last = None
+        with open(path) as fin:
+            for line in fin:
+                m = point.match(line)
+                if m:
+                    last = m.group(1).strip()
+                    if m.group(2):
+                        scale = 1.0 if m.group(3) == 's' else 0.001
+                        spans.append(test_span(last, float(m.group(2)) * scale, task, cells))
+                        last = None
+                    continue
+                m = duration_ms.match(line)
+                if m and last is not None:
+                    spans.append(test_span(last, float(m.group(1)) / 1000, task, cells))
+                    last = None
+    else:
+        raise ValueError('Unknown results format of {}, expected .xml or .tap'.format(path))
+    return spans
+
+
+def test_span(name, duration, task, cells):
+    span = Span(name, 'test', task if task in cells else None, None, cells.get(task))
+    span.args['duration'] = duration
+    return span
+
+
+def top_level(spans):
+    return [span for span in spans if span.start is not None and span.parent is None and span.cat != 'test']
+
+
+def critical_path(spans):
+    """Chain of top level spans ending last, each one the latest finishing before the next started"""
+    candidates = sorted(top_level(spans), key=lambda span: span.end)
+    if not candidates:
+        return []
+    path = [candidates[-1]]
+    while True:
+        current = path[-1]
+        before = [span for span in candidates if span.end <= current.start and span is not current]
+        if not before:
+            break
+        path.append(max(before, key=lambda span: (span.end, span.duration)))
+    path.reverse()
+    children = {}
+    for span in spans:
+        if span.parent is not None and span.cat in ('step', 'unstash'):
+            children.setdefault(id(span.parent), []).append(span)
+    res = []
+    for span in path:
+        res.append(span)
+        res.extend(sorted(children.get(id(span), []), key=lambda child: child.start))
+    return res
+
+
+def executor_usage(spans, executors=None):
+    """Peak parallel cells and idle executor time between first and last cell"""
+    cells = [span for span in spans if span.cat in ('cell', 'image') and span.parent is None]
+    if not cells:
+        return {'executors': executors or 0, 'peak_parallel': 0, 'busy': 0.0, 'idle': 0.0, 'utilization': 0.0}
+    events = sorted([(span.start, 1) for span in cells] + [(span.end, -1) for span in cells])
+    running = peak = 0
+    for stamp, delta in events:
+        running += delta
+        peak = max(peak, running)
+    executors = executors or peak
+    window = max(span.end for span in cells) - min(span.start for span in cells)
+    busy = sum(span.duration for span in cells)
+    capacity = executors * window
+    return {
+        'executors': executors,
+        'peak_parallel': peak,
+        'busy': round(busy, 3),
+        'idle': round(max(0.0, capacity - busy), 3),
+        'utilization': round(busy / capacity, 3) if capacity else 0.0,
+    }
+
+
+def assign_lanes(spans):
+    """Thread id per span: parallel branches get their own lane, others inherit"""
+    lanes = {}
+    free_at = []
+    for span in sorted((s for s in spans if s.cat in ('cell', 'image', 'branch')), key=lambda s: s.start):
+        for lane, end in enumerate(free_at):
+            if end <= span.start:
+                free_at[lane] = span.end
+                break
+        else:
+            free_at.append(span.end)
+            lane = len(free_at) - 1
+        lanes[id(span)] = lane + 1
+
+    def lane_of(span):
+        while span is not None:
+            if id(span) in lanes:
+                return lanes[id(span)]
+            span = span.parent
+        return 0
+    return lane_of
+
+
+def chrome_trace(spans):
+    origin = min(span.start for span in spans if span.start is not None)
+    lane_of = assign_lanes(spans)
+    events = []
+    for span in spans:
+        if span.start is None:
+            continue
+        events.append({
+            'name': span.name,
+            'cat': span.cat,
+            'ph': 'X',
+            'ts': round((span.start - origin) * 1e6),
+            'dur': round(span.duration * 1e6),
+            'pid': 1,
+            'tid': lane_of(span),
+            'args': dict(span.args, branch=span.branch),
+        })
+    events.sort(key=lambda event: (event['ts'], -event['dur']))
+    return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+
+def span_info(span):
+    info = {'name': span.name, 'cat': span.cat, 'duration': round(span.duration, 3)}
+    if span.parent is not None:
+        info['cell'] = span.parent.name if span.parent.cat in ('cell', 'image') else span.branch
+    if span.args.get('retries'):
+        info['retries'] = span.args['retries']
+    return info
+
+
+def analyze(spans, top=10, executors=None):
+    timed = [span for span in spans if span.start is not None]
+    path = critical_path(spans)
+    slowest = heapq.nlargest(top, (span for span in spans if span.cat in ('step', 'unstash', 'pipeline_start', 'pipeline_stop')),
+                             key=lambda span: span.duration)
+    tests = heapq.nlargest(top, (span for span in spans if span.cat == 'test'), key=lambda span: span.duration)
+    per_cat = {}
+    for span in spans:
+        stat = per_cat.setdefault(span.cat, [0, 0.0])
+        stat[0] += 1
+        stat[1] += span.duration
+    return {
+        'wall': round(max(s.end for s in timed) - min(s.start for s in timed), 3) if timed else 0.0,
+        'categories': {cat: {'count': count, 'total': round(total, 3)} for cat, (count, total) in sorted(per_cat.items())},
+        'executors': executor_usage(spans, executors),
+        'critical_path': [span_info(span) for span in path],
+        'unstash_retries': sum(span.args.get('retries', 0) for span in spans if span.cat == 'unstash'),
+        'slowest_steps': [span_info(span) for span in slowest],
+        'slowest_tests': [span_info(span) for span in tests],
+    }
+
+
+def print_report(report, out=sys.stdout):
+    usage = report['executors']
+    print('wall time: {:.1f}s'.format(report['wall']), file=out)
+    for cat, stat in report['categories'].items():
+        print('  {:15} {:5} spans {:10.1f}s'.format(cat, stat['count'], stat['total']), file=out)
+    print('executors: {} (peak parallel cells {}), busy {:.1f}s, idle {:.1f}s, utilization {:.0%}'.format(
+        usage['executors'], usage['peak_parallel'], usage['busy'], usage['idle'], usage['utilization']), file=out)
+    if report['unstash_retries']:
+        print('unstash retries: {}'.format(report['unstash_retries']), file=out)
+    print('critical path:', file=out)
+    for info in report['critical_path']:
+        indent = '    ' if info['cat'] in ('step', 'unstash') else '  '
+        print('{}{:10.1f}s {} [{}]'.format(indent, info['duration'], info['name'], info['cat']), file=out)
+    for key, title in (('slowest_steps', 'slowest steps'), ('slowest_tests', 'slowest tests')):
+        if not report[key]:
+            continue
+        print('{}:'.format(title), file=out)
+        for info in report[key]:
+            where = ' ({})'.format(info['cell']) if info.get('cell') else ''
+            print('  {:10.1f}s {}{}'.format(info['duration'], info['name'], where), file=out)
+
+
+def main(args):
+    try:
+        spans = parse_log(args.log)
+        cells = {span.name: span for span in spans if span.cat in ('cell', 'image')}
+        for spec in args.results:
+            spans.extend(load_results(spec, cells))
+    except (OSError, ValueError, ET.ParseError) as e:
+        print('Error: {}'.format(e))
+        exit(1)
+
+    if not any(span.start is not None for span in spans):
+        print('Error: no timestamped pipeline blocks found in {}, is timestamps {{}} enabled?'.format(args.log))
+        exit(1)
+
+    report = analyze(spans, args.top, args.executors)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+    if args.trace:
+        with open(args.trace, 'w') as fout:
+            json.dump(chrome_trace(spans), fout)
+
+
+if __name__ == '__main__':
+    args = usage()
+    main(args)
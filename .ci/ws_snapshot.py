@@ -0,0 +1,331 @@
+#!/usr/bin/env python3
+"""Content-addressed workspace snapshots
+
+Alternative to the scm-repo.tar stash of Matrix.groovy: files of the
+workspace are cut into chunks, every chunk is stored once under its
+sha256 in a chunk store, compressed with zlib. A manifest lists files,
+modes and chunk hashes. Restoring a snapshot only fetches chunks missing
+from the local cache and extracts files in parallel, so cells on the same
+node pay for changed content only.
+
+  create   snapshot a directory into a store, with -base unchanged files
+           (size, mtime) take their chunks from the previous manifest
+  restore  recreate the directory from manifest, store and local cache
+  bench    compare with tar c/x on the same directory
+
+The store is a directory, or for restore also an http(s) URL serving it.
+"""
+import os
+import gzip
+import json
+import stat
+import time
+import zlib
+import shutil
+import fnmatch
+import hashlib
+import argparse
+import tempfile
+import subprocess
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+MANIFEST_VERSION = 1
+CHUNK_SIZE = 4 * 2**20
+
+
+class SnapshotError(Exception):
+    pass
+
+
+def usage():
+    parser = argparse.ArgumentParser(description='Content-addressed workspace snapshots')
+    sub = parser.add_subparsers(dest='action')
+    sub.required = True
+
+    create = sub.add_parser('create', help='Snapshot a directory')
+    create.add_argument('-src', default='.', help='Directory to snapshot, default: current directory')
+    create.add_argument('-store', required=True, help='Chunk store directory')
+    create.add_argument('-manifest', required=True, help='Manifest file to write (.json.gz)')
+    create.add_argument('-base', help='Previous manifest, unchanged files are not read again')
+    create.add_argument('-exclude', action='append', default=[], help='Glob of paths to skip, can be repeated')
+    create.add_argument('-chunk-size', type=int, default=CHUNK_SIZE // 2**20, help='Chunk size in MiB, default: 4')
+    create.add_argument('-level', type=int, default=1, help='zlib compression level, default: 1')
+    create.add_argument('-jobs', type=int, default=os.cpu_count() or 1, help='Worker processes, default: %(default)s')
+
+    restore = sub.add_parser('restore', help='Restore a snapshot')
+    restore.add_argument('-manifest', required=True, help='Manifest file')
+    restore.add_argument('-store', required=True, help='Chunk store directory or http(s) URL')
+    restore.add_argument('-dest', default='.', help='Target directory, default: current directory')
+    restore.add_argument('-cache', help='Local chunk cache directory, default: read from store')
+    restore.add_argument('-jobs', type=int, default=os.cpu_count() or 1, help='Worker threads, default: %(default)s')
+
+    bench = sub.add_parser('bench', help='Compare with tar c/x')
+    bench.add_argument('-src', default='.', help='Directory to snapshot, default: current directory')
+    bench.add_argument('-exclude', action='append', default=[], help='Glob of paths to skip, can be repeated')
+    bench.add_argument('-jobs', type=int, default=os.cpu_count() or 1, help='Worker processes, default: %(default)s')
+    bench.add_argument('-json', action='store_true', help='Print results as JSON')
+    return parser.parse_args()
+
+
+def chunk_path(store, digest):
+    return os.path.join(store, digest[:2], digest)
+
+
+def write_atomic(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp, 'wb') as fout:
+        fout.write(data)
+    os.replace(tmp, path)
+
+
+def excluded(rel, patterns):
+    return any(fnmatch.fnmatch(rel, pattern) or fnmatch.fnmatch(os.path.basename(rel), pattern)
+               for pattern in patterns)
+
+
+def scan(src, exclude):
+    """Entries of src in walk order: (rel, kind, st), kind is dir, file or link"""
+    for root, dirs, files in os.walk(src):
+        rel_root = os.path.relpath(root, src)
+        rel_root = '' if rel_root == '.' else rel_root
+        keep = []
+        for name in sorted(dirs):
+            rel = os.path.join(rel_root, name)
+            if excluded(rel, exclude):
+                continue
+            st = os.lstat(os.path.join(root, name))
+            if stat.S_ISLNK(st.st_mode):
+                yield rel, 'link', st
+            else:
+                keep.append(name)
+                yield rel, 'dir', st
+        dirs[:] = keep
+        for name in sorted(files):
+            rel = os.path.join(rel_root, name)
+            if excluded(rel, exclude):
+                continue
+            st = os.lstat(os.path.join(root, name))
+            if stat.S_ISLNK(st.st_mode):
+                yield rel, 'link', st
+            elif stat.S_ISREG(st.st_mode):
+                yield rel, 'file', st
+
+
+def store_chunk(job):
+    """Hash one chunk and store it compressed unless present: (digest, stored bytes)"""
+    path, offset, length, store, level = job
+    with open(path, 'rb') as fin:
+        fin.seek(offset)
+        data = fin.read(length)
+    digest = hashlib.sha256(data).hexdigest()
+    target = chunk_path(store, digest)
+    if os.path.exists(target):
+        return digest, 0
+    packed = zlib.compress(data, level)
+    write_atomic(target, packed)
+    return digest, len(packed)
+
+
+def load_manifest(path):
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rt') as fin:
+        manifest = json.load(fin)
+    if manifest.get('version') != MANIFEST_VERSION:
+        raise SnapshotError('Unsupported manifest version {} in {}'.format(manifest.get('version'), path))
+    return manifest
+
+
+def save_manifest(path, manifest):
+    opener = gzip.open if path.endswith('.gz') else open
+    tmp = path + '.tmp'
+    with opener(tmp, 'wt') as fout:
+        json.dump(manifest, fout, separators=(',', ':'))
+    os.replace(tmp, path)
+
+
+def create(src, store, manifest_file, base=None, exclude=(), chunk_size=CHUNK_SIZE, level=1, jobs=1):
+    previous = {}
+    if base and os.path.isfile(base):
+        old = load_manifest(base)
+        if old['chunk_size'] == chunk_size:
+            previous = {entry['path']: entry for entry in old['files']}
+
+    manifest = {'version': MANIFEST_VERSION, 'chunk_size': chunk_size, 'dirs': [], 'links': [], 'files': []}
+    work = []
+    stats = {'files': 0, 'bytes': 0, 'reused_files': 0, 'chunks': 0, 'new_chunks': 0, 'stored_bytes': 0}
+    for rel, kind, st in scan(src, exclude):
+        if kind == 'dir':
+            manifest['dirs'].append({'path': rel, 'mode': stat.S_IMODE(st.st_mode)})
+            continue
+        if kind == 'link':
+            manifest['links'].append({'path': rel, 'target': os.readlink(os.path.join(src, rel))})
+            continue
+        entry = {'path': rel, 'mode': stat.S_IMODE(st.st_mode), 'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+        stats['files'] += 1
+        stats['bytes'] += st.st_size
+        old = previous.get(rel)
+        if old and old['size'] == st.st_size and old['mtime_ns'] == st.st_mtime_ns:
+            entry['chunks'] = old['chunks']
+            stats['reused_files'] += 1
+        else:
+            entry['chunks'] = []
+            path = os.path.join(src, rel)
+            for offset in range(0, st.st_size, chunk_size):
+                work.append((len(manifest['files']), (path, offset, min(chunk_size, st.st_size - offset), store, level)))
+        manifest['files'].append(entry)
+
+    if work:
+        os.makedirs(store, exist_ok=True)
+        if jobs > 1 and len(work) > 1:
+            with ProcessPoolExecutor(max_workers=jobs) as pool:
+                done = list(pool.map(store_chunk, [job for idx, job in work], chunksize=32))
+        else:
+            done = [store_chunk(job) for idx, job in work]
+        # work is in file and offset order, so appending keeps chunk order
+        for (idx, job), (digest, stored) in zip(work, done):
+            manifest['files'][idx]['chunks'].append(digest)
+            stats['new_chunks'] += 1 if stored else 0
+            stats['stored_bytes'] += stored
+    stats['chunks'] = sum(len(entry['chunks']) for entry in manifest['files'])
+
+    save_manifest(manifest_file, manifest)
+    return stats
+
+
+class ChunkSource:
+    """Reads chunks from the local cache, fetching missing ones from the store"""
+
+    def __init__(self, store, cache=None):
+        self.store = store.rstrip('/')
+        self.remote = store.startswith(('http://', 'https://'))
+        if self.remote and not cache:
+            raise SnapshotError('-cache is required with a remote store')
+        self.cache = cache
+
+    def fetch(self, digest):
+        """Make the chunk available locally, return fetched bytes"""
+        if not self.cache:
+            return 0
+        target = chunk_path(self.cache, digest)
+        if os.path.exists(target):
+            return 0
+        if self.remote:
+            # imported here, urllib is heavy and only http stores need it
+            import urllib.request
+            with urllib.request.urlopen('{}/{}/{}'.format(self.store, digest[:2], digest)) as response:
+                packed = response.read()
+        else:
+            with open(chunk_path(self.store, digest), 'rb') as fin:
+                packed = fin.read()
+        if hashlib.sha256(zlib.decompress(packed)).hexdigest() != digest:
+            raise SnapshotError('Chunk {} from {} is corrupted'.format(digest, self.store))
+        write_atomic(target, packed)
+        return len(packed)
+
+    def read(self, digest):
+        with open(chunk_path(self.cache or self.store, digest), 'rb') as fin:
+            return zlib.decompress(fin.read())
+
+
+def restore_file(source, dest, entry):
+    path = os.path.join(dest, entry['path'])
+    if os.path.islink(path):
+        os.unlink(path)
+    elif os.path.isdir(path):
+        shutil.rmtree(path)
+    with open(path, 'wb') as fout:
+        for digest in entry['chunks']:
+            fout.write(source.read(digest))
+    os.chmod(path, entry['mode'])
+    os.utime(path, ns=(entry['mtime_ns'], entry['mtime_ns']))
+
+
+def restore(manifest_file, store, dest, cache=None, jobs=1):
+    manifest = load_manifest(manifest_file)
+    source = ChunkSource(store, cache)
+    needed = sorted({digest for entry in manifest['files'] for digest in entry['chunks']})
+
+    os.makedirs(dest, exist_ok=True)
+    for entry in manifest['dirs']:
+        os.makedirs(os.path.join(dest, entry['path']), exist_ok=True)
+
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+        fetched = list(pool.map(source.fetch, needed))
+        list(pool.map(lambda entry: restore_file(source, dest, entry), manifest['files']))
+
+    for entry in manifest['links']:
+        path = os.path.join(dest, entry['path'])
+        if os.path.lexists(path):
+            os.unlink(path)
+        os.symlink(entry['target'], path)
+    for entry in reversed(manifest['dirs']):
+        os.chmod(os.path.join(dest, entry['path']), entry['mode'])
+
+    return {'files': len(manifest['files']), 'chunks': len(needed),
+            'fetched_chunks': sum(1 for size in fetched if size), 'fetched_bytes': sum(fetched)}
+
+
+def timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    res = func(*args, **kwargs)
+    return round(time.perf_counter() - start, 3), res
+
+
+def bench(src, exclude=(), jobs=1):
+    """Stash/unstash cost of tar against snapshots, cold and warm
+
+    tar times do not include the transfer of the archive by stash/unstash,
+    tar_bytes and store_bytes are the amount of data to move on a cold run.
+    """
+    results = {}
+    with tempfile.TemporaryDirectory(prefix='ws-snapshot-bench-') as tmp:
+        tar = os.path.join(tmp, 'scm-repo.tar')
+        tar_cmd = ['tar', '-c', '-f', tar] + ['--exclude={}'.format(pattern) for pattern in exclude] + ['-C', src, '.']
+        results['tar_create'], _ = timed(subprocess.check_call, tar_cmd)
+        out = os.path.join(tmp, 'tar-out')
+        os.makedirs(out)
+        results['tar_extract'], _ = timed(subprocess.check_call, ['tar', 'xf', tar, '-C', out])
+        results['tar_bytes'] = os.path.getsize(tar)
+        shutil.rmtree(out)
+
+        store = os.path.join(tmp, 'store')
+        manifest = os.path.join(tmp, 'manifest.json.gz')
+        results['snapshot_create_cold'], stats = timed(create, src, store, manifest, exclude=exclude, jobs=jobs)
+        results['store_bytes'] = stats['stored_bytes']
+        results['snapshot_create_warm'], _ = timed(create, src, store, manifest + '.2', base=manifest, exclude=exclude, jobs=jobs)
+
+        cache = os.path.join(tmp, 'cache')
+        results['snapshot_restore_cold'], _ = timed(restore, manifest, store, os.path.join(tmp, 'out1'), cache, jobs)
+        results['snapshot_restore_warm'], _ = timed(restore, manifest, store, os.path.join(tmp, 'out2'), cache, jobs)
+        results['files'] = stats['files']
+        results['bytes'] = stats['bytes']
+    return results
+
+
+def main(args):
+    try:
+        if args.action == 'create':
+            stats = create(args.src, args.store, args.manifest, args.base, args.exclude,
+                           args.chunk_size * 2**20, args.level, args.jobs)
+            print('Snapshot {}: {files} files, {bytes} bytes, {reused_files} unchanged, '
+                  '{chunks} chunks, {new_chunks} new ({stored_bytes} bytes stored)'.format(args.manifest, **stats))
+        elif args.action == 'restore':
+            stats = restore(args.manifest, args.store, args.dest, args.cache, args.jobs)
+            print('Restored {files} files from {chunks} chunks, fetched {fetched_chunks} '
+                  '({fetched_bytes} bytes)'.format(**stats))
+        else:
+            results = bench(args.src, args.exclude, args.jobs)
+            if args.json:
+                print(json.dumps(results, indent=2))
+            else:
+                for key, value in results.items():
+                    print('{:24} {}'.format(key, value))
+    except (OSError, ValueError, zlib.error, SnapshotError) as e:
+        print('Error: {}'.format(e))
+        exit(1)
+
+
+if __name__ == '__main__':
+    args = usage()
+    main(args)
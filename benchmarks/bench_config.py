@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+"""Benchmark ci-demo config processing on synthetic project files
+
+Stages:
+  parse              yaml.safe_load of the project file
+  load_cached        .ci/project_loader.py load from a warm parse cache
+  resolve_template   image uri/url resolution of .ci/cidemo-k8.py
+  generate_pod_yaml  .ci/cidemo-k8.py pod generation for every image
+  matrix_expand      .ci/matrix_planner.py task list
+  validate           yamale validation against ci_demo_schema.yaml
+
+Every stage runs in a fresh interpreter and reports best wall time of
+-repeat runs, peak RSS of the process and tracemalloc peak/blocks of one
+extra traced run. Results are JSON; with -baseline they are compared to
+an earlier result file and the run fails on regressions.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import resource
+import tempfile
+import tracemalloc
+import importlib.util
+import multiprocessing
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import synthetic  # noqa: E402
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CI_DIR = os.path.join(REPO_ROOT, '.ci')
+SCHEMA_FILE = os.path.join(REPO_ROOT, 'schema_validator', 'ci_demo_schema.yaml')
+
+SCENARIOS = {
+    'small': dict(axes=2, values=3, dockers=2, volumes=2, steps=5, arches=1),
+    'medium': dict(axes=3, values=5, dockers=8, volumes=10, steps=25, arches=2),
+    'large': dict(axes=4, values=8, dockers=20, volumes=40, steps=100, arches=3),
+}
+
+STAGES = ['parse', 'load_cached', 'resolve_template', 'generate_pod_yaml', 'matrix_expand', 'validate']
+
+# metrics compared against the baseline
+COMPARED = ['wall_ms', 'alloc_peak_kib']
+
+
+def usage():
+    parser = argparse.ArgumentParser(description='Benchmark ci-demo config processing')
+    parser.add_argument('-scenario', action='append', choices=sorted(SCENARIOS),
+                        help='Scenario to run, can be repeated, default: all')
+    parser.add_argument('-stage', action='append', choices=STAGES,
+                        help='Stage to run, can be repeated, default: all')
+    parser.add_argument('-repeat', type=int, default=5, help='Timed runs per stage, default: 5')
+    parser.add_argument('-out', metavar='filename', type=str, help='Write results JSON to file, default: stdout')
+    parser.add_argument('-baseline', metavar='filename', type=str, help='Compare results with baseline JSON')
+    parser.add_argument('-tolerance', type=float, default=25.0,
+                        help='Allowed regression against baseline in percent, default: 25')
+    return parser.parse_args()
+
+
+def load_cidemo_k8():
+    # cidemo-k8.py is not importable by name, its imports are
+    sys.path.insert(0, CI_DIR)
+    spec = importlib.util.spec_from_file_location('cidemo_k8', os.path.join(CI_DIR, 'cidemo-k8.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def prepare(stage, path):
+    """Return a callable running the stage once, setup cost excluded"""
+    import yaml
+
+    if stage == 'parse':
+        def run():
+            with open(path) as in_file:
+                return yaml.safe_load(in_file)
+        return run
+
+    if stage == 'load_cached':
+        sys.path.insert(0, CI_DIR)
+        import project_loader
+
+        project_loader.load(path)
+
+        def run():
+            return project_loader.load(path)
+        return run
+
+    if stage in ('resolve_template', 'generate_pod_yaml'):
+        k8 = load_cidemo_k8()
+        config = k8.read_job_project(path)
+
+        if stage == 'resolve_template':
+            def run():
+                res = []
+                for image in config['runs_on_dockers']:
+                    image = dict(image)
+                    uri = image.get('uri', image['arch'] + "/" + image['name'])
+                    url = image.get('url', config['registry_host'] + config['registry_path'] + "/" + uri + ":" + image['tag'])
+                    res.append((k8.resolve_template(uri, config, image), k8.resolve_template(url, config, image)))
+                return res
+            return run
+
+        def run():
+            for image in config['runs_on_dockers']:
+                args = argparse.Namespace(file=path, out=os.devnull, image_name=image['name'],
+                                          arch=image['arch'], tag='latest')
+                k8.generate_pod_yaml(args)
+        return run
+
+    if stage == 'matrix_expand':
+        sys.path.insert(0, CI_DIR)
+        import matrix_planner
+
+        def run():
+            planner = matrix_planner.MatrixPlanner(matrix_planner.read_job_project(path), {})
+            return sum(1 for _ in planner.iter_tasks())
+        return run
+
+    if stage == 'validate':
+        import yamale
+
+        def run():
+            schema = yamale.make_schema(SCHEMA_FILE)
+            data = yamale.make_data(path)
+            return yamale.validate(schema, data)
+        return run
+
+    raise ValueError('Unknown stage {}'.format(stage))
+
+
+def run_stage(stage, path, repeat):
+    """Runs in a fresh process, so ru_maxrss belongs to this stage only"""
+    try:
+        run = prepare(stage, path)
+    except ImportError as e:
+        return {'skipped': str(e)}
+
+    run()  # warm up
+    times = []
+    for _ in range(max(1, repeat)):
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    result = run()
+    current, peak = tracemalloc.get_traced_memory()
+    blocks = sum(stat.count for stat in tracemalloc.take_snapshot().statistics('filename'))
+    tracemalloc.stop()
+    del result
+
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        rss //= 1024
+    return {
+        'wall_ms': round(min(times) * 1000, 3),
+        'wall_ms_median': round(sorted(times)[len(times) // 2] * 1000, 3),
+        'peak_rss_kib': rss,
+        'alloc_peak_kib': round(peak / 1024, 1),
+        'alloc_blocks': blocks,
+    }
+
+
+def run_benchmarks(scenarios, stages, repeat):
+    ctx = multiprocessing.get_context('spawn')
+    results = {
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'scenarios': {},
+    }
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # parse cache of the tools, inherited by the stage processes
+        os.environ['CI_DEMO_YAML_CACHE'] = os.path.join(tmp_dir, 'yaml-cache')
+        for name in scenarios:
+            params = SCENARIOS[name]
+            path = synthetic.write_job_matrix(os.path.join(tmp_dir, name + '.yaml'), **params)
+            scenario = {'params': params, 'stages': {}}
+            for stage in stages:
+                with ctx.Pool(1) as pool:
+                    scenario['stages'][stage] = pool.apply(run_stage, (stage, path, repeat))
+                print('{:8} {:18} {}'.format(name, stage, scenario['stages'][stage]), file=sys.stderr)
+            results['scenarios'][name] = scenario
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Return list of regressions against baseline"""
+    regressions = []
+    for name, scenario in results['scenarios'].items():
+        base_scenario = baseline.get('scenarios', {}).get(name)
+        if not base_scenario or base_scenario.get('params') != scenario['params']:
+            continue
+        for stage, metrics in scenario['stages'].items():
+            base = base_scenario['stages'].get(stage, {})
+            for metric in COMPARED:
+                if metric not in metrics or not base.get(metric):
+                    continue
+                change = (metrics[metric] - base[metric]) * 100.0 / base[metric]
+                if change > tolerance:
+                    regressions.append('{}/{} {}: {} -> {} (+{:.1f}%)'.format(
+                        name, stage, metric, base[metric], metrics[metric], change))
+    return regressions
+
+
+def main(args):
+    scenarios = args.scenario or list(SCENARIOS)
+    stages = args.stage or STAGES
+    results = run_benchmarks(scenarios, stages, args.repeat)
+
+    if args.out:
+        with open(args.out, 'w') as fout:
+            json.dump(results, fout, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+
+    if args.baseline:
+        with open(args.baseline) as fin:
+            baseline = json.load(fin)
+        regressions = compare(results, baseline, args.tolerance)
+        for line in regressions:
+            print('REGRESSION: ' + line, file=sys.stderr)
+        if regressions:
+            exit(1)
+        print('No regressions against {}'.format(args.baseline), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    args = usage()
+    main(args)
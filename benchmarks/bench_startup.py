@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+"""Startup time of the ci-demo CLI commands against import budgets
+
+Runs `python -X importtime .ci/cidemo.py <command> -h` (or a zipapp built
+by `cidemo.py zipapp`) in fresh interpreters and reports per command:
+
+  wall_ms     best wall time of -repeat runs
+  import_ms   time spent importing modules after interpreter startup
+              (everything after `site`), best of -repeat runs
+  modules     number of modules the command imports
+  heaviest    top level imports with the largest cumulative time
+
+A command fails when import_ms exceeds its budget in BUDGETS_MS (times
+-scale) or when the bare dispatcher imports any of DISPATCH_FORBIDDEN.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import subprocess
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CLI = os.path.join(REPO_ROOT, '.ci', 'cidemo.py')
+
+# import time budgets in ms, dispatcher is `cidemo.py -h` alone
+BUDGETS_MS = {
+    'dispatcher': 5,
+    'nexus': 120,
+    'pod': 40,
+    'validate': 60,
+    'plan': 40,
+    'impact': 60,
+    'run': 60,
+    'schedule': 60,
+    'size': 60,
+    'image-hash': 60,
+    'timing': 25,
+    'snapshot': 40,
+}
+
+# heavy modules the dispatcher must leave to the commands
+DISPATCH_FORBIDDEN = ('yaml', 'yamale', 'requests', 'multiprocessing', 'concurrent')
+
+
+def usage():
+    parser = argparse.ArgumentParser(description='Benchmark startup time of the ci-demo CLI commands')
+    parser.add_argument('-command', action='append', choices=sorted(BUDGETS_MS),
+                        help='Command to run, can be repeated, default: all')
+    parser.add_argument('-zipapp', metavar='filename', help='Benchmark this zipapp instead of .ci/cidemo.py')
+    parser.add_argument('-repeat', type=int, default=5, help='Runs per command, default: 5')
+    parser.add_argument('-scale', type=float, default=1.0, help='Multiply budgets, e.g. 2 on slow machines, default: 1')
+    parser.add_argument('-top', type=int, default=5, help='Number of heaviest imports to report, default: 5')
+    parser.add_argument('-out', metavar='filename', type=str, help='Write results JSON to file, default: stdout')
+    return parser.parse_args()
+
+
+def parse_importtime(text):
+    """[(self_us, cumulative_us, depth, name)] of the imports after site"""
+    entries = []
+    for line in text.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        fields = line[len('import time:'):].split('|')
+        if len(fields) != 3:
+            continue
+        name = fields[2].rstrip()
+        depth = (len(name) - len(name.lstrip())) // 2
+        entries.append((int(fields[0]), int(fields[1]), depth, name.strip()))
+    # imports are listed after their children, 'site' closes the startup
+    for idx, entry in enumerate(entries):
+        if entry[2] == 0 and entry[3] == 'site':
+            return entries[idx + 1:]
+    return entries
+
+
+def run_command(cli, command, repeat, top):
+    argv = [sys.executable, '-X', 'importtime', cli] + ([] if command == 'dispatcher' else [command]) + ['-h']
+    walls = []
+    imports = []
+    entries = []
+    for _ in range(max(1, repeat)):
+        start = time.perf_counter()
+        res = subprocess.run(argv, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, cwd=REPO_ROOT)
+        walls.append(time.perf_counter() - start)
+        if res.returncode:
+            return {'error': res.stderr.decode(errors='replace').strip().splitlines()[-1:]}
+        parsed = parse_importtime(res.stderr.decode(errors='replace'))
+        total = sum(entry[0] for entry in parsed)
+        if not imports or total < min(imports):
+            entries = parsed
+        imports.append(total)
+    heaviest = sorted((entry for entry in entries if entry[2] == 0), key=lambda entry: -entry[1])[:top]
+    return {
+        'wall_ms': round(min(walls) * 1000, 1),
+        'import_ms': round(min(imports) / 1000.0, 1),
+        'modules': len(entries),
+        'heaviest': [[name, round(cumulative / 1000.0, 1)] for _, cumulative, _, name in heaviest],
+        'imported': sorted(set(entry[3] for entry in entries)),
+    }
+
+
+def check(command, res, scale):
+    """List of budget violations of one command"""
+    if 'error' in res:
+        return ['{}: failed: {}'.format(command, res['error'])]
+    problems = []
+    budget = BUDGETS_MS[command] * scale
+    if res['import_ms'] > budget:
+        problems.append('{}: imports take {} ms, budget {:g} ms'.format(command, res['import_ms'], budget))
+    if command == 'dispatcher':
+        heavy = sorted(name for name in res['imported'] if name.split('.')[0] in DISPATCH_FORBIDDEN)
+        if heavy:
+            problems.append('dispatcher imports {}'.format(', '.join(heavy)))
+    return problems
+
+
+def main(args):
+    cli = args.zipapp or CLI
+    commands = args.command or list(BUDGETS_MS)
+    results = {
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'cli': os.path.relpath(cli, REPO_ROOT) if not args.zipapp else args.zipapp,
+        'commands': {},
+    }
+    problems = []
+    for command in commands:
+        res = run_command(cli, command, args.repeat, args.top)
+        problems.extend(check(command, res, args.scale))
+        res.pop('imported', None)
+        results['commands'][command] = res
+        print('{:12} {}'.format(command, res), file=sys.stderr)
+
+    if args.out:
+        with open(args.out, 'w') as fout:
+            json.dump(results, fout, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+
+    for line in problems:
+        print('OVER BUDGET: ' + line, file=sys.stderr)
+    if problems:
+        exit(1)
+    print('All commands within budget', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    args = usage()
+    main(args)
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""Generate synthetic ci-demo project files for benchmarks
+
+The generated files are valid against schema_validator/ci_demo_schema.yaml
+and scale in the dimensions config processing cost depends on.
+"""
+import argparse
+
+import yaml
+
+ARCHES = ['x86_64', 'aarch64', 'ppc64le']
+
+
+def job_matrix(axes=2, values=3, dockers=2, volumes=2, steps=5, arches=1, env=5):
+    """Return a project file as dict
+
+    axes/values: matrix axes besides 'arch' and values per axis,
+    dockers: runs_on_dockers entries per arch, volumes: host volumes,
+    steps: steps, every 5th one with a containerSelector, arches: values
+    of the 'arch' axis, env: entries in 'env'.
+    """
+    arch_list = ARCHES[:max(1, min(arches, len(ARCHES)))]
+
+    config = {
+        'job': 'bench',
+        'registry_host': 'harbor.example.com',
+        'registry_path': '/bench/${job}',
+        'registry_auth': 'bench-auth',
+        'kubernetes': {
+            'cloud': 'bench-k8s',
+            'namespace': 'bench',
+            'limits': '{memory: 8Gi, cpu: 4000m}',
+            'requests': '{memory: 4Gi, cpu: 2000m}',
+        },
+        'env': {'BENCH_VAR_{}'.format(i): 'value-{}'.format(i) for i in range(env)},
+        'volumes': [
+            {'mountPath': '/mnt/vol{}'.format(i), 'hostPath': '/data/vol{}'.format(i)}
+            for i in range(volumes)
+        ],
+        'runs_on_dockers': [
+            {'file': '.ci/Dockerfile.bench{}'.format(i), 'name': 'bench-image-{}'.format(i),
+             'arch': arch, 'tag': '${BENCH_VAR_0}', 'uri': '$arch/$name'}
+            for arch in arch_list
+            for i in range(dockers)
+        ],
+        'matrix': {
+            'axes': dict([('arch', arch_list)] + [
+                ('axis{}'.format(i), ['value{}'.format(j) for j in range(values)])
+                for i in range(axes)
+            ]),
+        },
+        'steps': [],
+    }
+
+    for i in range(steps):
+        step = {'name': 'step {}'.format(i), 'run': 'echo step {} $axis0 ${{BENCH_VAR_1}}\nmake -j check'.format(i)}
+        if i % 5 == 4:
+            step['containerSelector'] = "{{name: 'bench-image-{}'}}".format(i % max(1, dockers))
+        config['steps'].append(step)
+
+    return config
+
+
+def write_job_matrix(path, **params):
+    with open(path, 'w') as out:
+        yaml.safe_dump(job_matrix(**params), out, default_flow_style=False, sort_keys=False)
+    return path
+
+
+def usage():
+    parser = argparse.ArgumentParser(description='Generate synthetic job_matrix.yaml')
+    parser.add_argument('-out', metavar='filename', type=str, help='Output file, default: stdout', required=False)
+    parser.add_argument('-axes', type=int, default=2, help='Number of matrix axes besides arch')
+    parser.add_argument('-values', type=int, default=3, help='Values per axis')
+    parser.add_argument('-dockers', type=int, default=2, help='runs_on_dockers entries per arch')
+    parser.add_argument('-volumes', type=int, default=2, help='Number of volumes')
+    parser.add_argument('-steps', type=int, default=5, help='Number of steps')
+    parser.add_argument('-arches', type=int, default=1, help='Number of arches (max {})'.format(len(ARCHES)))
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = usage()
+    params = dict(axes=args.axes, values=args.values, dockers=args.dockers,
+                  volumes=args.volumes, steps=args.steps, arches=args.arches)
+    if args.out:
+        write_job_matrix(args.out, **params)
+    else:
+        print(yaml.safe_dump(job_matrix(**params), default_flow_style=False, sort_keys=False))
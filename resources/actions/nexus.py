@@ -6,36 +6,180 @@ __version__ = '1.0'
 import requests
 import json
 import argparse
+import copy
+import fnmatch
+import glob
+import hashlib
+import heapq
+import mmap
+import os
+import random
+import shutil
 import sys
+import threading
+import time
 import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+from requests.adapters import HTTPAdapter
 from urllib.parse import urljoin
 
-logging.basicConfig(
-    level=logging.INFO,
-    format='[%(asctime)s] %(levelname)s '
-           '[%(name)s.%(funcName)s:%(lineno)d] '
-           '%(message)s',
-    datefmt='%d/%b/%Y %H:%M:%S',
-    stream=sys.stdout)
+# File patterns picked up when a directory is passed to --file
+UPLOAD_PATTERNS = {
+    'yum': '*.rpm',
+    'apt': '*.deb',
+}
+
+
+# Files of at least this size are hashed through mmap
+MMAP_THRESHOLD = 64 * 2**20
+
+# Downloads are read and written in blocks of this size
+DOWNLOAD_BLOCK = 2**20
+
+
+class NexusError(Exception):
+    def __init__(self, message, response=None):
+        super().__init__(message)
+        self.response = response
 
 
 def usage():
-    parser = argparse.ArgumentParser(description='Manage NEXUS 3 repositories')
+    conn_parser = argparse.ArgumentParser(add_help=False)
+    conn_parser.add_argument(
+                             '-u', '--url', type=str, required=True,
+                             help='Nexus 3 repository URL.'
+                                  'Example: http://swx-repos.mtr.labs.mlnx'
+                            )
+    conn_parser.add_argument('-U', '--user', type=str, required=True,
+                             help='Nexus 3 API username')
+    conn_parser.add_argument('-P', '--password', type=str, required=True,
+                             help='Nexus 3 API password')
+    conn_parser.add_argument(
+                             '-j', '--jobs', type=int, default=4,
+                             help='Number of parallel uploads and batch '
+                                  'operations (default: 4)'
+                            )
+    conn_parser.add_argument(
+                             '--retries', type=int, default=3,
+                             help='Number of retries for failed API calls '
+                                  'and uploads (default: 3)'
+                            )
+    conn_parser.add_argument(
+                             '--timeout', type=int, default=300,
+                             help='Read timeout in seconds for API calls '
+                                  'and uploads (default: 300)'
+                            )
+    conn_parser.add_argument(
+                             '--repo-cache', dest='repo_cache', type=str,
+                             help='Cache the repository listing in this file'
+                            )
+    conn_parser.add_argument(
+                             '--repo-cache-ttl', dest='repo_cache_ttl',
+                             type=int, default=60,
+                             help='Seconds a cached repository listing is '
+                                  'used without revalidation (default: 60)'
+                            )
+    conn_parser.add_argument(
+                             '--metrics-file', dest='metrics_file', type=str,
+                             help='Write Prometheus metrics of the run to '
+                                  'this file (node_exporter textfile '
+                                  'collector format), the recommended way '
+                                  'to collect metrics of a run'
+                            )
+    conn_parser.add_argument(
+                             '--metrics-port', dest='metrics_port', type=int,
+                             help='Serve Prometheus metrics on this local '
+                                  'port while running. It closes when the '
+                                  'process exits, so only useful for long '
+                                  'batch or mirror runs'
+                            )
+
+    parser = argparse.ArgumentParser(description='Manage NEXUS 3 repositories',
+                                     parents=[conn_parser])
     parser.add_argument('-n', '--name', type=str, required=True,
                         help='Set repository name')
+
+    # Upload options shared by all repository types
+    parser.add_argument(
+                        '-f', '--file', type=str, nargs='+',
+                        help='Select files to upload (files, directories '
+                             'or glob patterns)'
+                       )
+    parser.add_argument(
+                        '--state-file', dest='state_file', type=str,
+                        help='Keep track of uploaded files in this file, '
+                             'a rerun skips files that are already uploaded'
+                       )
+    parser.add_argument(
+                        '--skip-existing', dest='skip_existing',
+                        action='store_true',
+                        help='Skip files whose checksum already exists '
+                             'in the repository'
+                       )
+    parser.add_argument(
+                        '--dry-run', dest='dry_run', action='store_true',
+                        help='Only report what would be uploaded '
+                             'and skipped, pruned or downloaded'
+                       )
+    parser.add_argument(
+                        '--checksum', type=str, choices=['sha256', 'sha1'],
+                        default='sha256',
+                        help='Checksum used by --skip-existing '
+                             '(default: sha256)'
+                       )
+    parser.add_argument(
+                        '--asset-cache', dest='asset_cache', type=str,
+                        help='Check --skip-existing against an asset index '
+                             'of the repository cached in this file instead '
+                             'of searching for every file'
+                       )
+
+    # Prune options shared by all repository types
+    parser.add_argument(
+                        '--keep-last', dest='keep_last', type=int,
+                        help='Prune all but the N most recent components '
+                             'of every package'
+                       )
+    parser.add_argument(
+                        '--older-than', dest='older_than', type=float,
+                        help='Prune components older than DAYS, together '
+                             'with --keep-last only the ones beyond the '
+                             'N most recent'
+                       )
     parser.add_argument(
-                        '-u', '--url', type=str, required=True,
-                        help='Nexus 3 repository URL.'
-                             'Example: http://swx-repos.mtr.labs.mlnx'
+                        '--rate', type=float, default=10,
+                        help='Maximum number of component deletes per '
+                             'second (default: 10, 0: unlimited)'
+                       )
+
+    # Download options shared by all repository types
+    parser.add_argument(
+                        '-o', '--output', type=str,
+                        help='Directory assets are downloaded to, '
+                             'in their repository layout'
+                       )
+    parser.add_argument(
+                        '--match', type=str, nargs='+',
+                        help='Download only assets whose path matches one '
+                             'of these glob patterns'
+                       )
+    parser.add_argument(
+                        '--download-cache', dest='download_cache', type=str,
+                        help='Content-addressed cache of downloaded assets, '
+                             'may be shared by parallel jobs'
+                       )
+    parser.add_argument(
+                        '--part-size', dest='part_size', type=int,
+                        default=32,
+                        help='Download files larger than this many MiB '
+                             'as parallel range requests (default: 32)'
                        )
-    parser.add_argument('-U', '--user', type=str, required=True,
-                        help='Nexus 3 API username')
-    parser.add_argument('-P', '--password', type=str, required=True,
-                        help='Nexus 3 API password')
 
     main_parser = argparse.ArgumentParser()
 
-    subparsers = main_parser.add_subparsers(help='Nexus repository type',
+    subparsers = main_parser.add_subparsers(help='Nexus repository type '
+                                                 'or batch mode',
                                             dest='repo_type')
     subparsers.required = True
 
@@ -61,11 +205,13 @@ def usage():
                                                   'delete',
                                                   'create',
                                                   'show',
-                                                  'upload'
+                                                  'upload',
+                                                  'prune',
+                                                  'download',
+                                                  'mirror'
                                                  ],
                        default='show', help='Action to execute (default: show)'
                       )
-    p_yum.add_argument('-f', '--file', type=str, help='Select file to upload')
     p_yum.add_argument(
                        '-p', '--upload_path', type=str,
                        help='Path to upload package (Example: /7/x86_64/)'
@@ -79,7 +225,10 @@ def usage():
                                                   'delete',
                                                   'create',
                                                   'show',
-                                                  'upload'
+                                                  'upload',
+                                                  'prune',
+                                                  'download',
+                                                  'mirror'
                                                  ],
                        default='show',
                        help='Action to execute (default: show)'
@@ -101,7 +250,6 @@ def usage():
                       )
     p_apt.add_argument('--passphrase', type=str,
                        help='Passphrase to access PGP signing key')
-    p_apt.add_argument('-f', '--file', type=str, help='Select file to upload')
 
     p_apt_group = p_apt.add_mutually_exclusive_group()
     p_apt_group.add_argument(
@@ -115,6 +263,18 @@ def usage():
                              help='Read PGP signing key pair from a file'
                             )
 
+    # Batch subparser
+    p_batch = subparsers.add_parser('batch', parents=[conn_parser],
+                                    help='Run operations from a manifest')
+    p_batch.add_argument(
+                         '-m', '--manifest', type=str, required=True,
+                         help='YAML/JSON manifest with the operations to run'
+                        )
+    p_batch.add_argument(
+                         '-r', '--report', type=str,
+                         help='Write JSON report to a file (default: stdout)'
+                        )
+
     args = main_parser.parse_args()
 
     if args.repo_type == 'apt':
@@ -133,285 +293,1707 @@ def usage():
     return main_parser, args
 
 
-def delete_repository(url, name, user, password):
+class Metrics:
+    """Prometheus metrics of Nexus API calls and transfers
 
-    api_url = urljoin(url, f'service/rest/v1/repositories/{name}')
+    A small thread safe registry of counters, gauges and histograms,
+    rendered in the Prometheus text exposition format. Only used with
+    --metrics-file or --metrics-port, so the script keeps working
+    without a Prometheus client library.
 
-    response = requests.delete(
-                               api_url,
-                               auth=requests.auth.HTTPBasicAuth(user, password)
-                              )
+    --metrics-file, picked up by the node_exporter textfile collector, is
+    the main path: the exporter of --metrics-port lives only as long as
+    the process, so a scrape interval usually misses short operations.
+    """
 
-    if response.status_code == 204:
-        logging.info(f'Repository has been deleted: {name}')
-        return 0
-    elif response.status_code == 404:
-        logging.error(f'Repository not found: {name}')
-    elif response.status_code == 403:
-        logging.error(f'Insufficient permissions to delete repository: {name}')
-    else:
-        logging.error('Unable to delete repository')
-    logging.error(response.content)
-    sys.exit(1)
+    BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60,
+               120, 300, 600)
+
+    HELP = {
+        'nexus_request_duration_seconds': (
+            'histogram', 'Duration of Nexus API calls including retries'),
+        'nexus_request_retries_total': (
+            'counter', 'Retried Nexus API call attempts'),
+        'nexus_transfer_bytes_total': (
+            'counter', 'Bytes uploaded to or downloaded from Nexus'),
+        'nexus_transfer_seconds_total': (
+            'counter', 'Seconds spent in uploads and downloads'),
+        'nexus_transfer_files_total': (
+            'counter', 'Files uploaded to or downloaded from Nexus'),
+        'nexus_transfer_failures_total': (
+            'counter', 'Failed uploads and downloads'),
+        'nexus_transfer_throughput_bytes_per_second': (
+            'gauge', 'Throughput of the last upload or download'),
+        'nexus_operation_duration_seconds': (
+            'histogram', 'Duration of create/upload/show/prune/download/'
+                         'delete operations'),
+    }
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = {name: {} for name in self.HELP}
+        self.server = None
+
+    @staticmethod
+    def _key(labels):
+        return tuple(sorted((key, str(value))
+                            for key, value in labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[name][key] = self.values[name].get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.values[name][self._key(labels)] = value
+
+    def observe(self, name, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            # cumulative bucket counts, then sum and count
+            series = self.values[name].setdefault(
+                                            key,
+                                            [0] * (len(self.BUCKETS) + 2)
+                                           )
+            for i, bound in enumerate(self.BUCKETS):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    @staticmethod
+    def _escape(value):
+        return (value.replace('\\', '\\\\').replace('"', '\\"')
+                .replace('\n', '\\n'))
+
+    def _labels(self, key, extra=()):
+        pairs = list(key) + list(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{name}="{self._escape(value)}"'
+                              for name, value in pairs) + '}'
+
+    def render(self):
+        lines = []
+        with self.lock:
+            for name, (kind, text) in self.HELP.items():
+                lines.append(f'# HELP {name} {text}')
+                lines.append(f'# TYPE {name} {kind}')
+                for key, value in sorted(self.values[name].items()):
+                    if kind != 'histogram':
+                        lines.append(f'{name}{self._labels(key)} {value}')
+                        continue
+                    for bound, count in zip(self.BUCKETS, value):
+                        bucket = self._labels(key, [('le', str(bound))])
+                        lines.append(f'{name}_bucket{bucket} {count}')
+                    bucket = self._labels(key, [('le', '+Inf')])
+                    lines.append(f'{name}_bucket{bucket} {value[-1]}')
+                    lines.append(f'{name}_sum{self._labels(key)} '
+                                 f'{value[-2]}')
+                    lines.append(f'{name}_count{self._labels(key)} '
+                                 f'{value[-1]}')
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        # node_exporter may read the file any time, replace it atomically
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as metrics_file:
+            metrics_file.write(self.render())
+        os.replace(tmp_path, path)
+
+    def serve(self, port, host='127.0.0.1'):
+        # Only --metrics-port runs pay for importing the HTTP server
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type',
+                                 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        thread = threading.Thread(target=self.server.serve_forever,
+                                  daemon=True)
+        thread.start()
+        logging.info(f'Serving metrics on http://{host}:{port}/metrics')
+
+    def close(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+
+class NexusClient:
+    """Nexus 3 REST API client
+
+    Keeps a single keep-alive session for all calls, applies timeouts and
+    retries transient failures (5xx, connection resets) with jittered
+    exponential backoff. Unexpected responses raise NexusError, so the
+    client can be used as a library from release scripts:
+
+        with NexusClient(url, user, password) as nexus:
+            nexus.create_yum_repo('my-repo')
+            nexus.upload_yum('my-repo', 'pkg.rpm', upload_path='7/x86_64')
+    """
+
+    RETRY_STATUS = (500, 502, 503, 504)
+
+    def __init__(self, url, user=None, password=None, timeout=(10, 300),
+                 retries=3, backoff=1.0, pool_size=10, metrics=None):
+        self.url = url if url.endswith('/') else url + '/'
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.metrics = metrics
+        self.labels = {'repo_type': '', 'action': ''}
+
+        self.session = requests.Session()
+        if user is not None and password is not None:
+            self.session.auth = requests.auth.HTTPBasicAuth(user, password)
+
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.session.close()
+
+    def bind(self, **labels):
+        """Client sharing this one's session, with metrics labels set"""
+        client = copy.copy(self)
+        client.labels = dict(self.labels, **labels)
+        return client
 
+    def record_transfer(self, direction, name, size, seconds, failed=False):
+        if self.metrics is None:
+            return
+        labels = dict(self.labels, direction=direction, repository=name)
+        if failed:
+            self.metrics.inc('nexus_transfer_failures_total', **labels)
+            return
+        self.metrics.inc('nexus_transfer_bytes_total', size, **labels)
+        self.metrics.inc('nexus_transfer_seconds_total', seconds, **labels)
+        self.metrics.inc('nexus_transfer_files_total', **labels)
+        self.metrics.set('nexus_transfer_throughput_bytes_per_second',
+                         _rate(size, seconds) * 2**20, **labels)
 
-def get_repositories(url):
-    api_url = urljoin(url, 'service/rest/v1/repositories')
-    response = requests.get(api_url)
-    if response.status_code == 200:
+    def _sleep(self, attempt):
+        # "Full jitter" backoff to spread retries of parallel workers
+        time.sleep(random.uniform(0, self.backoff * 2 ** attempt))
+
+    def request(self, method, path, call=None, **kwargs):
+        """Send a request, retrying transient failures
+
+        call names the API call (list, get, create, ...) in metrics.
+        """
+        if self.metrics is None:
+            return self._request(method, path, **kwargs)
+        labels = dict(self.labels, call=call or method.lower())
+        start = time.monotonic()
+        status = 'error'
+        try:
+            response = self._request(method, path, labels, **kwargs)
+            status = response.status_code
+            return response
+        finally:
+            self.metrics.observe('nexus_request_duration_seconds',
+                                 time.monotonic() - start, status=status,
+                                 **labels)
+
+    def _request(self, method, path, labels=None, **kwargs):
+        api_url = urljoin(self.url, path)
+        kwargs.setdefault('timeout', self.timeout)
+
+        # Streamed bodies have to be rewound before they are sent again
+        data = kwargs.get('data')
+        offset = data.tell() if hasattr(data, 'seek') else None
+
+        for attempt in range(self.retries + 1):
+            if offset is not None:
+                data.seek(offset)
+            try:
+                response = self.session.request(method, api_url, **kwargs)
+            except (requests.exceptions.ConnectionError,
+                    requests.exceptions.Timeout) as e:
+                if attempt == self.retries:
+                    raise NexusError(f'{method} {api_url} failed: {e}')
+                logging.warning(f'{method} {api_url} failed ({e}), retrying')
+            else:
+                if (response.status_code not in self.RETRY_STATUS or
+                        attempt == self.retries):
+                    return response
+                logging.warning(
+                                f'{method} {api_url} returned '
+                                f'{response.status_code}, retrying'
+                               )
+            if labels is not None:
+                self.metrics.inc('nexus_request_retries_total', **labels)
+            self._sleep(attempt)
+
+    def _check(self, response, expected, message):
+        if response.status_code not in expected:
+            raise NexusError(message, response)
+        return response
+
+    def get_repositories(self, etag=None):
+        """Return (repositories, etag) of the repository listing
+
+        With etag set the listing is revalidated and repositories is
+        None if it hasn't changed since.
+        """
+        headers = {'If-None-Match': etag} if etag else {}
+        response = self.request('GET', 'service/rest/v1/repositories',
+                                call='list', headers=headers)
+        if etag and response.status_code == 304:
+            return None, etag
+        self._check(response, (200,),
+                    f'Please check if URL is valid: {response.url}')
         try:
-            return json.loads(response.content)
-        except json.decoder.JSONDecodeError:
-            logging.error('Unable to decode json data')
-
-    logging.error(f'ERROR: Please check if URL is valid: {api_url}')
-    sys.exit(1)
-
-
-def create_yum_repo(url, name, user, password, repo_data_depth,
-                    blob_store, write_policy):
-
-    api_url = urljoin(url, 'service/rest/v1/repositories/yum/hosted')
-
-    params = {
-          "name": name,
-          "online": "true",
-          "storage": {
-                  "blobStoreName": blob_store,
-                  "strictContentTypeValidation": "true",
-                  "writePolicy": write_policy
-                },
-          "cleanup": {
-                  "policyNames": [
-                            "string"
-                          ]
-                },
-          "component": {
-                  "proprietaryComponents": "false"
-                },
-          "yum": {
-                  "repodataDepth": repo_data_depth,
-                  "deployPolicy": "STRICT"
-                }
+            return response.json(), response.headers.get('ETag')
+        except ValueError:
+            raise NexusError('Unable to decode json data', response)
+
+    def get_repository(self, repo_type, name):
+        response = self.request(
+                                'GET',
+                                f'service/rest/v1/repositories/'
+                                f'{repo_type}/hosted/{name}',
+                                call='get'
+                               )
+        self._check(response, (200,), f'Failed to get repository: {name}')
+        return response.json()
+
+    def find_repository(self, repo_type, name):
+        """Same as get_repository, but returns None if it doesn't exist"""
+        try:
+            return self.get_repository(repo_type, name)
+        except NexusError as e:
+            if e.response is not None and e.response.status_code == 404:
+                return None
+            raise
+
+    def delete_repository(self, name):
+        response = self.request('DELETE',
+                                f'service/rest/v1/repositories/{name}',
+                                call='delete')
+        if response.status_code == 404:
+            raise NexusError(f'Repository not found: {name}', response)
+        if response.status_code == 403:
+            raise NexusError(
+                             f'Insufficient permissions to delete '
+                             f'repository: {name}', response
+                            )
+        self._check(response, (204,), 'Unable to delete repository')
+
+    def create_yum_repo(self, name, repo_data_depth=1, blob_store='default',
+                        write_policy='allow_once'):
+        params = {
+              "name": name,
+              "online": "true",
+              "storage": {
+                      "blobStoreName": blob_store,
+                      "strictContentTypeValidation": "true",
+                      "writePolicy": write_policy
+                    },
+              "cleanup": {
+                      "policyNames": [
+                                "string"
+                              ]
+                    },
+              "component": {
+                      "proprietaryComponents": "false"
+                    },
+              "yum": {
+                      "repodataDepth": repo_data_depth,
+                      "deployPolicy": "STRICT"
+                    }
+        }
+
+        response = self.request('POST',
+                                'service/rest/v1/repositories/yum/hosted',
+                                call='create', json=params)
+        self._check(response, (201,), f'Failed to create repository: {name}')
+
+    def create_apt_repo(self, name, distribution, blob_store='default',
+                        write_policy='allow_once', keypair=None,
+                        passphrase=None):
+        params = {
+              "name": name,
+              "online": "true",
+              "storage": {
+                "blobStoreName": blob_store,
+                "strictContentTypeValidation": "true",
+                "writePolicy": write_policy
+              },
+              "cleanup": {
+                "policyNames": [
+                  "string"
+                ]
+              },
+              "component": {
+                "proprietaryComponents": "true"
+              },
+              "apt": {
+                "distribution": distribution
+              },
+              "aptSigning": {
+                "keypair": keypair,
+                "passphrase": passphrase
+              }
+        }
+
+        response = self.request('POST',
+                                'service/rest/v1/repositories/apt/hosted',
+                                call='create', json=params)
+        self._check(response, (201,), f'Failed to create repository: {name}')
+
+    def paginate(self, path, params=None, call='list'):
+        """Iterate over items of a paged listing (assets, components, ...)"""
+        params = dict(params or {})
+        while True:
+            response = self.request('GET', path, call=call, params=params)
+            self._check(response, (200,), f'Failed to list {response.url}')
+            page = response.json()
+            yield from page.get('items', [])
+            token = page.get('continuationToken')
+            if not token:
+                return
+            params['continuationToken'] = token
+
+    def iter_assets(self, name):
+        return self.paginate('service/rest/v1/assets', {'repository': name})
+
+    def search_assets(self, name, **query):
+        query['repository'] = name
+        return self.paginate('service/rest/v1/search/assets', query,
+                             call='search')
+
+    def iter_components(self, name):
+        return self.paginate('service/rest/v1/components',
+                             {'repository': name})
+
+    def delete_component(self, component_id):
+        """Delete a component with its assets, False if it's already gone"""
+        response = self.request('DELETE',
+                                f'service/rest/v1/components/{component_id}',
+                                call='delete_component')
+        if response.status_code == 404:
+            return False
+        if response.status_code == 403:
+            raise NexusError(
+                             f'Insufficient permissions to delete '
+                             f'component: {component_id}', response
+                            )
+        self._check(response, (204,),
+                    f'Unable to delete component: {component_id}')
+        return True
+
+    def upload_yum(self, name, file_path, upload_path=None):
+        path = f'repository/{name}/{yum_asset_path(file_path, upload_path)}'
+
+        # Passing the file object makes requests stream it from disk
+        with open(file_path, 'rb') as artifact:
+            response = self.request('PUT', path, call='upload',
+                                    data=artifact)
+        self._check(response, (200, 201),
+                    f'Unable to upload artifact {file_path} to {response.url}')
+        return response.url
+
+    def upload_apt(self, name, file_path, upload_path=None):
+        # Forward slash at the end is mandatory for APT
+        with open(file_path, 'rb') as artifact:
+            response = self.request('POST', f'repository/{name}/',
+                                    call='upload', data=artifact)
+        self._check(response, (200, 201),
+                    f'Unable to upload artifact {file_path} to {response.url}')
+        return response.url
+
+
+class RepositoryIndex:
+    """Name -> repository index of the Nexus repository listing
+
+    The listing is fetched at most once per index and, with cache_file
+    set, persisted to disk. A cached listing younger than ttl seconds is
+    used as is, an older one is revalidated with If-None-Match so an
+    unchanged listing isn't downloaded again. Without a cache file,
+    lookups of a single repository of known type use a targeted GET
+    instead of fetching the whole listing, lookups without type always
+    use the listing.
+    """
+
+    def __init__(self, client, cache_file=None, ttl=60):
+        self.client = client
+        self.cache_file = cache_file
+        self.ttl = ttl
+        self.etag = None
+        self.fetched = 0
+        self.lock = threading.RLock()
+        self._repos = None
+
+        if cache_file and os.path.isfile(cache_file):
+            try:
+                with open(cache_file) as cache:
+                    data = json.load(cache)
+            except (IOError, json.decoder.JSONDecodeError):
+                logging.warning(f'Ignoring corrupted cache file: {cache_file}')
+            else:
+                if data.get('url') == client.url:
+                    self.etag = data.get('etag')
+                    self.fetched = data.get('fetched', 0)
+                    self._repos = {repo['name']: repo
+                                   for repo in data['repositories']}
+
+    def is_fresh(self):
+        return (self._repos is not None and
+                time.time() - self.fetched < self.ttl)
+
+    def refresh(self):
+        with self.lock:
+            repos, self.etag = self.client.get_repositories(self.etag)
+            if repos is not None:
+                self._repos = {repo['name']: repo for repo in repos}
+            self.fetched = time.time()
+            self.save()
+
+    def save(self):
+        if not self.cache_file or self._repos is None:
+            return
+        data = {
+            'url': self.client.url,
+            'etag': self.etag,
+            'fetched': self.fetched,
+            'repositories': list(self._repos.values()),
+        }
+        tmp_path = f'{self.cache_file}.tmp'
+        with open(tmp_path, 'w') as cache:
+            json.dump(data, cache)
+        os.replace(tmp_path, self.cache_file)
+
+    @property
+    def repositories(self):
+        with self.lock:
+            if not self.is_fresh():
+                self.refresh()
+            return self._repos
+
+    def get(self, name, repo_type=None):
+        if (repo_type is not None and self._repos is None and
+                not self.cache_file):
+            return self.client.find_repository(repo_type, name)
+        return self.repositories.get(name)
+
+    def exists(self, name, repo_type=None):
+        return self.get(name, repo_type) is not None
+
+    def add(self, repo):
+        with self.lock:
+            if self._repos is not None:
+                self._repos[repo['name']] = repo
+                self.save()
+
+    def discard(self, name):
+        with self.lock:
+            if self._repos is not None:
+                self._repos.pop(name, None)
+                self.save()
+
+
+def asset_path(asset):
+    """Path of an asset relative to the repository, Nexus may report it
+    with a leading slash"""
+    return asset['path'].lstrip('/')
+
+
+class AssetIndex:
+    """Checksum index of the assets of a repository
+
+    Built from the paged assets listing and, with cache_file set, kept on
+    disk for ttl seconds so repeated dedup checks of the same repository
+    don't list it again.
+    """
+
+    def __init__(self, client, name, cache_file=None, ttl=60):
+        self.client = client
+        self.name = name
+        self.cache_file = cache_file
+        self.lock = threading.Lock()
+        self.assets = None
+
+        if cache_file and os.path.isfile(cache_file):
+            try:
+                with open(cache_file) as cache:
+                    data = json.load(cache)
+            except (IOError, json.decoder.JSONDecodeError):
+                logging.warning(f'Ignoring corrupted cache file: {cache_file}')
+            else:
+                if (data.get('url') == client.url and
+                        data.get('repository') == name and
+                        time.time() - data.get('fetched', 0) < ttl):
+                    self.assets = data['assets']
+
+        if self.assets is None:
+            self.assets = [
+                {'path': asset['path'], 'checksum': asset.get('checksum', {})}
+                for asset in client.iter_assets(name)
+            ]
+            self.save()
+
+        self._by_checksum = {}
+        for asset in self.assets:
+            self._index(asset)
+
+    def _index(self, asset):
+        for algorithm, checksum in asset['checksum'].items():
+            self._by_checksum.setdefault((algorithm, checksum), []).append(
+                                                                       asset)
+
+    def save(self):
+        if not self.cache_file:
+            return
+        data = {
+            'url': self.client.url,
+            'repository': self.name,
+            'fetched': time.time(),
+            'assets': self.assets,
+        }
+        tmp_path = f'{self.cache_file}.tmp'
+        with open(tmp_path, 'w') as cache:
+            json.dump(data, cache)
+        os.replace(tmp_path, self.cache_file)
+
+    def find(self, algorithm, checksum, path=None):
+        for asset in self._by_checksum.get((algorithm, checksum), []):
+            if (path is None or asset['path'] is None or
+                    asset_path(asset) == path):
+                return asset
+        return None
+
+    def add(self, path, algorithm, checksum):
+        with self.lock:
+            asset = {'path': path, 'checksum': {algorithm: checksum}}
+            self.assets.append(asset)
+            self._index(asset)
+
+
+class UploadState:
+    """Uploaded files bookkeeping, persisted as JSON between runs"""
+
+    def __init__(self, path=None):
+        self.path = path
+        self.lock = threading.Lock()
+        self.files = {}
+
+        if path and os.path.isfile(path):
+            try:
+                with open(path) as state_file:
+                    self.files = json.load(state_file)
+            except (IOError, json.decoder.JSONDecodeError):
+                logging.warning(f'Ignoring corrupted state file: {path}')
+
+    @staticmethod
+    def _key(name, file_path):
+        return f'{name}:{os.path.abspath(file_path)}'
+
+    @staticmethod
+    def _stat(file_path):
+        st = os.stat(file_path)
+        return {'size': st.st_size, 'mtime': st.st_mtime}
+
+    def is_uploaded(self, name, file_path):
+        entry = self.files.get(self._key(name, file_path))
+        if entry is None:
+            return False
+        stat = self._stat(file_path)
+        return (entry['size'], entry['mtime']) == (stat['size'],
+                                                   stat['mtime'])
+
+    def mark_uploaded(self, name, file_path, upload_url):
+        entry = self._stat(file_path)
+        entry['url'] = upload_url
+        with self.lock:
+            self.files[self._key(name, file_path)] = entry
+            if self.path:
+                tmp_path = f'{self.path}.tmp'
+                with open(tmp_path, 'w') as state_file:
+                    json.dump(self.files, state_file, indent=2)
+                os.replace(tmp_path, self.path)
+
+
+def yum_asset_path(file_path, upload_path=None):
+    fn = os.path.basename(file_path)
+    if upload_path:
+        return f'{upload_path.strip("/")}/{fn}'
+    return fn
+
+
+def file_checksum(file_path, algorithm='sha256'):
+    digest = hashlib.new(algorithm)
+    with open(file_path, 'rb') as artifact:
+        if os.fstat(artifact.fileno()).st_size >= MMAP_THRESHOLD:
+            # Let the kernel page the file in, hashlib releases the GIL
+            # while hashing the whole mapping at once
+            with mmap.mmap(artifact.fileno(), 0,
+                           access=mmap.ACCESS_READ) as mapped:
+                digest.update(mapped)
+        else:
+            for chunk in iter(lambda: artifact.read(2**20), b''):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+
+def find_existing(client, name, repo_type, files, upload_path=None,
+                  algorithm='sha256', asset_index=None, jobs=4):
+    """Return {file_path: checksum} and {file_path: asset} of the files
+
+    A file exists if the repository has an asset with the same checksum
+    (and, for yum, the same path). Without asset_index every file is
+    looked up through the search API.
+    """
+    def check(file_path):
+        checksum = file_checksum(file_path, algorithm)
+        path = None
+        if repo_type == 'yum':
+            path = yum_asset_path(file_path, upload_path)
+        if asset_index is not None:
+            return checksum, asset_index.find(algorithm, checksum, path)
+        for asset in client.search_assets(name, **{algorithm: checksum}):
+            if path is None or asset_path(asset) == path:
+                return checksum, asset
+        return checksum, None
+
+    checksums = {}
+    existing = {}
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        for file_path, (checksum, asset) in zip(files,
+                                                executor.map(check, files)):
+            checksums[file_path] = checksum
+            if asset is not None:
+                existing[file_path] = asset
+    return checksums, existing
+
+
+def expand_files(patterns, repo_type):
+    files = []
+    seen = set()
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            matches = sorted(
+                             glob.glob(os.path.join(
+                                                    pattern,
+                                                    UPLOAD_PATTERNS[repo_type]
+                                                   ))
+                            )
+        else:
+            matches = sorted(glob.glob(pattern))
+            if not matches:
+                raise NexusError(f'Unable to open file: {pattern}')
+
+        for file_path in matches:
+            if file_path not in seen:
+                seen.add(file_path)
+                files.append(file_path)
+    return files
+
+
+def upload_file(client, name, repo_type, file_path, upload_path=None):
+    upload = client.upload_yum if repo_type == 'yum' else client.upload_apt
+    start = time.monotonic()
+    try:
+        upload_url = upload(name, file_path, upload_path=upload_path)
+    except IOError as e:
+        client.record_transfer('upload', name, 0, 0, failed=True)
+        raise NexusError(f'Unable to open file: {file_path}: {e}')
+    except NexusError:
+        client.record_transfer('upload', name, 0, 0, failed=True)
+        raise
+    result = {
+        'file': file_path,
+        'url': upload_url,
+        'bytes': os.path.getsize(file_path),
+        'seconds': time.monotonic() - start,
     }
+    client.record_transfer('upload', name, result['bytes'],
+                           result['seconds'])
+    return result
 
-    logging.info(f'Creating hosted yum repository: {name}')
-    response = requests.post(api_url, json=params,
-                             auth=requests.auth.HTTPBasicAuth(user, password))
 
-    if response.status_code == 201:
-        logging.info('Done')
-    else:
-        logging.error(f'Failed to create repository: {name}')
-        logging.error(f'Status code: {response.status_code}')
-        logging.error(f'Response: {response.content}')
-        sys.exit(1)
+def upload_files(client, name, repo_type, files, upload_path=None,
+                 jobs=4, state_file=None):
+    state = UploadState(state_file)
+    results = []
+    failed = []
+
+    pending = []
+    for file_path in files:
+        if state.is_uploaded(name, file_path):
+            logging.info(f'Already uploaded, skipping: {file_path}')
+        else:
+            pending.append(file_path)
+
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        futures = {
+            executor.submit(upload_file, client, name, repo_type,
+                            file_path, upload_path): file_path
+            for file_path in pending
+        }
+        for future in as_completed(futures):
+            file_path = futures[future]
+            try:
+                result = future.result()
+            except (NexusError, IOError,
+                    requests.exceptions.RequestException) as e:
+                if isinstance(e, NexusError):
+                    log_error(e)
+                else:
+                    logging.error(f'Unable to upload {file_path}: {e}')
+                failed.append(file_path)
+                continue
+            state.mark_uploaded(name, file_path, result['url'])
+            logging.info(f'Uploaded {file_path} to {result["url"]}')
+            results.append(result)
+
+    return results, failed
+
 
+def _rate(size, seconds):
+    return size / seconds / 2**20 if seconds > 0 else 0.0
 
-def get_yum_repo(url, name, user=None, password=None):
 
-    api_url = urljoin(url, f'service/rest/v1/repositories/yum/hosted/{name}')
+def print_upload_summary(results, failed, elapsed):
+    total = 0
+    for result in sorted(results, key=lambda r: r['file']):
+        total += result['bytes']
+        logging.info(
+                     f'{result["file"]}: '
+                     f'{result["bytes"] / 2**20:.1f} MiB in '
+                     f'{result["seconds"]:.1f}s '
+                     f'({_rate(result["bytes"], result["seconds"]):.1f} MiB/s)'
+                    )
+    logging.info(
+                 f'Uploaded {len(results)} file(s), '
+                 f'{total / 2**20:.1f} MiB in {elapsed:.1f}s '
+                 f'({_rate(total, elapsed):.1f} MiB/s), '
+                 f'failed: {len(failed)}'
+                )
 
-    auth_params = None
 
-    if user is not None and password is not None:
-        auth_params = requests.auth.HTTPBasicAuth(user, password)
+def log_error(e):
+    logging.error(e)
+    if e.response is not None:
+        logging.error(f'Status code: {e.response.status_code}')
+        logging.error(f'Response: {e.response.content}')
 
-    response = requests.get(api_url, auth=auth_params)
-    if response.status_code == 200:
-        response_json = json.loads(response.content)
-        print(json.dumps(response_json, indent=2))
+
+def create_repository(client, index, op):
+    name = op['name']
+    # Names are unique across formats and types, only the full listing
+    # tells about a repository the targeted GET of this format misses
+    existing = index.get(name)
+    if existing is not None:
+        raise NexusError(f'Repository already exists: {name} '
+                         f'({existing.get("format")}/'
+                         f'{existing.get("type")})')
+
+    blob_store = op.get('blob_store', 'default')
+    write_policy = op.get('write_policy', 'allow_once')
+
+    if op['repo_type'] == 'yum':
+        logging.info(f'Creating hosted yum repository: {name}')
+        client.create_yum_repo(name, op.get('repo_data_depth', 1),
+                               blob_store, write_policy)
     else:
-        print(api_url)
-        logging.error(f'Failed to get repository: {name}')
-        logging.error(f'Status code: {response.status_code}')
-        logging.error(f'Response: {response.content}')
-        sys.exit(1)
+        if not op.get('distro'):
+            raise NexusError(f'Missing distro for APT repository: {name}')
+        keypair = op.get('keypair')
+        if op.get('keypair_file'):
+            with open(op['keypair_file']) as keypair_file:
+                keypair = keypair_file.read()
+        logging.info(f'Creating hosted APT repository: {name}')
+        client.create_apt_repo(name, op['distro'], blob_store, write_policy,
+                               keypair, op.get('passphrase'))
+    index.add({'name': name, 'format': op['repo_type'], 'type': 'hosted'})
+    logging.info('Done')
+    return {}
 
 
-def create_apt_repo(url, name, user, password,
-                    blob_store, write_policy,
-                    distribution, keypair=None, keypair_file=None,
-                    passphrase=None):
+def upload_repository(client, index, op, jobs=4):
+    name = op['name']
+    if not index.exists(name, op['repo_type']):
+        raise NexusError(f'Repository {name} doesn\'t exist')
 
-    api_url = urljoin(url, 'service/rest/v1/repositories/apt/hosted')
+    patterns = op['file']
+    if isinstance(patterns, str):
+        patterns = [patterns]
+    files = expand_files(patterns, op['repo_type'])
+    dry_run = op.get('dry_run', False)
+    algorithm = op.get('checksum', 'sha256')
+    asset_index = None
+    summary = {}
 
-    if keypair_file:
-        keypair = keypair_file.read()
+    if op.get('skip_existing') or dry_run:
+        if op.get('asset_cache'):
+            asset_index = AssetIndex(client, name, op['asset_cache'],
+                                     op.get('repo_cache_ttl', 60))
+        checksums, existing = find_existing(
+                                            client, name, op['repo_type'],
+                                            files, op.get('upload_path'),
+                                            algorithm, asset_index, jobs
+                                           )
+        for file_path, asset in existing.items():
+            logging.info(f'Already in repository {name}, skipping: '
+                         f'{file_path} ({asset["path"]})')
+        files = [file_path for file_path in files
+                 if file_path not in existing]
+        summary['skipped_files'] = len(existing)
+        summary['bytes_saved'] = sum(os.path.getsize(file_path)
+                                     for file_path in existing)
+        logging.info(f'{len(existing)} file(s) already in repository {name}, '
+                     f'{summary["bytes_saved"] / 2**20:.1f} MiB saved')
 
-    params = {
-          "name": name,
-          "online": "true",
-          "storage": {
-            "blobStoreName": blob_store,
-            "strictContentTypeValidation": "true",
-            "writePolicy": write_policy
-          },
-          "cleanup": {
-            "policyNames": [
-              "string"
-            ]
-          },
-          "component": {
-            "proprietaryComponents": "true"
-          },
-          "apt": {
-            "distribution": distribution
-          },
-          "aptSigning": {
-            "keypair": keypair,
-            "passphrase": passphrase
-          }
+    if dry_run:
+        summary['files'] = len(files)
+        summary['bytes'] = sum(os.path.getsize(file_path)
+                               for file_path in files)
+        summary['dry_run'] = True
+        logging.info(f'Dry run: would upload {len(files)} file(s), '
+                     f'{summary["bytes"] / 2**20:.1f} MiB')
+        return summary
+
+    start = time.monotonic()
+    results, failed = upload_files(
+                                   client, name, op['repo_type'], files,
+                                   upload_path=op.get('upload_path'),
+                                   jobs=jobs, state_file=op.get('state_file')
+                                  )
+    print_upload_summary(results, failed, time.monotonic() - start)
+
+    if asset_index is not None:
+        for result in results:
+            path = None
+            if op['repo_type'] == 'yum':
+                path = yum_asset_path(result['file'], op.get('upload_path'))
+            asset_index.add(path, algorithm, checksums[result['file']])
+        asset_index.save()
+
+    if failed:
+        raise NexusError(f'Failed to upload {len(failed)} file(s) '
+                         f'to repository {name}')
+    summary['files'] = len(results)
+    summary['bytes'] = sum(result['bytes'] for result in results)
+    return summary
+
+
+class RateLimiter:
+    """Spaces out calls of all worker threads to at most rate per second"""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate and rate > 0 else 0
+        self.lock = threading.Lock()
+        self.next_call = time.monotonic()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next_call - now
+            self.next_call = max(now, self.next_call) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+def parse_time(stamp):
+    # datetime.fromisoformat() before Python 3.11 doesn't accept 'Z'
+    if stamp.endswith('Z'):
+        stamp = stamp[:-1] + '+00:00'
+    try:
+        return datetime.fromisoformat(stamp).timestamp()
+    except ValueError:
+        return None
+
+
+def component_summary(component):
+    """Fields of a listed component prune needs, with the time of its
+    newest asset (None if no asset has a parsable timestamp)"""
+    stamps = []
+    size = 0
+    for asset in component.get('assets', []):
+        size += asset.get('fileSize') or 0
+        stamp = asset.get('lastModified') or asset.get('blobCreated')
+        if stamp:
+            stamps.append(parse_time(stamp))
+    stamps = [stamp for stamp in stamps if stamp is not None]
+    return {
+        'id': component['id'],
+        'group': component.get('group'),
+        'name': component.get('name'),
+        'version': component.get('version'),
+        'bytes': size,
+        'time': max(stamps) if stamps else None,
     }
 
-    logging.info(f'Creating hosted APT repository: {name}')
-    response = requests.post(api_url, json=params,
-                             auth=requests.auth.HTTPBasicAuth(user, password))
 
-    if response.status_code == 201:
-        logging.info('Done')
+def prune_candidates(components, keep_last=None, cutoff=None):
+    """Yield the components to prune from a stream of component summaries
+
+    Only the keep_last most recent components of every package (group
+    and name) are held in memory. A component pushed out of them, or any
+    component without keep_last, is pruned if it's older than cutoff
+    (epoch seconds, None: any age). Components without a timestamp are
+    always kept.
+    """
+    newest = {}
+    for component in components:
+        if component['time'] is None:
+            logging.warning(f'No timestamp, keeping component '
+                            f'{component["name"]} {component["version"]}')
+            continue
+        if keep_last is None:
+            if cutoff is None or component['time'] < cutoff:
+                yield component
+            continue
+        heap = newest.setdefault((component['group'], component['name']), [])
+        # The id breaks ties, components themselves don't compare
+        item = (component['time'], component['id'], component)
+        if len(heap) < keep_last:
+            heapq.heappush(heap, item)
+            continue
+        oldest = heapq.heappushpop(heap, item)[2]
+        if cutoff is None or oldest['time'] < cutoff:
+            yield oldest
+
+
+def _prune_component(client, limiter, slots, component, summary, lock):
+    try:
+        limiter.wait()
+        deleted = client.delete_component(component['id'])
+    except (NexusError, IOError, requests.exceptions.RequestException) as e:
+        if isinstance(e, NexusError):
+            log_error(e)
+        else:
+            logging.error(f'Unable to delete component {component["id"]}: '
+                          f'{e}')
+        with lock:
+            summary['failed'] += 1
+        return
+    finally:
+        slots.release()
+    with lock:
+        if deleted:
+            summary['pruned'] += 1
+            summary['bytes'] += component['bytes']
+        else:
+            summary['gone'] += 1
+
+
+def prune_repository(client, index, op, jobs=4):
+    """Delete old components of a repository
+
+    Components are streamed page by page and deleted while the listing
+    goes on, by at most jobs concurrent deletes limited to op['rate']
+    per second.
+    """
+    name = op['name']
+    if not index.exists(name, op['repo_type']):
+        raise NexusError(f'Repository {name} doesn\'t exist')
+
+    keep_last = op.get('keep_last')
+    older_than = op.get('older_than')
+    if keep_last is None and older_than is None:
+        raise NexusError(f'Missing keep_last or older_than to prune '
+                         f'repository: {name}')
+    if (keep_last is not None and keep_last < 0 or
+            older_than is not None and older_than < 0):
+        raise NexusError('keep_last and older_than must not be negative')
+    cutoff = None
+    if older_than is not None:
+        cutoff = time.time() - older_than * 86400
+
+    dry_run = op.get('dry_run', False)
+    summary = {'components': 0, 'pruned': 0, 'bytes': 0, 'failed': 0,
+               'gone': 0}
+
+    def listing():
+        for component in client.iter_components(name):
+            summary['components'] += 1
+            yield component_summary(component)
+
+    start = time.monotonic()
+    limiter = RateLimiter(op.get('rate', 10))
+    lock = threading.Lock()
+    # Bounds the queued deletes, the listing waits for the workers
+    slots = threading.BoundedSemaphore(max(1, jobs) * 2)
+    futures = []
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        for component in prune_candidates(listing(), keep_last, cutoff):
+            label = (f'{component["group"] or ""}/{component["name"]} '
+                     f'{component["version"]}')
+            if dry_run:
+                logging.info(f'Dry run: would prune {label}')
+                summary['pruned'] += 1
+                summary['bytes'] += component['bytes']
+                continue
+            logging.info(f'Pruning {label}')
+            slots.acquire()
+            futures.append(executor.submit(_prune_component, client, limiter,
+                                           slots, component, summary, lock))
+    # Re-raises what the workers didn't expect instead of losing it
+    for future in futures:
+        future.result()
+
+    elapsed = time.monotonic() - start
+    verb = 'Dry run: would prune' if dry_run else 'Pruned'
+    logging.info(f'{verb} {summary["pruned"]} of {summary["components"]} '
+                 f'component(s) of repository {name}, '
+                 f'{summary["bytes"] / 2**20:.1f} MiB reclaimed '
+                 f'in {elapsed:.1f}s, failed: {summary["failed"]}')
+    if dry_run:
+        summary['dry_run'] = True
+    if summary['failed']:
+        raise NexusError(f'Failed to prune {summary["failed"]} component(s) '
+                         f'of repository {name}')
+    return summary
+
+
+def asset_checksum(asset):
+    """(algorithm, checksum) a downloaded asset is verified with"""
+    checksums = asset.get('checksum') or {}
+    for algorithm in ('sha256', 'sha1'):
+        if checksums.get(algorithm):
+            return algorithm, checksums[algorithm]
+    return None, None
+
+
+def _tmp_path(path):
+    # Unique per process and thread, parallel jobs may share directories
+    return f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+
+
+def _install(source, target):
+    """Atomically place a copy of source at target
+
+    Copies aren't hard links on purpose: a test modifying a downloaded
+    file must not corrupt the cache entry.
+    """
+    os.makedirs(os.path.dirname(target) or '.', exist_ok=True)
+    tmp_path = _tmp_path(target)
+    try:
+        shutil.copyfile(source, tmp_path)
+        os.replace(tmp_path, target)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+class DownloadCache:
+    """Content-addressed store of downloaded assets
+
+    Entries live at <root>/<algorithm>/<first 2 chars>/<checksum> and are
+    only created by renaming a verified download, so a cache shared by
+    parallel jobs (e.g. through a hostPath volume) never exposes partial
+    files.
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, algorithm, checksum):
+        return os.path.join(self.root, algorithm, checksum[:2], checksum)
+
+    def get(self, algorithm, checksum):
+        path = self.path(algorithm, checksum)
+        return path if os.path.isfile(path) else None
+
+    def add(self, algorithm, checksum, file_path):
+        _install(file_path, self.path(algorithm, checksum))
+
+
+def _write_response(response, fd, offset, digest=None):
+    for block in response.iter_content(DOWNLOAD_BLOCK):
+        os.pwrite(fd, block, offset)
+        offset += len(block)
+        if digest is not None:
+            digest.update(block)
+    return offset
+
+
+def _fetch_range(client, url, fd, start, end):
+    response = client.request('GET', url, call='download', stream=True,
+                              headers={'Range': f'bytes={start}-{end}'})
+    with response:
+        client._check(response, (206,),
+                      f'Range request failed: {url} bytes {start}-{end}')
+        if _write_response(response, fd, start) != end + 1:
+            raise NexusError(f'Short read of {url} bytes {start}-{end}')
+
+
+def fetch(client, url, file_path, size=None, part_size=32 * 2**20,
+          executor=None, algorithm=None):
+    """Download url to file_path, files larger than part_size in parallel
+    parts on executor. Returns the checksum of the file if algorithm is
+    set."""
+    with open(file_path, 'wb') as out:
+        fd = out.fileno()
+        if not size or size <= part_size or executor is None:
+            headers = {}
+            start = None
+        else:
+            # The first part tells if the server supports ranges
+            headers = {'Range': f'bytes=0-{part_size - 1}'}
+            start = part_size
+
+        digest = hashlib.new(algorithm) if algorithm else None
+        response = client.request('GET', url, call='download', stream=True,
+                                  headers=headers)
+        with response:
+            client._check(response, (200, 206),
+                          f'Unable to download {response.url}')
+            if response.status_code == 200:
+                # Whole file, either asked for or ranges aren't supported
+                _write_response(response, fd, 0, digest)
+                return digest.hexdigest() if digest else None
+            _write_response(response, fd, 0)
+
+        out.truncate(size)
+        futures = [
+            executor.submit(_fetch_range, client, url, fd, offset,
+                            min(offset + part_size, size) - 1)
+            for offset in range(start, size, part_size)
+        ]
+        for future in futures:
+            future.result()
+    return file_checksum(file_path, algorithm) if algorithm else None
+
+
+def download_asset(client, asset, output, cache=None, part_size=32 * 2**20,
+                   executor=None):
+    """Download an asset into output unless it's already there or cached
+
+    Returns 'cached', 'present' or 'downloaded'.
+    """
+    rel_path = asset_path(asset)
+    if '..' in rel_path.split('/'):
+        raise NexusError(f'Refusing to download outside of {output}: '
+                         f'{asset["path"]}')
+    target = os.path.join(output, rel_path)
+    algorithm, checksum = asset_checksum(asset)
+    size = asset.get('fileSize')
+
+    if checksum and cache is not None:
+        cached = cache.get(algorithm, checksum)
+        if cached:
+            _install(cached, target)
+            return 'cached'
+    if (checksum and os.path.isfile(target) and
+            (size is None or os.path.getsize(target) == size) and
+            file_checksum(target, algorithm) == checksum):
+        if cache is not None:
+            cache.add(algorithm, checksum, target)
+        return 'present'
+    if not checksum:
+        logging.warning(f'No checksum to verify {asset["path"]}')
+
+    os.makedirs(os.path.dirname(target) or '.', exist_ok=True)
+    tmp_path = _tmp_path(target)
+    try:
+        actual = fetch(client, asset['downloadUrl'], tmp_path, size,
+                       part_size, executor, algorithm)
+        if checksum and actual != checksum:
+            raise NexusError(f'{algorithm} mismatch of {asset["path"]}: '
+                             f'expected {checksum}, got {actual}')
+        if checksum and cache is not None:
+            cache.add(algorithm, checksum, tmp_path)
+        os.replace(tmp_path, target)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return 'downloaded'
+
+
+def _download_one(client, asset, op, cache, part_size, parts, slots,
+                  summary, lock):
+    start = time.monotonic()
+    try:
+        status = download_asset(client, asset, op['output'], cache,
+                                part_size, parts)
+    except (NexusError, IOError, requests.exceptions.RequestException) as e:
+        if isinstance(e, NexusError):
+            log_error(e)
+        else:
+            logging.error(f'Unable to download {asset["path"]}: {e}')
+        with lock:
+            summary['failed'] += 1
+        client.record_transfer('download', op['name'], 0, 0, failed=True)
+        return
+    finally:
+        slots.release()
+    size = asset.get('fileSize') or 0
+    with lock:
+        summary[status] += 1
+        summary[f'{status}_bytes'] += size
+    if status == 'downloaded':
+        seconds = time.monotonic() - start
+        client.record_transfer('download', op['name'], size, seconds)
+        logging.info(f'{asset["path"]}: {size / 2**20:.1f} MiB in '
+                     f'{seconds:.1f}s ({_rate(size, seconds):.1f} MiB/s)')
+
+
+def remove_stale(output, paths):
+    """Remove files under output that aren't in paths, for mirror"""
+    removed = 0
+    for root, _, names in os.walk(output):
+        for file_name in names:
+            file_path = os.path.join(root, file_name)
+            rel_path = os.path.relpath(file_path, output).replace(os.sep, '/')
+            if rel_path not in paths:
+                logging.info(f'Removing {rel_path}, not in the repository')
+                os.remove(file_path)
+                removed += 1
+    return removed
+
+
+def download_repository(client, index, op, jobs=4):
+    """Download (or, with action mirror, mirror) assets of a repository
+
+    Assets are streamed from the paged listing, verified against the
+    checksum Nexus reports and, with download_cache set, kept in a
+    content-addressed cache so later runs copy them from local disk.
+    """
+    name = op['name']
+    if not op.get('output'):
+        raise NexusError(f'Missing output to download repository: {name}')
+    if not index.exists(name, op['repo_type']):
+        raise NexusError(f'Repository {name} doesn\'t exist')
+
+    patterns = op.get('match') or []
+    if isinstance(patterns, str):
+        patterns = [patterns]
+    cache = None
+    if op.get('download_cache'):
+        cache = DownloadCache(op['download_cache'])
+    part_size = int(op.get('part_size', 32) * 2**20)
+    dry_run = op.get('dry_run', False)
+    mirror = op['action'] == 'mirror'
+
+    summary = {'assets': 0, 'failed': 0}
+    for status in ('downloaded', 'cached', 'present'):
+        summary[status] = 0
+        summary[f'{status}_bytes'] = 0
+    paths = set()
+    start = time.monotonic()
+    lock = threading.Lock()
+    slots = threading.BoundedSemaphore(max(1, jobs) * 2)
+    futures = {}
+    # parts is shut down last, the asset workers submit ranges to it
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as parts, \
+            ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        for asset in client.iter_assets(name):
+            rel_path = asset_path(asset)
+            if patterns and not any(fnmatch.fnmatch(rel_path, pattern)
+                                    for pattern in patterns):
+                continue
+            summary['assets'] += 1
+            paths.add(rel_path)
+            if dry_run:
+                algorithm, checksum = asset_checksum(asset)
+                status = 'downloaded'
+                if cache is not None and checksum and \
+                        cache.get(algorithm, checksum):
+                    status = 'cached'
+                summary[status] += 1
+                summary[f'{status}_bytes'] += asset.get('fileSize') or 0
+                continue
+            slots.acquire()
+            future = executor.submit(_download_one, client, asset, op, cache,
+                                     part_size, parts, slots, summary, lock)
+            futures[future] = asset['path']
+    for future, path in futures.items():
+        try:
+            future.result()
+        except Exception as e:
+            # _download_one counts the errors it expects, anything else
+            # must not pass for a successful download
+            logging.error(f'Unable to download {path}: {e!r}')
+            summary['failed'] += 1
+
+    if mirror and not dry_run and not summary['failed']:
+        summary['removed'] = remove_stale(op['output'], paths)
+
+    elapsed = time.monotonic() - start
+    if dry_run:
+        summary['dry_run'] = True
+        logging.info(f'Dry run: would download {summary["downloaded"]} of '
+                     f'{summary["assets"]} asset(s), '
+                     f'{summary["downloaded_bytes"] / 2**20:.1f} MiB, '
+                     f'{summary["cached"]} cached')
     else:
-        logging.error(f'Failed to create repository: {name}')
-        logging.error(f'Status code: {response.status_code}')
-        logging.error(f'Response: {response.content}')
-        sys.exit(1)
+        logging.info(f'Downloaded {summary["downloaded"]} of '
+                     f'{summary["assets"]} asset(s), '
+                     f'{summary["downloaded_bytes"] / 2**20:.1f} MiB in '
+                     f'{elapsed:.1f}s '
+                     f'({_rate(summary["downloaded_bytes"], elapsed):.1f} '
+                     f'MiB/s), cached: {summary["cached"]}, '
+                     f'present: {summary["present"]}, '
+                     f'failed: {summary["failed"]}')
+    if summary['failed']:
+        raise NexusError(f'Failed to download {summary["failed"]} asset(s) '
+                         f'of repository {name}')
+    return summary
 
 
-def upload_yum(url, name, file_path, user, password, upload_path=None):
+def run_operation(client, index, op, jobs=4):
+    """Run a single create/upload/show/prune/download/delete operation"""
+    client = client.bind(repo_type=op.get('repo_type', ''),
+                         action=op['action'])
+    if client.metrics is None:
+        return _run_operation(client, index, op, jobs)
+    start = time.monotonic()
+    status = 'failed'
     try:
-        artifcat = open(file_path, 'rb').read()
-    except IOError:
-        logging.error(f'Unable to open file: {file_path}')
-        sys.exit(1)
+        result = _run_operation(client, index, op, jobs)
+        status = 'ok'
+        return result
+    finally:
+        client.metrics.observe('nexus_operation_duration_seconds',
+                               time.monotonic() - start, status=status,
+                               **client.labels)
 
-    fn = file_path.split('/')[-1]
 
-    path = f'repository/{name}'
+def _run_operation(client, index, op, jobs):
+    if op['action'] == 'create':
+        return create_repository(client, index, op)
+    if op['action'] == 'upload':
+        return upload_repository(client, index, op, jobs)
+    if op['action'] == 'prune':
+        return prune_repository(client, index, op, jobs)
+    if op['action'] in ('download', 'mirror'):
+        return download_repository(client, index, op, jobs)
+    if op['action'] == 'show':
+        return {'repository': client.get_repository(op['repo_type'],
+                                                    op['name'])}
+    if op['action'] == 'delete':
+        client.delete_repository(op['name'])
+        index.discard(op['name'])
+        logging.info(f'Repository has been deleted: {op["name"]}')
+        return {}
+    raise NexusError(f'Unsupported action: {op["action"]}')
 
-    if upload_path:
-        path = f'{path}/{upload_path}'
-
-    upload_url = urljoin(url, f'{path}/{fn}')
-
-    response = requests.put(
-                            upload_url, data=artifcat,
-                            auth=requests.auth.HTTPBasicAuth(
-                                                             args.user,
-                                                             args.password
-                                                            )
-                           )
-    if response.status_code != 200:
-        logging.error(f'Unable to upload artifact {file_path} to {upload_url}')
-        logging.error(f'Status code: {response.status_code}')
-        logging.error(f'Response: {response.content}')
-        sys.exit(1)
 
+# Operations on the same repository run in this order, e.g. an upload
+# waits for the create of its repository, a prune for the uploads and
+# a delete for everything else.
+BATCH_ACTIONS = {
+    'create': 0,
+    'upload': 1,
+    'show': 1,
+    'download': 1,
+    'mirror': 1,
+    'prune': 2,
+    'delete': 3,
+}
+
+
+def load_manifest(path):
+    """Load batch operations from a YAML or JSON manifest
+
+    operations:
+      - {action: create, repo_type: yum, name: my-repo}
+      - {action: upload, repo_type: yum, name: my-repo,
+         file: ['dist/*.rpm'], upload_path: 7/x86_64}
+      - {action: prune, repo_type: yum, name: my-repo, keep_last: 5}
+      - {action: download, repo_type: yum, name: my-repo, output: mirror,
+         match: ['7/x86_64/*'], download_cache: /var/cache/nexus}
+      - {id: cleanup, action: delete, name: old-repo,
+         depends_on: ['1-upload-my-repo']}
+
+    Operation keys match the command line options of the yum/apt
+    subcommands (distro, keypair, keypair_file, blob_store, ...).
+    """
+    with open(path) as manifest:
+        text = manifest.read()
+
+    if path.endswith('.json'):
+        data = json.loads(text)
+    else:
+        try:
+            import yaml
+        except ImportError:
+            # JSON is a subset of YAML, so it still works without PyYAML
+            data = json.loads(text)
+        else:
+            data = yaml.safe_load(text)
+
+    if isinstance(data, dict):
+        data = data.get('operations')
+    if not isinstance(data, list):
+        raise NexusError(f'Manifest {path} has no list of operations')
+
+    ops = []
+    for i, op in enumerate(data):
+        if not isinstance(op, dict):
+            raise NexusError(f'Operation #{i} is not a map: {op}')
+        op = dict(op)
+        for key in ('action', 'name'):
+            if not op.get(key):
+                raise NexusError(f'Operation #{i} has no {key}: {op}')
+        if op['action'] not in BATCH_ACTIONS:
+            raise NexusError(f'Operation #{i} has unsupported action: '
+                             f'{op["action"]}')
+        op.setdefault('repo_type', 'yum')
+        if op['repo_type'] not in UPLOAD_PATTERNS:
+            raise NexusError(f'Operation #{i} has unsupported repo_type: '
+                             f'{op["repo_type"]}')
+        if op['action'] == 'upload' and not op.get('file'):
+            raise NexusError(f'Operation #{i} has no file to upload: {op}')
+        if op['action'] in ('download', 'mirror') and not op.get('output'):
+            raise NexusError(f'Operation #{i} has no output to download '
+                             f'to: {op}')
+        op.setdefault('id', f'{i}-{op["action"]}-{op["name"]}')
+        ops.append(op)
+    return ops
+
+
+def plan_batch(ops):
+    """Return {id: set of ids it depends on} for the operations
+
+    Besides explicit depends_on lists, an operation depends on all
+    operations on the same repository of an earlier BATCH_ACTIONS stage.
+    """
+    ids = [op['id'] for op in ops]
+    if len(set(ids)) != len(ids):
+        raise NexusError('Operation ids in manifest are not unique')
+
+    deps = {op['id']: set(op.get('depends_on', [])) for op in ops}
+    by_name = {}
+    for op in ops:
+        by_name.setdefault(op['name'], []).append(op)
 
-def upload_apt(url, name, file_path, user, password):
+    for op in ops:
+        unknown = deps[op['id']] - set(ids)
+        if unknown:
+            raise NexusError(f'Operation {op["id"]} depends on unknown '
+                             f'operations: {sorted(unknown)}')
+        stage = BATCH_ACTIONS[op['action']]
+        for other in by_name[op['name']]:
+            if BATCH_ACTIONS[other['action']] < stage:
+                deps[op['id']].add(other['id'])
+
+    # Kahn's algorithm, just to reject cycles up front
+    pending = {op_id: len(op_deps) for op_id, op_deps in deps.items()}
+    ready = [op_id for op_id, count in pending.items() if count == 0]
+    visited = 0
+    while ready:
+        op_id = ready.pop()
+        visited += 1
+        for other, op_deps in deps.items():
+            if op_id in op_deps:
+                pending[other] -= 1
+                if pending[other] == 0:
+                    ready.append(other)
+    if visited != len(ops):
+        raise NexusError('Manifest operations have circular dependencies')
+    return deps
+
+
+def _run_timed(client, index, op, jobs):
+    start = time.monotonic()
+    result = {
+        'id': op['id'],
+        'action': op['action'],
+        'repo_type': op['repo_type'],
+        'name': op['name'],
+    }
     try:
-        artifcat = open(file_path, 'rb')
-    except IOError:
-        logging.error(f'Unable to open file: {file_path}')
-        sys.exit(1)
+        result.update(run_operation(client, index, op, jobs))
+        result['status'] = 'ok'
+    except (NexusError, IOError) as e:
+        if isinstance(e, NexusError):
+            log_error(e)
+        else:
+            logging.error(e)
+        result['status'] = 'failed'
+        result['error'] = str(e)
+    result['seconds'] = round(time.monotonic() - start, 3)
+    return result
 
-    upload_url = urljoin(url, f'repository/{name}')
 
-    # Forward slash at the end is mandatory for APT
-    if not upload_url.endswith('/'):
-        upload_url = upload_url + '/'
+def run_batch(client, index, ops, jobs=4):
+    """Run manifest operations, independent ones concurrently
 
-    response = requests.post(
-                             upload_url, data=artifcat,
-                             auth=requests.auth.HTTPBasicAuth(
-                                                              args.user,
-                                                              args.password
-                                                             )
-                            )
-    if response.status_code != 201:
-        logging.error(f'Unable to upload artifact {file_path} to {upload_url}')
-        logging.error(f'Status code: {response.status_code}')
-        logging.error(f'Response: {response.content}')
-        sys.exit(1)
-    logging.info('Done')
+    Operations whose dependencies failed are skipped. Returns the report.
+    """
+    deps = plan_batch(ops)
+    ops_by_id = {op['id']: op for op in ops}
+    results = {}
+    start = time.monotonic()
+
+    # Fetch the listing once for all existence checks, unless nothing
+    # in the manifest needs it
+    if (any(op['action'] not in ('show', 'delete') for op in ops) and
+            not index.is_fresh()):
+        index.refresh()
 
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        running = {}
+        while len(results) < len(ops):
+            for op_id, op_deps in deps.items():
+                if op_id in results or op_id in running.values():
+                    continue
+                if any(results.get(dep, {}).get('status') in ('failed',
+                                                               'skipped')
+                       for dep in op_deps):
+                    op = ops_by_id[op_id]
+                    results[op_id] = {
+                        'id': op_id,
+                        'action': op['action'],
+                        'repo_type': op['repo_type'],
+                        'name': op['name'],
+                        'status': 'skipped',
+                        'seconds': 0,
+                    }
+                elif all(dep in results for dep in op_deps):
+                    future = executor.submit(_run_timed, client, index,
+                                             ops_by_id[op_id], jobs)
+                    running[future] = op_id
+            if not running:
+                continue
+            done = next(as_completed(running))
+            results[running.pop(done)] = done.result()
 
-def get_apt_repo(url, name, user=None, password=None):
-    api_url = urljoin(url, f'service/rest/v1/repositories/apt/hosted/{name}')
+    report = {
+        'operations': [results[op['id']] for op in ops],
+        'summary': {
+            status: sum(1 for r in results.values() if r['status'] == status)
+            for status in ('ok', 'failed', 'skipped')
+        },
+    }
+    report['summary']['seconds'] = round(time.monotonic() - start, 3)
+    return report
 
-    auth_params = None
 
-    if user is not None and password is not None:
-        auth_params = requests.auth.HTTPBasicAuth(user, password)
+def batch(client, index, args):
+    ops = load_manifest(args.manifest)
+    report = run_batch(client, index, ops, args.jobs)
 
-    response = requests.get(api_url, auth=auth_params)
-    if response.status_code == 200:
-        response_json = json.loads(response.content)
-        print(json.dumps(response_json, indent=2))
+    if args.report:
+        with open(args.report, 'w') as report_file:
+            json.dump(report, report_file, indent=2)
     else:
-        logging.error(f'Failed to get repository: {name}')
-        logging.error(f'Status code: {response.status_code}')
-        logging.error(f'Response: {response.content}')
+        print(json.dumps(report, indent=2))
+
+    summary = report['summary']
+    logging.info(f'Batch done in {summary["seconds"]}s: ok: {summary["ok"]}, '
+                 f'failed: {summary["failed"]}, '
+                 f'skipped: {summary["skipped"]}')
+    if summary['failed'] or summary['skipped']:
         sys.exit(1)
 
 
+def connection_pool_size(args):
+    """Requests in flight at once, so no connection is opened just to be
+    dropped: jobs workers per operation plus the jobs range workers of a
+    download, times the jobs concurrent operations of a batch"""
+    jobs = max(1, args.jobs)
+    size = 2 * jobs
+    if args.repo_type == 'batch':
+        size *= jobs
+    return size
+
+
 def main(parser, args):
-    url = args.url
-    repo_list = get_repositories(url)
-    if args.action == 'delete':
-        delete_repository(url, args.name, args.user, args.password)
-    # YUM
-    if args.repo_type == 'yum':
-        if args.action == 'create':
-            if args.name not in [repo['name'] for repo in repo_list]:
-                create_yum_repo(url, args.name, args.user, args.password,
-                                args.repo_data_depth, args.blob_store,
-                                args.write_policy)
-            else:
-                logging.error(f'Repository already exists: {args.name}')
-                sys.exit(1)
-        if args.action == 'show':
-            get_yum_repo(url, args.name, args.user, args.password)
-        if args.action == 'upload':
-            if not args.file or not args.upload_path:
-                parser.error(
-                             '--file --upload_path options are '
-                             'required with --action=upload'
-                            )
-            if args.name not in [repo['name'] for repo in repo_list]:
-                logging.error(f'Repository {args.name} doesn\'t exist')
-                sys.exit(1)
-            upload_yum(
-                       url, args.name, args.file,
-                       args.user, args.password,
-                       upload_path=args.upload_path
-                      )
-    # APT
-    if args.repo_type == 'apt':
-        if args.action == 'create':
-            if args.name not in [repo['name'] for repo in repo_list]:
-                create_apt_repo(
-                                url, args.name, args.user, args.password,
-                                args.blob_store, args.write_policy,
-                                args.distro, args.keypair,
-                                args.keypair_file, args.passphrase
-                               )
-            else:
-                logging.error(f'Repository already exists: {args.name}')
-                sys.exit(1)
-        if args.action == 'show':
-            get_apt_repo(url, args.name, args.user, args.password)
-        if args.action == 'upload':
-            if not args.file:
-                parser.error(
-                             '--file option is required'
-                             'with --action=upload'
-                            )
-            if args.name not in [repo['name'] for repo in repo_list]:
-                logging.error(f'Repository {args.name} doesn\'t exist')
-                sys.exit(1)
-            upload_apt(url, args.name, args.file, args.user, args.password)
+    metrics = None
+    if args.metrics_file or args.metrics_port:
+        metrics = Metrics()
+        if args.metrics_port:
+            metrics.serve(args.metrics_port)
+    client = NexusClient(args.url, args.user, args.password,
+                         timeout=(10, args.timeout), retries=args.retries,
+                         pool_size=connection_pool_size(args),
+                         metrics=metrics)
+    try:
+        run(parser, args, client)
+    finally:
+        if args.metrics_file:
+            metrics.write(args.metrics_file)
+        if metrics is not None:
+            metrics.close()
+
+
+def run(parser, args, client):
+    index = RepositoryIndex(client, args.repo_cache, args.repo_cache_ttl)
+
+    if args.repo_type == 'batch':
+        batch(client, index, args)
+        return
+
+    if args.action == 'upload':
+        if args.repo_type == 'yum' and (not args.file or
+                                        not args.upload_path):
+            parser.error(
+                         '--file --upload_path options are '
+                         'required with --action=upload'
+                        )
+        if not args.file:
+            parser.error(
+                         '--file option is required '
+                         'with --action=upload'
+                        )
+
+    if args.action in ('download', 'mirror') and not args.output:
+        parser.error(
+                     '--output option is required '
+                     f'with --action={args.action}'
+                    )
+
+    if (args.action == 'prune' and args.keep_last is None and
+            args.older_than is None):
+        parser.error(
+                     '--keep-last or --older-than option is required '
+                     'with --action=prune'
+                    )
+
+    op = {
+        key: value for key, value in vars(args).items()
+        if value is not None
+    }
+    op['name'] = args.name
+    if op.get('keypair_file'):
+        op['keypair'] = args.keypair_file.read()
+        del op['keypair_file']
+
+    result = run_operation(client, index, op, args.jobs)
+    if args.action == 'show':
+        print(json.dumps(result['repository'], indent=2))
 
 
 if __name__ == '__main__':
+    logging.basicConfig(
+        level=logging.INFO,
+        format='[%(asctime)s] %(levelname)s '
+               '[%(name)s.%(funcName)s:%(lineno)d] '
+               '%(message)s',
+        datefmt='%d/%b/%Y %H:%M:%S',
+        stream=sys.stdout)
+
     parser, args = usage()
-    main(parser, args)
+    try:
+        main(parser, args)
+    except NexusError as e:
+        log_error(e)
+        sys.exit(1)
@@ -1,27 +1,204 @@
 import yamale
 from yamale import YamaleError
-import sys
 import os
+import sys
+import glob
+import json
+import hashlib
+import argparse
 
 script_root = os.path.dirname(os.path.abspath(__file__))
-yaml_file_to_validate = None
-try:
-    if os.path.isfile(sys.argv[1]):
-        yaml_file_to_validate = sys.argv[1]
-    else:
-        raise
-except:
-    print("This script expects first parameter to be a YAML schema file")
-    exit(1)
-
 schema_file = script_root + '/ci_demo_schema.yaml'
 
-schema = yamale.make_schema(schema_file)
-data = yamale.make_data(yaml_file_to_validate)
+# .ci/project_loader.py of the same checkout (or zipapp) parses with
+# CSafeLoader and shares its parse cache with the .ci tools. The
+# validator does not depend on it: when the module is not found, as for
+# a copy of schema_validator/ on its own, files are parsed with
+# yamale.make_data instead.
+sys.path.append(os.path.join(os.path.dirname(script_root), '.ci'))
 try:
-    yamale.validate(schema, data)
-    print('CI-Demo {} successfuly validated!'.format(yaml_file_to_validate))
-except YamaleError as e:
-    print('CI-Demo YAML Validation failed!')
-    print(e)
-    exit(1)
\ No newline at end of file
+    import project_loader
+except ImportError:
+    project_loader = None
+
+
+def default_schema():
+    """Schema next to this script, extracted to a temp file when it is
+    packed in a zipapp (yamale needs a real file)"""
+    if os.path.isfile(schema_file):
+        return schema_file
+    import pkgutil
+    import tempfile
+    data = pkgutil.get_data(__name__, 'ci_demo_schema.yaml')
+    path = os.path.join(tempfile.gettempdir(), 'ci_demo_schema-{}.yaml'.format(hashlib.sha256(data).hexdigest()[:12]))
+    if not os.path.isfile(path):
+        tmp = '{}.{}'.format(path, os.getpid())
+        with open(tmp, 'wb') as fout:
+            fout.write(data)
+        os.replace(tmp, path)
+    return path
+
+
+# set once per process by init_worker()
+schema = None
+
+
+def usage():
+    parser = argparse.ArgumentParser(description='Validate ci-demo project files against the ci-demo schema')
+    parser.add_argument('files', metavar='FILE', nargs='+',
+                        help='Project file or glob pattern (quoted, ** is supported), can be repeated')
+    parser.add_argument('-s', '--schema', help='Schema file, default: {}'.format(schema_file))
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1,
+                        help='Number of validation processes, default: %(default)s')
+    parser.add_argument('-c', '--cache', metavar='FILE',
+                        help='Result cache keyed on file content, unchanged files are not validated again')
+    parser.add_argument('--json', metavar='FILE', nargs='?', const='-',
+                        help='Write aggregated results as JSON to FILE, default: stdout')
+    args = parser.parse_args()
+    if args.schema is None:
+        args.schema = default_schema()
+    return args
+
+
+def expand_files(patterns):
+    files = []
+    for pattern in patterns:
+        if os.path.isfile(pattern):
+            matches = [pattern]
+        else:
+            matches = sorted(f for f in glob.glob(pattern, recursive=True) if os.path.isfile(f))
+        if not matches:
+            raise ValueError("No YAML file matches '{}'".format(pattern))
+        files.extend(m for m in matches if m not in files)
+    return files
+
+
+def sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as fin:
+        for chunk in iter(lambda: fin.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def init_worker(path):
+    global schema
+    schema = yamale.make_schema(path)
+
+
+def validate_file(path):
+    result = {'file': path, 'valid': True, 'errors': []}
+    try:
+        if project_loader:
+            data = [(doc, path) for doc in project_loader.load_all(path)] or [({}, path)]
+        else:
+            data = yamale.make_data(path)
+        yamale.validate(schema, data)
+    except YamaleError as e:
+        result['valid'] = False
+        result['errors'] = [error for res in e.results for error in res.errors]
+        result['message'] = str(e)
+    except Exception as e:
+        # broken YAML, unreadable file
+        result['valid'] = False
+        result['errors'] = ['{}: {}'.format(type(e).__name__, e)]
+        result['message'] = result['errors'][0]
+    return result
+
+
+def load_cache(path, schema_hash):
+    try:
+        with open(path) as fin:
+            cache = json.load(fin)
+    except (OSError, ValueError):
+        return {}
+    if cache.get('schema') != schema_hash or cache.get('yamale') != yamale.__version__:
+        return {}
+    return cache.get('files', {})
+
+
+def save_cache(path, schema_hash, entries):
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as fout:
+        json.dump({'schema': schema_hash, 'yamale': yamale.__version__, 'files': entries}, fout)
+    os.replace(tmp, path)
+
+
+def validate_files(files, schema_path, jobs=1, cache_file=None):
+    schema_hash = sha256(schema_path)
+    hashes = {f: sha256(f) for f in files}
+    cache = load_cache(cache_file, schema_hash) if cache_file else {}
+
+    results = {}
+    todo = []
+    for f in files:
+        entry = cache.get(hashes[f])
+        if entry is not None:
+            results[f] = dict(entry, file=f, cached=True)
+        elif f not in todo:
+            todo.append(f)
+
+    if todo:
+        jobs = max(1, min(jobs, len(todo)))
+        if jobs == 1:
+            init_worker(schema_path)
+            done = map(validate_file, todo)
+        else:
+            # imported here, single file runs don't pay for multiprocessing
+            from concurrent.futures import ProcessPoolExecutor
+            pool = ProcessPoolExecutor(max_workers=jobs, initializer=init_worker, initargs=(schema_path,))
+            done = pool.map(validate_file, todo)
+        for res in done:
+            res['cached'] = False
+            results[res['file']] = res
+            cache[hashes[res['file']]] = {k: v for k, v in res.items() if k not in ('file', 'cached')}
+        if jobs > 1:
+            pool.shutdown()
+
+    if cache_file:
+        save_cache(cache_file, schema_hash, {hashes[f]: cache[hashes[f]] for f in files})
+    return [results[f] for f in files]
+
+
+def main(args):
+    try:
+        files = expand_files(args.files)
+    except ValueError as e:
+        print(e)
+        exit(1)
+
+    results = validate_files(files, args.schema, args.jobs, args.cache)
+    # JSON on stdout is the only output
+    quiet = args.json == '-'
+    for res in results:
+        if quiet:
+            pass
+        elif res['valid']:
+            print('CI-Demo {} successfuly validated!{}'.format(res['file'], ' (cached)' if res['cached'] else ''))
+        else:
+            print('CI-Demo YAML Validation failed!')
+            print(res['message'])
+
+    failed = [res['file'] for res in results if not res['valid']]
+    if args.json:
+        report = {
+            'schema': os.path.abspath(args.schema),
+            'total': len(results),
+            'failed': len(failed),
+            'cached': sum(1 for res in results if res['cached']),
+            'results': results,
+        }
+        if args.json == '-':
+            print(json.dumps(report, indent=2))
+        else:
+            with open(args.json, 'w') as fout:
+                json.dump(report, fout, indent=2)
+    if len(results) > 1 and not quiet:
+        print('Validated {} files, {} failed'.format(len(results), len(failed)))
+    if failed:
+        exit(1)
+
+
+if __name__ == '__main__':
+    args = usage()
+    main(args)
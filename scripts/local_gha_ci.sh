@@ -352,6 +352,7 @@ if ! docker exec "${JENKINS_NAME}" "${validator_python}" -c "import yamale" >/de
   echo "ERROR: validator runtime not available in Jenkins container (${validator_python}). Rebuild ${JENKINS_IMAGE} from .github/Dockerfile.jenkins" >&2
   exit 1
 fi
+conf_paths=()
 for conf in "${conf_files[@]}"; do
   conf_rel="${conf}"
   if [[ "${conf_rel}" == ./* ]]; then
@@ -360,8 +361,9 @@ for conf in "${conf_files[@]}"; do
     conf_rel="${REPO_MOUNT}/${conf_rel}"
   fi
   echo "Validating schema: ${conf_rel}"
-  docker exec "${JENKINS_NAME}" "${validator_python}" "${REPO_MOUNT}/schema_validator/ci_demo_yaml_validator.py" "${conf_rel}"
+  conf_paths+=("${conf_rel}")
 done
+docker exec "${JENKINS_NAME}" "${validator_python}" "${REPO_MOUNT}/schema_validator/ci_demo_yaml_validator.py" "${conf_paths[@]}"
 
 echo "[7/9] Creating/updating Jenkins job ci-demo"
 sed -e "s|REPO_URL_PLACEHOLDER|${REPO_URL}|g" \
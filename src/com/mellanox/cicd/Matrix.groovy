@@ -1481,6 +1481,30 @@ spec:
     }
 }
 
+// Reorder task names by the 'order' list of the batchSchedule file
+// written by .ci/batch_scheduler.py, names missing from it go last
+def orderTasks(config, names) {
+
+    def scheduleFile = getConfigVal(config, ['batchSchedule'], null)
+    if (!scheduleFile) {
+        return names
+    }
+
+    if (!fileExists(scheduleFile)) {
+        config.logger.warn("batchSchedule file ${scheduleFile} not found, keeping declaration order")
+        return names
+    }
+
+    def order = readYaml(file: scheduleFile)?.order ?: []
+    def known = names.findAll { order.contains(it) }
+    if (!known) {
+        return names
+    }
+    def res = order.findAll { names.contains(it) } + names.findAll { !order.contains(it) }
+    config.logger.debug("orderTasks: ordered ${known.size()} of ${names.size()} tasks by ${scheduleFile}")
+    return res
+}
+
 def run_parallel_in_chunks(config, myTasks, depth) {
 
     if (myTasks.size() == 0) {
@@ -1496,7 +1520,7 @@ def run_parallel_in_chunks(config, myTasks, depth) {
     def val = getConfigVal(config, ['failFast'], false)
 
     config.logger.trace(3, "run_parallel_in_chunks: batch size is ${bSize}")
-    (myTasks.keySet() as List).collate(bSize).each {
+    (orderTasks(config, myTasks.keySet() as List)).collate(bSize).each {
         def batchMap = myTasks.subMap(it)
         batchMap['failFast'] = val
         parallel batchMap